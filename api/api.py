@@ -1,4 +1,5 @@
 import atexit
+import signal
 import time
 import traceback
 
@@ -16,9 +17,12 @@ from models.search import SearchSchema, SuggestionSearchSchema
 
 # single global of our index
 from search.analyzer import Analyzer
+from search.embedding import DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT_MS
 from search.exception import IndexException, StoreException, MergeException, SearchException, TrieException, \
     ExpansionsException
 from search.index import Index
+from search.merge import TieredMergePolicy, DEFAULT_SEGMENTS_PER_TIER, DEFAULT_MAX_MERGED_DOCS, \
+    DEFAULT_MAX_MERGE_MB_PER_SEC
 from search.utils import load_stop_words
 from cheroot.wsgi import Server as WSGIServer
 from cheroot.wsgi import PathInfoDispatcher as WSGIPathInfoDispatcher
@@ -35,7 +39,28 @@ def create_app():
     index_dir = os.path.join(os.getcwd(), 'index')
     os.makedirs(index_dir, exist_ok=True)
     # we stem and enable stop words for now
-    index = Index(index_dir, Analyzer(stop_words, True), doc_value_fields=['authors', 'subject'])
+    # segments are merged in the background after flushes unless disabled - /optimize can still be used
+    merge_policy = TieredMergePolicy(
+        segments_per_tier=int(os.getenv("MERGE_SEGMENTS_PER_TIER", DEFAULT_SEGMENTS_PER_TIER)),
+        max_merged_docs=int(os.getenv("MERGE_MAX_DOCS", DEFAULT_MAX_MERGED_DOCS)))
+    # under serve.py one writer process indexes whilst reader processes serve queries over the same files - the writer
+    # signals the master process after flushes and merges, which signals the readers to refresh
+    read_only = os.getenv("INDEX_ROLE", "writer").lower() == "reader"
+    on_segments_changed = None
+    if not read_only and os.getenv("INDEX_NOTIFY_PID"):
+        notify_pid = int(os.getenv("INDEX_NOTIFY_PID"))
+        on_segments_changed = lambda: os.kill(notify_pid, signal.SIGUSR1)
+    index = Index(index_dir, Analyzer(stop_words, True), doc_value_fields=['authors', 'subject'],
+                  auto_merge=not read_only and os.getenv("AUTO_MERGE", "true").lower() == "true",
+                  merge_policy=merge_policy,
+                  max_merge_mb_per_sec=float(os.getenv("MERGE_MAX_MB_PER_SEC", DEFAULT_MAX_MERGE_MB_PER_SEC)),
+                  read_only=read_only, on_segments_changed=on_segments_changed,
+                  analysis_processes=int(os.getenv("ANALYSIS_PROCESSES", 1)),
+                  embedding_batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE)),
+                  embedding_wait_ms=float(os.getenv("EMBEDDING_WAIT_MS", DEFAULT_MAX_WAIT_MS)),
+                  embedding_cache_bytes=int(float(os.getenv("EMBEDDING_CACHE_MB", 16)) * 1024 * 1024),
+                  persist_embeddings=os.getenv("PERSIST_EMBEDDINGS", "true").lower() == "true",
+                  vector_backend=os.getenv("VECTOR_BACKEND", "fp32").lower())
     index.load()
     print('Index ready')
     return app
@@ -92,8 +117,8 @@ def suggest():
 def search():
     try:
         start_time = time.time()
-        hits, facets, total = index.search(SearchSchema().load(request.get_json()))
-        results = Results(hits, total, facets, round((time.time() - start_time), 3))
+        hits, facets, total, total_is_lower_bound = index.search(SearchSchema().load(request.get_json()))
+        results = Results(hits, total, facets, round((time.time() - start_time), 3), total_is_lower_bound)
         return jsonify(ResultsSchema().dump(results)), 200
         # TODO: Pass the request to API and marshall the responses
     except ValidationError as e:
@@ -196,11 +221,13 @@ def flush():
                 APIError('unable to execute flush - unexpected exception', {"exception": str(ue)}))), 400
 
 
-# selects two segments (smallest and flushed) and merges them together
+# selects two segments (smallest and flushed) and merges them together or, if target_segments is passed, merges the
+# segments down to that number
 @app.route('/optimize', methods=['POST', 'GET'])
 def optimize():
     try:
-        before, after = index.optimize()
+        target_segments = request.args.get('target_segments', type=int)
+        before, after = index.optimize(target_segments=target_segments)
         return jsonify({'ok': True, "segments": {
             "before": before,
             "after": after
@@ -215,6 +242,20 @@ def optimize():
                 APIError('unable to execute optimize - unexpected exception', {"exception": str(ue)}))), 400
 
 
+# state of the background merges - the running merge, merges completed, bytes written and time throttled. Only the
+# writer merges (see serve.py) so readers always report no merges - nginx.conf routes this to the writer
+@app.route('/merges', methods=['GET'])
+def merges():
+    return jsonify(index.merge_state()), 200
+
+
+# hit and miss counts and memory use of the index caches - of this process only, so with serve.py of whichever reader
+# nginx.conf balanced the request to
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(index.cache_stats()), 200
+
+
 @app.route('/build_suggest', methods=['POST', 'GET'])
 def build_trie():
     try:
@@ -10,9 +10,11 @@ class ResultSchema(Schema):
 
 
 class Results:
-    def __init__(self, hits, total_hits, facets, time_elapsed):
+    def __init__(self, hits, total_hits, facets, time_elapsed, total_hits_lower_bound=False):
         self.hits = hits
         self.total_hits = total_hits
+        # natural language searches without facets only count the neighbours retrieved for the page
+        self.total_hits_lower_bound = total_hits_lower_bound
         self.facets = facets
         self.time_elapsed = time_elapsed
         self.request_id = str(uuid.uuid1())
@@ -21,6 +23,7 @@ class Results:
 class ResultsSchema(Schema):
     hits = fields.List(fields.Nested(ResultSchema))
     total_hits = fields.Int()
+    total_hits_lower_bound = fields.Bool()
     facets = fields.Dict()
     time_elapsed = fields.Float()
     request_id = fields.Str()
@@ -3,6 +3,10 @@ from transformers import AutoTokenizer, AutoModel
 from sentence_transformers import SentenceTransformer
 
 
+# inference backends - int8 trades a little accuracy for speed on CPU
+BACKENDS = ['fp32', 'int8']
+
+
 class BERTModule:
     '''
     Attributes:
@@ -12,17 +16,23 @@ class BERTModule:
             2: "allenai/longformer-base-4096"
             3: "distilbert-base-uncased"
             4: 'multi-qa-MiniLM-L6-cos-v1' (S-BERT trained on consine sim)
+        backend: 'fp32' (default) or 'int8' - dynamic int8 quantization of the linear layers for faster CPU inference
         tokenizer: pretrained tokenizer
         model: pretrained model
     Methods:
         config(): show configuration of pre-trained model used
         embed(input): generate embedding for given input (string/list of string)
+        embed_batch(inputs): generate embeddings for a list of queries
     '''
 
-    def __init__(self, vmodel=0):
+    def __init__(self, vmodel=0, backend='fp32'):
         '''
         Input: (vmodel) string indicating the pre-trained model; default is 'bert-base-uncased'
+                (backend) the inference backend - 'fp32' or 'int8'
         '''
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend} - must be one of {', '.join(BACKENDS)}")
+        self.backend = backend
         self.model_choice = ['bert-base-uncased', 'bert-large-uncased', "allenai/longformer-base-4096",
                              "distilbert-base-uncased", 'multi-qa-MiniLM-L6-cos-v1']
         self.vmodel = vmodel
@@ -39,6 +49,13 @@ class BERTModule:
             self.model = SentenceTransformer(self.model_choice[vmodel])
         else:
             print('No such moel choice!')
+            return
+        if backend == 'int8':
+            # weights of the linear layers, which dominate inference, are stored as int8 and activations quantized on
+            # the fly - around 4x smaller and faster on CPU, at a small cost in accuracy (see utils/bench_embeddings.py)
+            print('Quantizing model to int8...', end='')
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            print('done')
 
     def config(self):
         print('The configuration of model:')
@@ -69,6 +86,15 @@ class BERTModule:
         else:
             print('Cannot embed with this model choice!')
 
+    def embed_batch(self, inputs):
+        '''
+        Input: (inputs) list of query strings
+        Output: one vector per query, in order - a single forward pass for the S-BERT model
+        '''
+        if self.vmodel == 4:
+            return self.model.encode(inputs)
+        return [self.embed(input, sentwise=False) for input in inputs]
+
     def __sentence_embedding(self, sentence):
         '''
         Input: (sentence) a sentence string, if end with \n, remove it, should less than max length of number of tokens
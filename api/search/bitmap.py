@@ -0,0 +1,54 @@
+import numpy as np
+
+from search.kernels import DOC_ID_TYPE, EMPTY_DOC_IDS
+
+# containers holding more docs than this are stored as a bitset - 4096 16 bit values is the size of a 2^16 bitset
+ARRAY_CONTAINER_MAX = 4096
+
+
+# A compressed bitmap of doc ids in the layout of a roaring bitmap. Doc ids are partitioned by their high 16 bits, each
+# partition holding its low 16 bits in a container - a sorted uint16 array if sparse, otherwise a 2^16 bitset (8KB). A
+# sparse set thus costs 2 bytes per doc and a dense set 1 bit, compared to 4 or 8 bytes for an array of doc ids.
+class RoaringBitmap:
+
+    def __init__(self, keys, containers, cardinality):
+        self._keys = keys
+        # uint16 arrays or uint8 packed bitsets
+        self._containers = containers
+        self._cardinality = cardinality
+
+    @staticmethod
+    def from_doc_ids(doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.uint32)
+        keys, starts = np.unique(doc_ids >> 16, return_index=True)
+        ends = np.append(starts[1:], len(doc_ids))
+        containers = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            low = (doc_ids[start:end] & 0xFFFF).astype(np.uint16)
+            if end - start > ARRAY_CONTAINER_MAX:
+                bits = np.zeros(1 << 16, dtype=bool)
+                bits[low] = True
+                containers.append(np.packbits(bits, bitorder='little'))
+            else:
+                containers.append(low)
+        return RoaringBitmap(keys.tolist(), containers, len(doc_ids))
+
+    def __len__(self):
+        return self._cardinality
+
+    @property
+    def nbytes(self):
+        return sum(container.nbytes for container in self._containers) + 8 * len(self._keys)
+
+    # the doc ids as a sorted array
+    def doc_ids(self):
+        if self._cardinality == 0:
+            return EMPTY_DOC_IDS
+        parts = []
+        for key, container in zip(self._keys, self._containers):
+            if container.dtype == np.uint8:
+                low = np.flatnonzero(np.unpackbits(container, bitorder='little'))
+            else:
+                low = container
+            parts.append(low.astype(DOC_ID_TYPE) + (key << 16))
+        return np.concatenate(parts)
@@ -0,0 +1,78 @@
+import hashlib
+import io
+import math
+import os
+import struct
+
+import numpy as np
+
+# default false positive rate - roughly 10 bits and 7 hashes per term
+FALSE_POSITIVE_RATE = 0.01
+
+
+def _hashes(term):
+    # a stable hash (unlike hash()) as the filter is persisted - two 64 bit halves for double hashing
+    digest = hashlib.blake2b(term.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+# A Bloom filter over the terms of a flushed segment, so lookups of terms not in the segment (rare and misspelt terms
+# against an index with many segments) can be answered without touching the term dictionary or postings. A negative is
+# certain, a positive is wrong with probability ~FALSE_POSITIVE_RATE. Bit i of the filter is set for each of the
+# num_hashes positions (h1 + i * h2) % num_bits of a term. Layout:
+#
+#   <flag><num bits:Q><num hashes:I><number of terms:I><bits, little endian bit order>
+class BloomFilter:
+    START_FLAG = b'# BLOOM v1\n'
+    HEADER = struct.Struct('<QII')
+
+    def __init__(self, num_bits, num_hashes, count, bits):
+        self._num_bits = num_bits
+        self._num_hashes = num_hashes
+        self.count = count
+        self._bits = bits
+
+    @staticmethod
+    def path_for(segment_path):
+        return f"{segment_path}.blm"
+
+    @staticmethod
+    def from_terms(terms, false_positive_rate=FALSE_POSITIVE_RATE):
+        terms = list(terms)
+        count = max(len(terms), 1)
+        num_bits = max(math.ceil(-count * math.log(false_positive_rate) / math.log(2) ** 2), 8)
+        num_hashes = max(round(num_bits / count * math.log(2)), 1)
+        hashes = np.array([_hashes(term) for term in terms], dtype=np.uint64).reshape(-1, 2)
+        # positions of all terms at once - uint64 arithmetic wraps as the python version below does modulo 2^64
+        steps = np.arange(num_hashes, dtype=np.uint64)
+        positions = (hashes[:, :1] + steps * hashes[:, 1:]) % np.uint64(num_bits)
+        bits = np.zeros(num_bits, dtype=bool)
+        bits[positions.ravel().astype(np.int64)] = True
+        return BloomFilter(num_bits, num_hashes, len(terms), np.packbits(bits, bitorder='little').tobytes())
+
+    @staticmethod
+    def read(path):
+        with io.open(path, 'rb') as file:
+            if file.read(len(BloomFilter.START_FLAG)) != BloomFilter.START_FLAG:
+                raise ValueError(f"{path} is not a bloom filter")
+            num_bits, num_hashes, count = BloomFilter.HEADER.unpack(file.read(BloomFilter.HEADER.size))
+            bits = file.read()
+        if len(bits) != (num_bits + 7) // 8:
+            raise ValueError(f"{path} is truncated")
+        return BloomFilter(num_bits, num_hashes, count, bits)
+
+    def write(self, path):
+        # written to a temp file first so a partial filter is never loaded
+        with io.open(f"{path}.tmp", 'wb') as file:
+            file.write(self.START_FLAG)
+            file.write(self.HEADER.pack(self._num_bits, self._num_hashes, self.count))
+            file.write(self._bits)
+        os.replace(f"{path}.tmp", path)
+
+    def __contains__(self, term):
+        h1, h2 = _hashes(term)
+        for i in range(self._num_hashes):
+            position = ((h1 + i * h2) & 0xFFFFFFFFFFFFFFFF) % self._num_bits
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+
+
+# A thread safe least recently used cache, bounded by the total size in bytes of its values rather than their number -
+# cached values such as doc sets vary widely in size. Values larger than the whole cache are never cached.
+class LRUCache:
+
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        # key -> (value, size in bytes), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries[key][1]
+            self._entries[key] = (value, size)
+            self._entries.move_to_end(key)
+            self._bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._bytes > self._max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    # changes the budget of the cache, evicting the least recently used entries if it shrinks
+    def resize(self, max_bytes):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    # removes all entries whose key matches the predicate e.g. those of a segment removed by a merge
+    def invalidate(self, predicate):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    # the (key, value) pairs, least recently used first
+    def items(self):
+        with self._lock:
+            return [(key, value) for key, (value, _) in self._entries.items()]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / requests if requests > 0 else 0
+            }
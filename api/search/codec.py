@@ -0,0 +1,227 @@
+import struct
+
+import numpy as np
+
+# Binary encoding of a term's postings. Version 1 is the original text format (see posting.py) which we can still
+# read. Version 2 splits the posting list into fixed size blocks of doc ids, frequencies and (optionally) positions.
+# Each block is delta encoded and bit-packed so it can be decoded with a handful of numpy operations rather than
+# Python string splitting. Layout of a term value:
+#
+#   header      <version:B><flags:B><first occurrence length:H><first occurrence utf-8>
+#   stats       <collection frequency:I><doc frequency:I><number of blocks:I><max frequency:I>
+#   skip table  <last doc id:I><block offset:I><doc count:I><max frequency:I> per block - offsets are relative to the
+#               data section
+#   data        the blocks
+#
+# and each block:
+#
+#   <first doc id:I><doc bit width:B><frequency bit width:B><position bit width:B>
+#   (doc id gaps - 1) packed, (frequencies - 1) packed, positions delta encoded per doc and packed
+#
+# Blocks are self-contained (the first doc id is absolute) so a reader can jump to any block using the skip table
+# and decode only that block. Version 3 adds the max frequency of the term and of each block - the score of a doc is
+# monotonic in its frequency so these give upper bounds on the scores in a term/block, allowing queries to skip docs
+# that can't make the top results (see iterators.py). Version 2 (without the max frequencies) can still be read.
+FORMAT_VERSION = 3
+BLOCK_SIZE = 128
+
+WITH_POSITIONS = 1
+
+_HEADER = struct.Struct('<BBH')
+_STATS = struct.Struct('<IIII')
+_BLOCK_HEADER = struct.Struct('<IBBB')
+SKIP_ENTRY = np.dtype([('last_doc', '<u4'), ('offset', '<u4'), ('count', '<u4'), ('max_freq', '<u4')])
+_STATS_V2 = struct.Struct('<III')
+_SKIP_ENTRY_V2 = np.dtype([('last_doc', '<u4'), ('offset', '<u4'), ('count', '<u4')])
+
+
+def _bit_width(values):
+    if len(values) == 0:
+        return 0
+    return int(values.max()).bit_length()
+
+
+def _pack(values, width):
+    if width == 0 or len(values) == 0:
+        return b''
+    shifts = np.arange(width - 1, -1, -1, dtype=np.uint64)
+    bits = (values.astype(np.uint64)[:, None] >> shifts) & np.uint64(1)
+    return np.packbits(bits.astype(np.uint8)).tobytes()
+
+
+def _unpack(buffer, offset, count, width):
+    if width == 0 or count == 0:
+        return np.zeros(count, dtype=np.int64), offset
+    num_bytes = (count * width + 7) // 8
+    packed = np.frombuffer(buffer, dtype=np.uint8, count=num_bytes, offset=offset)
+    bits = np.unpackbits(packed, count=count * width).reshape(count, width)
+    values = bits.dot(np.left_shift(1, np.arange(width - 1, -1, -1, dtype=np.int64)))
+    return values, offset + num_bytes
+
+
+def _encode_block(doc_ids, frequencies, positions):
+    gaps = np.diff(doc_ids) - 1
+    freqs = frequencies - 1
+    doc_width = _bit_width(gaps)
+    freq_width = _bit_width(freqs)
+    if positions is not None:
+        # delta encode positions within each doc - the first position of a doc is absolute
+        starts = np.concatenate(([0], np.cumsum(frequencies)[:-1]))
+        deltas = np.diff(positions, prepend=0)
+        deltas[starts] = positions[starts]
+        pos_width = _bit_width(deltas)
+    else:
+        deltas = None
+        pos_width = 0
+    parts = [_BLOCK_HEADER.pack(int(doc_ids[0]), doc_width, freq_width, pos_width), _pack(gaps, doc_width),
+             _pack(freqs, freq_width)]
+    if deltas is not None:
+        parts.append(_pack(deltas, pos_width))
+    return b''.join(parts)
+
+
+def encode(doc_ids, frequencies, positions=None, collection_frequency=0, first_occurrence=None):
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    frequencies = np.asarray(frequencies, dtype=np.int64)
+    flags = 0
+    if positions is not None:
+        positions = np.asarray(positions, dtype=np.int64)
+        flags |= WITH_POSITIONS
+        position_offsets = np.concatenate(([0], np.cumsum(frequencies)))
+    occurrence = first_occurrence.encode('utf-8') if first_occurrence else b''
+    num_blocks = (len(doc_ids) + BLOCK_SIZE - 1) // BLOCK_SIZE
+    skips = np.zeros(num_blocks, dtype=SKIP_ENTRY)
+    blocks = []
+    offset = 0
+    for b in range(num_blocks):
+        start = b * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, len(doc_ids))
+        block_positions = None
+        if positions is not None:
+            block_positions = positions[position_offsets[start]:position_offsets[end]]
+        block = _encode_block(doc_ids[start:end], frequencies[start:end], block_positions)
+        skips[b] = (doc_ids[end - 1], offset, end - start, frequencies[start:end].max())
+        blocks.append(block)
+        offset += len(block)
+    return b''.join([_HEADER.pack(FORMAT_VERSION, flags, len(occurrence)), occurrence,
+                     _STATS.pack(collection_frequency, len(doc_ids), num_blocks,
+                                 int(frequencies.max()) if len(frequencies) > 0 else 0), skips.tobytes()] + blocks)
+
+
+class TermHeader:
+    # the fixed part of an encoded term - enough to answer frequency questions and locate blocks
+    __slots__ = ('first_occurrence', 'collection_frequency', 'doc_frequency', 'max_frequency', 'has_positions', 'skips',
+                 'data_offset')
+
+    def __init__(self, buffer):
+        version, flags, occurrence_length = _HEADER.unpack_from(buffer, 0)
+        if version != FORMAT_VERSION and version != 2:
+            raise ValueError(f"Unsupported posting format version {version}")
+        offset = _HEADER.size
+        occurrence = bytes(buffer[offset:offset + occurrence_length])
+        self.first_occurrence = occurrence.decode('utf-8') if occurrence_length > 0 else None
+        offset += occurrence_length
+        if version == 2:
+            # no max frequencies - None indicates the scores of the term are unbounded
+            self.collection_frequency, self.doc_frequency, num_blocks = _STATS_V2.unpack_from(buffer, offset)
+            self.max_frequency = None
+            offset += _STATS_V2.size
+            skip_entry = _SKIP_ENTRY_V2
+        else:
+            self.collection_frequency, self.doc_frequency, num_blocks, self.max_frequency = _STATS.unpack_from(buffer,
+                                                                                                             offset)
+            offset += _STATS.size
+            skip_entry = SKIP_ENTRY
+        self.has_positions = flags & WITH_POSITIONS == WITH_POSITIONS
+        self.skips = np.frombuffer(buffer, dtype=skip_entry, count=num_blocks, offset=offset)
+        self.data_offset = offset + num_blocks * skip_entry.itemsize
+
+
+# whether an encoded term can be combined by concatenate/strip_positions without decoding - the current version only
+def is_raw_mergeable(buffer):
+    return not isinstance(buffer, str) and len(buffer) > 0 and buffer[0] == FORMAT_VERSION
+
+
+# The encoding of the postings of a term in several segments, given their encodings in doc id order, without decoding
+# them. Blocks are self-contained so they are copied as is and only the skip table is rebased - block offsets are
+# shifted by the data before them. All must be of the current version and all with or all without positions.
+def concatenate(buffers):
+    headers = [TermHeader(buffer) for buffer in buffers]
+    skips = np.concatenate([header.skips for header in headers])
+    data = []
+    offset = 0
+    start = 0
+    for buffer, header in zip(buffers, headers):
+        skips['offset'][start:start + len(header.skips)] += offset
+        start += len(header.skips)
+        data.append(buffer[header.data_offset:])
+        offset += len(buffer) - header.data_offset
+    first = headers[0]
+    occurrence = first.first_occurrence.encode('utf-8') if first.first_occurrence else b''
+    return b''.join([_HEADER.pack(FORMAT_VERSION, WITH_POSITIONS if first.has_positions else 0, len(occurrence)),
+                     occurrence, _STATS.pack(sum(header.collection_frequency for header in headers),
+                                             sum(header.doc_frequency for header in headers), len(skips),
+                                             max(header.max_frequency for header in headers)), skips.tobytes()] + data)
+
+
+# The encoding of a term without its positions, as encode would produce it, from its encoding with positions. The
+# positions are at the end of each block, byte aligned, so each block is truncated - only the widths in its header are
+# read and the skip table is rebased for the shorter blocks.
+def strip_positions(buffer):
+    header = TermHeader(buffer)
+    if not header.has_positions:
+        return bytes(buffer)
+    skips = header.skips.copy()
+    blocks = []
+    offset = 0
+    for b in range(len(skips)):
+        start = header.data_offset + int(skips[b]['offset'])
+        count = int(skips[b]['count'])
+        first_doc, doc_width, freq_width, _ = _BLOCK_HEADER.unpack_from(buffer, start)
+        length = ((count - 1) * doc_width + 7) // 8 + (count * freq_width + 7) // 8
+        block = _BLOCK_HEADER.pack(first_doc, doc_width, freq_width, 0) + bytes(
+            buffer[start + _BLOCK_HEADER.size:start + _BLOCK_HEADER.size + length])
+        skips[b]['offset'] = offset
+        blocks.append(block)
+        offset += len(block)
+    occurrence = header.first_occurrence.encode('utf-8') if header.first_occurrence else b''
+    return b''.join([_HEADER.pack(FORMAT_VERSION, 0, len(occurrence)), occurrence,
+                     _STATS.pack(header.collection_frequency, header.doc_frequency, len(skips), header.max_frequency),
+                     skips.tobytes()] + blocks)
+
+
+def decode_block(buffer, header, block, with_positions=True):
+    entry = header.skips[block]
+    count = int(entry['count'])
+    first_doc, doc_width, freq_width, pos_width = _BLOCK_HEADER.unpack_from(buffer,
+                                                                            header.data_offset + int(entry['offset']))
+    offset = header.data_offset + int(entry['offset']) + _BLOCK_HEADER.size
+    gaps, offset = _unpack(buffer, offset, count - 1, doc_width)
+    doc_ids = np.empty(count, dtype=np.int64)
+    doc_ids[0] = first_doc
+    np.cumsum(gaps + 1, out=doc_ids[1:])
+    doc_ids[1:] += first_doc
+    frequencies, offset = _unpack(buffer, offset, count, freq_width)
+    frequencies += 1
+    if not (with_positions and header.has_positions):
+        return doc_ids, frequencies, None
+    deltas, offset = _unpack(buffer, offset, int(frequencies.sum()), pos_width)
+    # undo the per doc delta encoding - a running sum reset at the start of each doc
+    positions = np.cumsum(deltas)
+    starts = np.concatenate(([0], np.cumsum(frequencies)[:-1]))
+    positions -= np.repeat(positions[starts] - deltas[starts], frequencies)
+    return doc_ids, frequencies, positions
+
+
+def decode(buffer, with_positions=True):
+    header = TermHeader(buffer)
+    blocks = [decode_block(buffer, header, b, with_positions=with_positions) for b in range(len(header.skips))]
+    if len(blocks) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return header, empty, empty, empty if with_positions and header.has_positions else None
+    doc_ids = np.concatenate([block[0] for block in blocks])
+    frequencies = np.concatenate([block[1] for block in blocks])
+    positions = None
+    if with_positions and header.has_positions:
+        positions = np.concatenate([block[2] for block in blocks])
+    return header, doc_ids, frequencies, positions
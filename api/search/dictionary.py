@@ -0,0 +1,226 @@
+import io
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# terms are front coded in blocks of this size - the first term of a block is stored in full
+BLOCK_SIZE = 16
+
+_FULL = struct.Struct('<H')
+_FRONT = struct.Struct('<HH')
+
+
+def _shared_prefix(left, right):
+    i = 0
+    n = min(len(left), len(right))
+    while i < n and left[i] == right[i]:
+        i += 1
+    return i
+
+
+# An immutable term dictionary for a flushed segment, replacing a hash of every term held in memory. Terms are held in
+# sorted order (by utf-8 bytes, the same as python str ordering) in front coded blocks, with a sorted array of values
+# per term - the (offset, length) of the term in each of the segment's files (postings, positions). The term's position
+# in the sorted order is its ordinal. The file is memory mapped and supports exact lookup (binary search over the first
+# term of each block followed by a scan of the block), prefix scans and access by ordinal. Layout:
+#
+#   <flag><count:I><columns:I><blocks:I><data file size:Q per column>
+#   block offsets (blocks + 1) * I, value offsets (count * columns) * Q, value lengths (count * columns) * I, terms
+class TermDictionary:
+    START_FLAG = b'# TERM-DICT v1\n'
+    HEADER = struct.Struct('<III')
+
+    def __init__(self, path):
+        self.path = path
+        with io.open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        offset = len(self.START_FLAG)
+        self._count, self._columns, num_blocks = self.HEADER.unpack_from(self._map, offset)
+        offset += self.HEADER.size
+        self.data_sizes = list(struct.unpack_from(f'<{self._columns}Q', self._map, offset))
+        offset += self._columns * 8
+        self._block_offsets = view[offset:offset + (num_blocks + 1) * 4].cast('I')
+        offset += (num_blocks + 1) * 4
+        self._value_offsets = view[offset:offset + self._count * self._columns * 8].cast('Q')
+        offset += self._count * self._columns * 8
+        self._value_lengths = view[offset:offset + self._count * self._columns * 4].cast('I')
+        self._terms_start = offset + self._count * self._columns * 4
+        self._num_blocks = num_blocks
+
+    @staticmethod
+    def path_for(segment_path):
+        return f"{segment_path}.tdi"
+
+    # checks the dictionary exists and was built for the current data files
+    @staticmethod
+    def is_valid(path, data_sizes):
+        if not os.path.exists(path):
+            return False
+        with io.open(path, 'rb') as file:
+            header = file.read(len(TermDictionary.START_FLAG) + TermDictionary.HEADER.size + len(data_sizes) * 8)
+        if not header.startswith(TermDictionary.START_FLAG):
+            return False
+        offset = len(TermDictionary.START_FLAG)
+        count, columns, num_blocks = TermDictionary.HEADER.unpack_from(header, offset)
+        if columns != len(data_sizes):
+            return False
+        return list(struct.unpack_from(f'<{columns}Q', header, offset + TermDictionary.HEADER.size)) == data_sizes
+
+    # columns is a list of dicts of term -> (offset, length), one per file. Only terms present in all are written
+    @staticmethod
+    def write(path, columns, data_sizes):
+        terms = set(columns[0].keys())
+        for column in columns[1:]:
+            terms &= column.keys()
+        terms = sorted(terms)
+        blob = bytearray()
+        block_offsets = []
+        previous = b''
+        for i, term in enumerate(terms):
+            term_bytes = term.encode('utf-8')
+            if i % BLOCK_SIZE == 0:
+                block_offsets.append(len(blob))
+                blob += _FULL.pack(len(term_bytes))
+                blob += term_bytes
+            else:
+                shared = _shared_prefix(previous, term_bytes)
+                blob += _FRONT.pack(shared, len(term_bytes) - shared)
+                blob += term_bytes[shared:]
+            previous = term_bytes
+        block_offsets.append(len(blob))
+        values = np.array([column[term] for term in terms for column in columns], dtype=np.int64).reshape(-1, 2)
+        # written to a temp file first so a partial dictionary is never loaded
+        with io.open(f"{path}.tmp", 'wb') as file:
+            file.write(TermDictionary.START_FLAG)
+            file.write(TermDictionary.HEADER.pack(len(terms), len(columns), len(block_offsets) - 1))
+            file.write(struct.pack(f'<{len(columns)}Q', *data_sizes))
+            file.write(np.array(block_offsets, dtype='<u4').tobytes())
+            file.write(values[:, 0].astype('<u8').tobytes())
+            file.write(values[:, 1].astype('<u4').tobytes())
+            file.write(bytes(blob))
+        os.replace(f"{path}.tmp", path)
+
+    def _first_term(self, block):
+        offset = self._terms_start + self._block_offsets[block]
+        (length,) = _FULL.unpack_from(self._map, offset)
+        return self._map[offset + _FULL.size:offset + _FULL.size + length]
+
+    # yields (ordinal, term bytes) starting from the first term of a block through to the end of the dictionary
+    def _iter_from_block(self, block):
+        ordinal = block * BLOCK_SIZE
+        while block < self._num_blocks:
+            offset = self._terms_start + self._block_offsets[block]
+            end = self._terms_start + self._block_offsets[block + 1]
+            (length,) = _FULL.unpack_from(self._map, offset)
+            offset += _FULL.size
+            term = self._map[offset:offset + length]
+            offset += length
+            yield ordinal, term
+            ordinal += 1
+            while offset < end:
+                shared, length = _FRONT.unpack_from(self._map, offset)
+                offset += _FRONT.size
+                term = term[:shared] + self._map[offset:offset + length]
+                offset += length
+                yield ordinal, term
+                ordinal += 1
+            block += 1
+
+    # the block which would contain the term i.e. the last block whose first term is <= term
+    def _find_block(self, term_bytes):
+        low = 0
+        high = self._num_blocks
+        while low < high:
+            mid = (low + high) // 2
+            if self._first_term(mid) <= term_bytes:
+                low = mid + 1
+            else:
+                high = mid
+        return max(low - 1, 0)
+
+    # the ordinal of the first term >= term_bytes
+    def _lower_bound(self, term_bytes):
+        if self._count == 0:
+            return 0, None
+        for ordinal, term in self._iter_from_block(self._find_block(term_bytes)):
+            if term >= term_bytes:
+                return ordinal, term
+        return self._count, None
+
+    def ordinal(self, term):
+        term_bytes = term.encode('utf-8')
+        ordinal, found = self._lower_bound(term_bytes)
+        if found == term_bytes:
+            return ordinal
+        return -1
+
+    def term(self, ordinal):
+        if ordinal < 0 or ordinal >= self._count:
+            raise IndexError(ordinal)
+        for i, term in self._iter_from_block(ordinal // BLOCK_SIZE):
+            if i == ordinal:
+                return term.decode('utf-8')
+
+    # all (term, ordinal) pairs starting with the prefix, in sorted order
+    def prefix(self, prefix):
+        prefix_bytes = prefix.encode('utf-8')
+        start, found = self._lower_bound(prefix_bytes)
+        if found is None:
+            return
+        for ordinal, term in self._iter_from_block(start // BLOCK_SIZE):
+            if ordinal < start:
+                continue
+            if not term.startswith(prefix_bytes):
+                return
+            yield term.decode('utf-8'), ordinal
+
+    def value(self, ordinal, column):
+        i = ordinal * self._columns + column
+        return self._value_offsets[i], self._value_lengths[i]
+
+    def column(self, column):
+        return DictionaryColumn(self, column)
+
+    def __iter__(self):
+        for ordinal, term in self._iter_from_block(0):
+            yield term.decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._block_offsets.release()
+        self._value_offsets.release()
+        self._value_lengths.release()
+        self._map.close()
+
+
+# the values of one file in the dictionary - this has the same interface as the OffsetIndex so can be passed to a
+# MappedStore as its index
+class DictionaryColumn:
+
+    def __init__(self, dictionary, column):
+        self._dictionary = dictionary
+        self._column = column
+
+    def __getitem__(self, term):
+        ordinal = self._dictionary.ordinal(term)
+        if ordinal == -1:
+            raise KeyError(term)
+        return self._dictionary.value(ordinal, self._column)
+
+    def __contains__(self, term):
+        return self._dictionary.ordinal(term) != -1
+
+    def keys(self):
+        return iter(self._dictionary)
+
+    def __len__(self):
+        return len(self._dictionary)
+
+    def close(self):
+        # owned by the segment which closes the dictionary
+        pass
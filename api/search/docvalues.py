@@ -0,0 +1,104 @@
+import io
+import os
+import struct
+
+import numpy as np
+
+
+# The doc values of a field in a flushed segment in a columnar layout, so facets can be counted over an array of
+# matched docs with numpy rather than parsing the values of each doc. Each distinct value (label) is assigned an
+# ordinal in sorted order. The values of each doc are held as ordinals in one array, in doc id order, with the offset of
+# each doc's values in another - docs can have any number of values. Written to <doc value store>c on flush, merge, or
+# load for segments written before it existed. Layout:
+#
+#   <flag><min doc id:Q><docs:I><labels:I><values:Q><docs with values:I>
+#   <doc offsets:uint32 x docs + 1><ordinals:uint32 x values><label offsets:uint32 x labels + 1><labels utf-8>
+class DocValueColumn:
+    START_FLAG = b'# DOC VALUES v1\n'
+    HEADER = struct.Struct('<QIIQI')
+
+    def __init__(self, min_doc_id, offsets, ordinals, labels, count):
+        self._min_doc_id = min_doc_id
+        self._offsets = offsets
+        self._ordinals = ordinals
+        # as a numpy array so the labels of many ordinals can be looked up at once
+        self.labels = labels
+        # number of docs with values - used to check the column against its store
+        self.count = count
+
+    @staticmethod
+    def path_for(store_path):
+        return f"{store_path}c"
+
+    # items are (doc id, values) for docs in [min_doc_id, max_doc_id] in doc id order
+    @staticmethod
+    def from_items(min_doc_id, max_doc_id, items):
+        num_docs = max(max_doc_id - min_doc_id + 1, 0)
+        lengths = np.zeros(num_docs, dtype=np.uint32)
+        values = []
+        count = 0
+        for doc_id, doc_values in items:
+            lengths[doc_id - min_doc_id] = len(doc_values)
+            values.extend(doc_values)
+            count += 1
+        labels, ordinals = np.unique(np.array(values, dtype=str), return_inverse=True)
+        offsets = np.zeros(num_docs + 1, dtype=np.uint32)
+        np.cumsum(lengths, out=offsets[1:])
+        return DocValueColumn(min_doc_id, offsets, ordinals.astype(np.uint32), labels, count)
+
+    @staticmethod
+    def read(path):
+        with io.open(path, 'rb') as file:
+            data = file.read()
+        if not data.startswith(DocValueColumn.START_FLAG):
+            raise ValueError(f"{path} is not a doc value column")
+        offset = len(DocValueColumn.START_FLAG)
+        min_doc_id, num_docs, num_labels, num_values, count = DocValueColumn.HEADER.unpack_from(data, offset)
+        offset += DocValueColumn.HEADER.size
+        expected = offset + 4 * (num_docs + 1 + num_values + num_labels + 1)
+        if len(data) < expected:
+            raise ValueError(f"{path} is truncated")
+        offsets = np.frombuffer(data, dtype='<u4', count=num_docs + 1, offset=offset)
+        offset += offsets.nbytes
+        ordinals = np.frombuffer(data, dtype='<u4', count=num_values, offset=offset)
+        offset += ordinals.nbytes
+        label_offsets = np.frombuffer(data, dtype='<u4', count=num_labels + 1, offset=offset).tolist()
+        offset += 4 * (num_labels + 1)
+        labels = np.array([data[offset + label_offsets[i]:offset + label_offsets[i + 1]].decode('utf-8') for i in
+                           range(num_labels)], dtype=str)
+        return DocValueColumn(min_doc_id, offsets, ordinals, labels, count)
+
+    def write(self, path):
+        encoded = [label.encode('utf-8') for label in self.labels.tolist()]
+        label_offsets = np.zeros(len(encoded) + 1, dtype='<u4')
+        np.cumsum([len(label) for label in encoded], out=label_offsets[1:])
+        # written to a temp file first so a partial column is never loaded
+        with io.open(f"{path}.tmp", 'wb') as file:
+            file.write(self.START_FLAG)
+            file.write(self.HEADER.pack(self._min_doc_id, len(self._offsets) - 1, len(self.labels), len(self._ordinals),
+                                        self.count))
+            file.write(self._offsets.astype('<u4').tobytes())
+            file.write(self._ordinals.astype('<u4').tobytes())
+            file.write(label_offsets.tobytes())
+            file.write(b''.join(encoded))
+        os.replace(f"{path}.tmp", path)
+
+    # the values of a doc, None if it has none
+    def values(self, doc_id):
+        i = doc_id - self._min_doc_id
+        if i < 0 or i >= len(self._offsets) - 1 or self._offsets[i] == self._offsets[i + 1]:
+            return None
+        return self.labels[self._ordinals[self._offsets[i]:self._offsets[i + 1]]].tolist()
+
+    # the ordinals of the values of the docs, in doc id order and the order of each doc's values
+    def ordinals(self, doc_ids):
+        i = np.asarray(doc_ids, dtype=np.int64) - self._min_doc_id
+        starts = self._offsets[i].astype(np.int64)
+        lengths = self._offsets[i + 1].astype(np.int64) - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.uint32)
+        # the index of each value - the start of its doc plus its position within the doc
+        ends = np.cumsum(lengths)
+        positions = np.arange(total) - np.repeat(ends - lengths, lengths) + np.repeat(starts, lengths)
+        return self._ordinals[positions]
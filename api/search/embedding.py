@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from search.cache import LRUCache
+
+# queries embedded in one forward pass at most
+DEFAULT_MAX_BATCH_SIZE = 32
+# how long the first query of a batch waits for others to join it
+DEFAULT_MAX_WAIT_MS = 5
+# memory for the vectors of recent queries - each is 1.5KB so around 10k queries
+QUERY_EMBEDDING_CACHE_BYTES = 16 * 1024 * 1024
+# size of an entry beyond its vector and text
+_ENTRY_OVERHEAD = 128
+
+
+class _Request:
+    __slots__ = ('text', 'done', 'vector', 'error')
+
+    def __init__(self, text):
+        self.text = text
+        self.done = threading.Event()
+        self.vector = None
+        self.error = None
+
+
+# Embeds the queries of concurrent requests in batches. A forward pass over a batch of short queries costs little more
+# than one over a single query, so rather than each request running its own, requests queue their query and wait. A
+# single thread takes the first queued query, waits up to max_wait_ms for up to max_batch_size - 1 others to join it and
+# embeds them with one call to the model, handing each request its vector. Under no load a query waits at most
+# max_wait_ms - under load batches fill and the wait is shorter.
+class EmbeddingBatcher:
+
+    def __init__(self, model, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self._model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._batches = 0
+        self._queries = 0
+        self._largest_batch = 0
+        self._embed_time = 0
+
+    # the embedding of the text, batched with those of other threads - blocks until it is computed
+    def embed(self, text):
+        if self.max_batch_size <= 1:
+            return self._model.embed(text, sentwise=False)
+        request = _Request(text)
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("Embedding batcher is stopped")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+            self._queue.append(request)
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.vector
+
+    def _next_batch(self):
+        with self._condition:
+            while len(self._queue) == 0 and not self._stopped:
+                self._condition.wait()
+            if self._stopped:
+                return None
+            deadline = time.monotonic() + self.max_wait_ms / 1000
+            while len(self._queue) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch_size))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start_time = time.time()
+            try:
+                vectors = self._model.embed_batch([request.text for request in batch])
+                for request, vector in zip(batch, vectors):
+                    request.vector = vector
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            self._embed_time += time.time() - start_time
+            self._batches += 1
+            self._queries += len(batch)
+            self._largest_batch = max(self._largest_batch, len(batch))
+            for request in batch:
+                request.done.set()
+
+    # fails any queued requests and stops the thread
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            pending = list(self._queue)
+            self._queue.clear()
+            self._condition.notify_all()
+        for request in pending:
+            request.error = RuntimeError("Embedding batcher is stopped")
+            request.done.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            "batches": self._batches,
+            "queries": self._queries,
+            "mean_batch_size": self._queries / self._batches if self._batches > 0 else 0,
+            "largest_batch": self._largest_batch,
+            "embed_time": self._embed_time,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms
+        }
+
+
+# the key of a query in the embedding cache - the model is uncased and splits on whitespace so neither affect a vector
+def normalize_query(text):
+    return ' '.join(text.lower().split())
+
+
+# Vectors of recent queries, keyed by their normalized text. The same queries are sent repeatedly e.g. as a user types,
+# and a forward pass dominates the latency of a natural language search. If given a path, the cache is saved there on
+# close and loaded on start so hot queries survive restarts.
+class EmbeddingCache:
+
+    def __init__(self, max_bytes=QUERY_EMBEDDING_CACHE_BYTES, path=None):
+        self._cache = LRUCache(max_bytes)
+        self._path = path
+
+    def get(self, text):
+        return self._cache.get(normalize_query(text))
+
+    def put(self, text, vector):
+        key = normalize_query(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self._cache.put(key, vector, vector.nbytes + len(key) + _ENTRY_OVERHEAD)
+        return vector
+
+    def load(self):
+        if self._path is None or not os.path.isfile(self._path):
+            return
+        print(f"Loading query embeddings from {self._path}...", end="")
+        try:
+            with np.load(self._path) as data:
+                # least recently used first so the order of the cache is kept
+                for key, vector in zip(data['queries'], data['vectors']):
+                    self._cache.put(str(key), vector, vector.nbytes + len(key) + _ENTRY_OVERHEAD)
+            print("OK")
+        except Exception as e:
+            # a lost cache only costs forward passes
+            print(f"failed - {e}")
+        # loading doesn't count as misses
+        self._cache.hits = self._cache.misses = 0
+
+    def save(self):
+        if self._path is None:
+            return
+        items = self._cache.items()
+        if len(items) == 0:
+            return
+        print(f"Saving {len(items)} query embeddings to {self._path}...", end="")
+        # processes sharing an index each write their own temp file - the last to close wins
+        temp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as embeddings_file:
+            np.savez(embeddings_file, queries=np.array([key for key, _ in items]),
+                     vectors=np.stack([vector for _, vector in items]))
+        os.replace(temp_path, self._path)
+        print("OK")
+
+    def stats(self):
+        return self._cache.stats()
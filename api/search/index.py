@@ -2,34 +2,130 @@ import itertools
 import os
 import pickle
 import sys
+import threading
 import time
 import traceback
 import uuid
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import hnswlib
+import numpy as np
 from bidict import bidict
 from search.analyzer import Analyzer
 from search.bert import BERTModule
+from search.bitmap import RoaringBitmap
+from search.cache import LRUCache
+from search.embedding import EmbeddingBatcher, EmbeddingCache, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT_MS, \
+    QUERY_EMBEDDING_CACHE_BYTES
 from search.exception import IndexException, SearchException, MergeException, TrieException, StoreException, \
     ExpansionsException
 from search.expander import TermExpander
+from search.iterators import DecodedBlocks, EncodedBlocks
+from search.kernels import EMPTY_DOC_IDS, DOC_ID_TYPE, intersect
 from search.lock import ReadWriteLock
+from search.merge import MergeScheduler, TieredMergePolicy, DEFAULT_MAX_MERGE_MB_PER_SEC
 from search.models import Result
 from search.posting import TermPosting
 from search.query import Query
-from search.segment import Segment, _create_segment_id
+from search.segment import Segment, _create_segment_id, DOC_VALUE_CACHE, DOC_VALUE_CACHE_BYTES
 from search.store import DocumentStore
 from search.suggestions import Suggester
 from math import log10
 
 VECTOR_DIMENSIONS = 384
+# the BERT model embedding queries - see search/bert.py
+VECTOR_MODEL = 4
 MAX_VECTOR_DOCUMENTS = 500000
 MAX_VECTOR_RESULTS = 10000
+# minimum size of the candidate list (ef) of an hnsw search - a reasonable compromise between performance and accuracy
+HNSW_EF = 50
+# candidates searched per neighbour retrieved - ef == k loses recall for small k
+HNSW_EF_FACTOR = 4
 CORES = os.cpu_count()
+# memory for the doc sets of filters across all segments
+FILTER_CACHE_BYTES = 64 * 1024 * 1024
+# memory for decoded postings and positions across all segments
+POSTING_CACHE_BYTES = 128 * 1024 * 1024
+# memory for the results of recent searches
+RESULT_CACHE_BYTES = 32 * 1024 * 1024
+# memory for the vectors of the docs of small filters - 7.5MB for the largest scored exactly
+FILTER_VECTOR_CACHE_BYTES = 64 * 1024 * 1024
+
+
+# rough size in bytes of the results of a search - the fields of each hit dominate
+def _result_size(results):
+    hits, facets = results[:2]
+    size = 256
+    for hit in hits:
+        size += 128 + len(str(hit.id))
+        if hit.fields:
+            size += sum(len(str(value)) for value in hit.fields.values())
+    for values in facets.values():
+        size += sum(64 + len(str(value)) for value in values)
+    return size
+
+
+# the terms (with their original tokens) and doc values of a document. Depends only on the analyzer so documents can be
+# analyzed in parallel and outside the write lock - see add_documents
+def _analyze_document(analyzer, doc_value_fields, document):
+    terms_and_tokens = analyzer.process_document(document, keepOriginal=True)
+    # this allows exact matching on doc value fields TODO: really we should have a different index for this
+    doc_value_terms = []
+    doc_values = {}
+    for field in doc_value_fields:
+        if field in document.fields:
+            # TODO: we assume all doc values are a list
+            doc_values[field] = document.fields[field]
+            doc_value_terms += [(f"{field}:{'_'.join(analyzer.tokenize(value))}", None) for value in
+                                document.fields[field]]
+    return doc_value_terms + terms_and_tokens, doc_values
+
+
+# the analyzer of an analysis process - set once when the process starts rather than sent with each batch
+_worker_analyzer = None
+_worker_doc_value_fields = None
+
+
+def _init_analysis_worker(analyzer, doc_value_fields):
+    global _worker_analyzer, _worker_doc_value_fields
+    _worker_analyzer = analyzer
+    _worker_doc_value_fields = doc_value_fields
+
+
+def _analyze_in_worker(documents):
+    return [_analyze_document(_worker_analyzer, _worker_doc_value_fields, document) for document in documents]
+
+
+# the pickled state of a segment in the state file, without opening the segment - see Index.refresh
+class _SegmentState:
+
+    def __setstate__(self, state):
+        self.state = state
+
+    @property
+    def segment_id(self):
+        return self.state[0]
+
+    def is_flushed(self):
+        return self.state[3]
+
+
+class _StateUnpickler(pickle.Unpickler):
+
+    def find_class(self, module, name):
+        if module == 'search.segment' and name == 'Segment':
+            return _SegmentState
+        return super().find_class(module, name)
 
 
 class Index:
 
-    def __init__(self, storage_path, analyzer=Analyzer(), doc_value_fields=[], index_id=uuid.uuid4()):
+    def __init__(self, storage_path, analyzer=Analyzer(), doc_value_fields=[], index_id=uuid.uuid4(),
+                 doc_value_cache_bytes=DOC_VALUE_CACHE_BYTES, auto_merge=False, merge_policy=TieredMergePolicy(),
+                 max_merge_mb_per_sec=DEFAULT_MAX_MERGE_MB_PER_SEC, search_threads=CORES, read_only=False,
+                 on_segments_changed=None, analysis_processes=None, embedding_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                 embedding_wait_ms=DEFAULT_MAX_WAIT_MS, embedding_cache_bytes=QUERY_EMBEDDING_CACHE_BYTES,
+                 persist_embeddings=False, vector_backend='fp32'):
         # location of index files
         self._storage_path = storage_path
         self.analyzer = analyzer
@@ -47,21 +143,68 @@ class Index:
         # ids are unique - we may want to move this to uniqueness to an external check in the future. For this reason,
         # the dict is bi-directional. internal->external, whilst inverse is external to internal.
         self._id_mappings = bidict()
+        # a read only index serves queries over the files of an index written by another process - see refresh
+        self._read_only = read_only
+        # called once segments have been flushed or merged and the state file written e.g. to notify readers
+        self._on_segments_changed = on_segments_changed
+        # documents added in bulk are analyzed by a pool of processes, if more than one - tokenizing and stemming hold
+        # the GIL. The pool is forked first, before the doc store is opened, the vector model loaded or any threads
+        # started, so the workers hold none of them
+        self._analysis_processes = analysis_processes
+        self._analysis_pool = None
+        if analysis_processes is not None and analysis_processes > 1 and not read_only:
+            self._analysis_pool = ProcessPoolExecutor(max_workers=analysis_processes,
+                                                      mp_context=multiprocessing.get_context('fork'),
+                                                      initializer=_init_analysis_worker,
+                                                      initargs=(self.analyzer, doc_value_fields))
+            self._analysis_pool.submit(int).result()
         # document store so we can return the original docs - flag c open if it exists
-        self._doc_store = DocumentStore.open(os.path.join(self._storage_path, 'docs.db'), 'c')
+        self._doc_store = DocumentStore.open(os.path.join(self._storage_path, 'docs.db'), 'r' if read_only else 'c')
         # used to ensure single threaded indexing
         self._write_lock = ReadWriteLock()
         # bert model for vectors
-        self._vector_model = BERTModule(vmodel=4)
+        self._vector_model = BERTModule(vmodel=VECTOR_MODEL, backend=vector_backend)
+        # embeds the queries of concurrent searches together - see search/embedding.py
+        self._embedder = EmbeddingBatcher(self._vector_model, max_batch_size=embedding_batch_size,
+                                          max_wait_ms=embedding_wait_ms)
+        # vectors of recent queries, optionally saved across restarts. Vectors differ between models and backends so
+        # each saves its own file - switching backend never serves the vectors of the other
+        embeddings_path = os.path.join(self._storage_path, f'embeddings-model{VECTOR_MODEL}-{vector_backend}.npz') \
+            if persist_embeddings else None
+        self._embedding_cache = EmbeddingCache(embedding_cache_bytes, embeddings_path)
         # facet fields
         self._doc_value_fields = doc_value_fields
+        # the doc value cache is shared by the segments of all indices in the process - the budget is global
+        DOC_VALUE_CACHE.resize(doc_value_cache_bytes)
         # merge lock - only one merge at once
         self._merge_lock = ReadWriteLock()
         # merge update - this is used when we update the list of segments post merge - reads can't occur during this
         self._segment_update_lock = ReadWriteLock()
         # hsnw
         self._hnsw_model = hnswlib.Index(space='cosine', dim=VECTOR_DIMENSIONS)
+        self._hnsw_lock = threading.Lock()
+        # (hnsw index, element count, sorted ids) - see vector_doc_ids
+        self._vector_ids = None
         self._docs_added = False
+        # doc sets of field:value filters for each (segment id, term) - see get_filter
+        self._filter_cache = LRUCache(FILTER_CACHE_BYTES)
+        # decoded blocks of hot terms for each (segment id, term, with positions) - see get_term_blocks. Hits and misses
+        # are counted per segment id to size the cache
+        self._posting_cache = LRUCache(POSTING_CACHE_BYTES)
+        self._posting_cache_stats = {}
+        # results of recent searches - keyed by the generation of the index, which advances on any change to the docs or
+        # segments, so results cached before a change are never returned (see search)
+        self._result_cache = LRUCache(RESULT_CACHE_BYTES)
+        self._generation = 0
+        # (doc ids, vectors) of the docs matching filters, for each set of filter terms - see exact_closest_vectors
+        self._filter_vector_cache = LRUCache(FILTER_VECTOR_CACHE_BYTES)
+        # merges segments in the background after flushes if enabled - otherwise segments are merged by optimize
+        self._merge_scheduler = MergeScheduler(self, merge_policy, max_merge_mb_per_sec) if auto_merge else None
+        # segments are searched in parallel by a query - decoding and the numpy kernels release the GIL
+        self._search_pool = ThreadPoolExecutor(max_workers=search_threads, thread_name_prefix="search") \
+            if search_threads is not None and search_threads > 1 else None
+        # modification time of the hnsw file last loaded by refresh
+        self._hnsw_mtime = None
 
     def _get_db_path(self):
         return os.path.join(self._storage_path, 'index.idb')
@@ -69,26 +212,54 @@ class Index:
     def _get_hnsw_path(self):
         return os.path.join(self._storage_path, 'index.hnsw')
 
-    # not thread safe and pickles the index - mostly meta and doc ids
+    # not thread safe and pickles the index - mostly meta and doc ids. Written to a temp file first so readers never
+    # load a partial state file
     def _store_index_meta(self):
-        with open(self._get_db_path(), 'wb') as index_file:
+        with open(f"{self._get_db_path()}.tmp", 'wb') as index_file:
             print(f"Saving state file to {self._get_db_path()}...", end="")
             state = self.__dict__.copy()
             # we don't store the doc store
             del state['_doc_store']
             del state['_vector_model']
+            del state['_embedder']
+            del state['_embedding_cache']
             del state['_write_lock']
             del state['_merge_lock']
             del state['_segment_update_lock']
             del state['_suggester']
             del state['_expander']
             del state['_hnsw_model']
+            del state['_hnsw_lock']
+            del state['_vector_ids']
+            del state['_filter_cache']
+            del state['_result_cache']
+            del state['_filter_vector_cache']
+            del state['_posting_cache']
+            del state['_posting_cache_stats']
+            del state['_merge_scheduler']
+            del state['_search_pool']
+            del state['_read_only']
+            del state['_on_segments_changed']
+            del state['_hnsw_mtime']
+            del state['_analysis_pool']
+            del state['_analysis_processes']
             # del state['_vector_model']
             pickle.dump(state, index_file)
             print("OK")
+        os.replace(f"{self._get_db_path()}.tmp", self._get_db_path())
+
+    def _segments_changed(self):
+        if self._on_segments_changed is not None:
+            # the changes are on disk - failing to notify must not fail the flush or merge
+            try:
+                self._on_segments_changed()
+            except Exception:
+                traceback.print_exc()
 
     # saves the index to disk - for now just pickle down given the sizes
     def save(self):
+        if self._read_only:
+            return
         try:
             # we need to lock as we shouldn't index during flushing or vise versa
             self._write_lock.acquire_write()
@@ -102,19 +273,27 @@ class Index:
                     print(f"Flushing last segment...", end="")
                     most_recent.flush()
                     print("OK")
+                    self._generation += 1
+                    self._notify_merge_scheduler()
             self._store_index_meta()
             if self._docs_added:
                 print("Saving hnsw index to disk...", end="")
-                with open(self._get_hnsw_path(), 'wb') as hnsw_file:
+                with open(f"{self._get_hnsw_path()}.tmp", 'wb') as hnsw_file:
                     pickle.dump(self._hnsw_model, hnsw_file)
+                os.replace(f"{self._get_hnsw_path()}.tmp", self._get_hnsw_path())
                 print("OK")
             self._docs_added = False
+            self._segments_changed()
             self._write_lock.release_write()
         except Exception as e:
             self._write_lock.release_write()
             raise StoreException(f"Unexpected exception during flushing - {e}")
 
     def load(self):
+        self._embedding_cache.load()
+        if self._read_only:
+            self.refresh()
+            return
         self._write_lock.acquire_write()
         if os.path.isfile(self._get_db_path()):
             with open(self._get_db_path(), 'rb') as index_file:
@@ -132,10 +311,76 @@ class Index:
             # we assume we haven't initialized if 0 max elements
             self._hnsw_model.init_index(max_elements=MAX_VECTOR_DOCUMENTS, ef_construction=200, M=16)
         self._write_lock.release_write()
+        if self._merge_scheduler is not None:
+            self._merge_scheduler.start()
+
+    # loads the changes of the writer of the index since the last refresh - used by read only indices, which the
+    # writer notifies after flushes and merges (see serve.py). Only flushed segments are read - the open segment of the
+    # writer is in its memory. Segments already open are kept, new ones opened and those merged away closed, but never
+    # deleted - the writer owns the files
+    def refresh(self):
+        if not os.path.isfile(self._get_db_path()):
+            if self._hnsw_model.max_elements == 0:
+                self._hnsw_model.init_index(max_elements=MAX_VECTOR_DOCUMENTS, ef_construction=200, M=16)
+            return
+        with open(self._get_db_path(), 'rb') as index_file:
+            print("Refreshing inverted index...", end="")
+            state = _StateUnpickler(index_file).load()
+            print("OK")
+        current = {segment.segment_id: segment for segment in self._segments}
+        segments = []
+        try:
+            for segment_state in state['_segments']:
+                if not segment_state.is_flushed():
+                    continue
+                segment = current.get(segment_state.segment_id)
+                if segment is None:
+                    segment = Segment.__new__(Segment)
+                    segment.__setstate__(segment_state.state)
+                segments.append(segment)
+        except Exception as e:
+            # the segments may have been merged away since the state file was read - the writer notifies us again
+            for segment in segments:
+                if segment.segment_id not in current:
+                    segment.close()
+            raise StoreException(f"Unexpected exception during refresh - {e}")
+        segment_ids = set(segment.segment_id for segment in segments)
+        removed = [segment for segment in self._segments if segment.segment_id not in segment_ids]
+        if os.path.isfile(self._get_hnsw_path()) and os.path.getmtime(self._get_hnsw_path()) != self._hnsw_mtime:
+            self._hnsw_mtime = os.path.getmtime(self._get_hnsw_path())
+            with open(self._get_hnsw_path(), 'rb') as hnsw_file:
+                print("Loading hnsw index...", end="")
+                self._hnsw_model = pickle.load(hnsw_file)
+                print("OK")
+        if self._hnsw_model.max_elements == 0:
+            self._hnsw_model.init_index(max_elements=MAX_VECTOR_DOCUMENTS, ef_construction=200, M=16)
+        self._segment_update_lock.acquire_write()
+        self._segments = segments
+        self._id_mappings = state['_id_mappings']
+        self._current_doc_id = state['_current_doc_id']
+        self._generation += 1
+        self._segment_update_lock.release_write()
+        removed_ids = set(segment.segment_id for segment in removed)
+        self._filter_cache.invalidate(lambda key: key[0] in removed_ids)
+        self._posting_cache.invalidate(lambda key: key[0] in removed_ids)
+        for segment in removed:
+            self._posting_cache_stats.pop(segment.segment_id, None)
+            segment.close()
+        print(f"Refreshed {len(segments)} segments - {len(segment_ids - set(current))} new, {len(removed)} removed")
 
     # closes the index
     def close(self):
+        if self._merge_scheduler is not None:
+            print(f"Stopping merges...", end="")
+            self._merge_scheduler.stop()
+            print("OK")
         self.save()
+        self._embedder.stop()
+        self._embedding_cache.save()
+        if self._search_pool is not None:
+            self._search_pool.shutdown()
+        if self._analysis_pool is not None:
+            self._analysis_pool.shutdown()
         print(f"Closing all segments...", end="")
         for segment in self._segments:
             segment.close()
@@ -156,6 +401,15 @@ class Index:
     def number_of_docs(self):
         return self.current_id - 1
 
+    @property
+    def number_of_vectors(self):
+        return self._hnsw_model.element_count
+
+    def _notify_merge_scheduler(self):
+        if self._merge_scheduler is not None:
+            self._merge_scheduler.start()
+            self._merge_scheduler.notify()
+
     # IMPORTANT: This assumes single threaded indexing
     def __get_writeable_segment(self):
         if len(self._segments) == 0:
@@ -172,33 +426,41 @@ class Index:
         if not most_recent.has_buffer_capacity():
             # segment is open but has no capacity so flush
             most_recent.flush()
+            self._notify_merge_scheduler()
+            # so readers can search the flushed segment
+            self._store_index_meta()
+            self._segments_changed()
             # insert new
             self._segment_update_lock.acquire_write()
             self._segments.append(Segment(_create_segment_id(), self._storage_path, self._doc_value_fields))
             self._segment_update_lock.release_write()
         return self._segments[-1]
 
-    # NOT THREAD SAFE!
-    def _process_document(self, document):
+    # NOT THREAD SAFE! Documents analyzed in advance pass their terms and doc values (see _analyze_document)
+    def _process_document(self, document, analyzed=None):
         self._id_mappings[self._current_doc_id] = document.id
-        terms_and_tokens = self.analyzer.process_document(document, keepOriginal=True)
-        # this allows exact matching on doc value fields TODO: really we should have a different index for this
-        doc_value_terms = []
-        doc_values = {}
-        for field in self._doc_value_fields:
-            if field in document.fields:
-                # TODO: we assume all doc values are a list
-                doc_values[field] = document.fields[field]
-                doc_value_terms += [(f"{field}:{'_'.join(self.analyzer.tokenize(value))}", None) for value in
-                                    document.fields[field]]
-        terms_and_tokens = doc_value_terms + terms_and_tokens
+        if analyzed is None:
+            analyzed = _analyze_document(self.analyzer, self._doc_value_fields, document)
+        terms_and_tokens, doc_values = analyzed
         # Flush trie if flushing segment
         segment = self.__get_writeable_segment()
         segment.add_document(self._current_doc_id, terms_and_tokens, doc_values=doc_values)
 
+    # the analysis of each document, in order - split across the analysis processes if there are any
+    def _analyze_documents(self, documents):
+        if self._analysis_pool is None or len(documents) < 2:
+            return [_analyze_document(self.analyzer, self._doc_value_fields, document) for document in documents]
+        # a few chunks per process balances the load without pickling each document separately
+        num_chunks = self._analysis_processes * 4
+        chunk_size = max((len(documents) + num_chunks - 1) // num_chunks, 1)
+        chunks = [documents[i:i + chunk_size] for i in range(0, len(documents), chunk_size)]
+        return list(itertools.chain.from_iterable(self._analysis_pool.map(_analyze_in_worker, chunks)))
+
     # this is an append only operation. We generated a new internal id for the document and store a mapping between the
     # the two. The passed id here must be unique - no updates supported, but can be anything.
     def add_document(self, document):
+        if self._read_only:
+            raise IndexException(f'Index {self._index_id} is read only')
         # enforce single threaded indexing
         self._write_lock.acquire_write()
         if document.id in self._id_mappings.inverse:
@@ -216,6 +478,7 @@ class Index:
                 self._hnsw_model.add_items([document.vector], [self._current_doc_id])
             doc_id = self._current_doc_id
             self._current_doc_id += 1
+            self._generation += 1
             self._write_lock.release_write()
         except Exception as e:
             traceback.print_exc()
@@ -223,11 +486,25 @@ class Index:
             raise IndexException(f"Unexpected exception during indexing - {e}")
         return document.id, doc_id
 
-    # this is more efficient than single document addition
+    # this is more efficient than single document addition. Documents are analyzed before taking the write lock, in
+    # parallel if there's an analysis pool, so the lock is only held to append them to the segment and store them
     def add_documents(self, documents):
-        # enforce single threaded indexing
+        if self._read_only:
+            raise IndexException(f'Index {self._index_id} is read only')
         failures = []
         doc_ids = []
+        # ids already indexed are rejected again under the lock - this just avoids analyzing them
+        candidates = [document for document in documents if document.id not in self._id_mappings.inverse]
+        try:
+            n = len(candidates)
+            if n > 0:
+                print(f"Analyzing {n} documents...", end="")
+            analyzed = dict(zip((id(document) for document in candidates), self._analyze_documents(candidates)))
+            if n > 0:
+                print("OK")
+        except Exception as e:
+            raise IndexException(f"Unexpected exception during indexing - {e}")
+        # enforce single threaded indexing
         self._write_lock.acquire_write()
         try:
             # check all the ids
@@ -237,7 +514,6 @@ class Index:
                     failures.append(f'{document.id} already exists in index {self._index_id}')
                 else:
                     docs_to_index.append(document)
-            # this could be more efficient - i.e. we could optimise bulk additions - less locking and large write chunks
             if len(docs_to_index) > 0:
                 self._docs_added = True
                 doc_batch = {}
@@ -252,7 +528,7 @@ class Index:
                             continue
                         vector_batch.append(document.vector)
                         v_doc_ids.append(self._current_doc_id)
-                    self._process_document(document)
+                    self._process_document(document, analyzed.get(id(document)))
                     doc_ids.append((document.id, self._current_doc_id))
                     doc_batch[str(self._current_doc_id)] = document.fields
                     self._current_doc_id += 1
@@ -262,6 +538,7 @@ class Index:
                 # persists the vectors
                 if len(vector_batch) > 0:
                     self._hnsw_model.add_items(vector_batch, v_doc_ids)
+                self._generation += 1
             self._write_lock.release_write()
         except Exception as e:
             self._write_lock.release_write()
@@ -274,13 +551,75 @@ class Index:
             return doc
         return {field: doc[field] for field in fields if field in doc}
 
-    def find_closest_vectors(self, query):
-        query_vector = self._vector_model.embed(query, sentwise=False)
-        self._hnsw_model.set_ef(50)
-        # we need all for facets
-        max_vectors = self._hnsw_model.element_count - 1 if self._hnsw_model.element_count < MAX_VECTOR_RESULTS \
-            else MAX_VECTOR_RESULTS
-        return self._hnsw_model.knn_query(query_vector, k=max_vectors, num_threads=CORES)
+    # the vector of a natural language query - recent queries are cached, others batched with concurrent searches
+    def embed_query(self, query):
+        query_vector = self._embedding_cache.get(query)
+        if query_vector is None:
+            query_vector = self._embedding_cache.put(query, self._embedder.embed(query))
+        return query_vector
+
+    # the most neighbours a vector search can retrieve
+    def max_vector_results(self):
+        return max(min(self._hnsw_model.element_count - 1, MAX_VECTOR_RESULTS), 0)
+
+    # the ids and distances of the k nearest docs to the vector, nearest first. The ef of the search grows with k so
+    # small searches keep their recall, but never beyond the ef of retrieving MAX_VECTOR_RESULTS. Given allowed doc ids
+    # (sorted, each with a vector - see vector_doc_ids) only those are returned - the graph is still traversed through
+    # other docs, so the neighbours are found as without a filter. Fewer than k are returned if the search can't reach k
+    def find_closest_vectors(self, query_vector, k, allowed=None):
+        if k == 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.float32)
+        ef = max(HNSW_EF, min(k * HNSW_EF_FACTOR, max(k, MAX_VECTOR_RESULTS)))
+        predicate = None
+        if allowed is not None:
+            # a byte per doc id - the predicate is called for every candidate so must be cheap
+            mask = np.zeros(int(allowed[-1]) + 1 if len(allowed) > 0 else 0, dtype=np.uint8)
+            mask[allowed] = 1
+            mask = mask.tobytes()
+            predicate = lambda label: label < len(mask) and mask[label] == 1
+        # ef is a setting of the hnsw index rather than of a search
+        with self._hnsw_lock:
+            hnsw_model = self._hnsw_model
+            hnsw_model.set_ef(ef)
+            while True:
+                try:
+                    ids, distances = hnsw_model.knn_query(query_vector, k=k, num_threads=CORES, filter=predicate)
+                    return ids[0], distances[0]
+                except RuntimeError:
+                    # a few docs may be unreachable in the graph, and k close to the number allowed by a filter can
+                    # exceed those reached - hnswlib fails rather than return fewer, so ask for fewer
+                    if k <= 1:
+                        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.float32)
+                    k = k * 9 // 10
+
+    # the exact distances of the vector to those of the docs (sorted, each with a vector) matching the filter terms,
+    # nearest first - cheaper than a search of the graph when there are few docs. Reading vectors from the hnsw index is
+    # slower than scoring them so those of recent filters are cached, until the docs matching them change
+    def exact_closest_vectors(self, query_vector, doc_ids, filters):
+        if len(doc_ids) == 0:
+            return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.float32)
+        key = tuple(sorted(filters))
+        cached = self._filter_vector_cache.get(key)
+        if cached is not None and np.array_equal(cached[0], doc_ids):
+            vectors = cached[1]
+        else:
+            # vectors are stored normalized for cosine distance
+            vectors = np.asarray(self._hnsw_model.get_items(doc_ids), dtype=np.float32)
+            self._filter_vector_cache.put(key, (doc_ids, vectors), doc_ids.nbytes + vectors.nbytes)
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        distances = 1 - vectors @ (query_vector / max(np.linalg.norm(query_vector), 1e-12))
+        order = np.argsort(distances, kind='stable')
+        return doc_ids[order], distances[order]
+
+    # the docs (sorted) which have a vector. The ids in the hnsw index are cached until vectors are added
+    def vector_doc_ids(self, doc_ids):
+        hnsw_model = self._hnsw_model
+        cached = self._vector_ids
+        if cached is None or cached[0] is not hnsw_model or cached[1] != hnsw_model.element_count:
+            count = hnsw_model.element_count
+            ids = np.sort(np.asarray(hnsw_model.get_ids_list(), dtype=DOC_ID_TYPE))
+            self._vector_ids = cached = (hnsw_model, count, ids)
+        return doc_ids[intersect(doc_ids, cached[2])[0]]
 
     def update_expansions(self):
         # so we consider the latest segment in suggestions as we don't read the buffer
@@ -332,26 +671,50 @@ class Index:
         except Exception as e:
             raise SearchException(f"Unexpected exception during querying - {e}")
 
+    def cache_stats(self):
+        postings = self._posting_cache.stats()
+        postings["segments"] = {
+            segment_id: {"hits": hits, "misses": misses, "hit_ratio": hits / (hits + misses) if hits + misses > 0 else 0}
+            for segment_id, (hits, misses) in list(self._posting_cache_stats.items())}
+        return {"results": self._result_cache.stats(), "filters": self._filter_cache.stats(), "postings": postings,
+                "doc_values": DOC_VALUE_CACHE.stats(), "embeddings": self._embedder.stats(),
+                "query_embeddings": self._embedding_cache.stats(), "filter_vectors": self._filter_vector_cache.stats()}
+
+    # the key of a search in the result cache - anything which changes the results, including the index generation
+    def _result_key(self, query):
+        return (self._generation, ' '.join(query.query.split()),
+                tuple(sorted((filter.field, filter.value) for filter in query.filters)),
+                tuple((facet.field, facet.num_values) for facet in query.facets), query.score, query.max_results,
+                query.offset, query.use_hnsw, query.max_distance, tuple(sorted(set(query.fields))))
+
     def search(self, query):
-        # filters are currently appended as an AND phrase - this isn't ideal but these doc value fields are also indexed
+        key = self._result_key(query)
+        results = self._result_cache.get(key)
+        if results is not None:
+            return results
+        results = self._search(query)
+        self._result_cache.put(key, results, _result_size(results))
+        return results
+
+    def _search(self, query):
         try:
-            docs, facets, total = Query(self).execute(query.query, query.filters, query.score, query.max_results,
-                                                      query.offset,
-                                                      query.facets, use_hnsw=query.use_hnsw,
-                                                      max_distance=query.max_distance)
+            executor = Query(self)
+            docs, facets, total = executor.execute(query.query, query.filters, query.score, query.max_results,
+                                                   query.offset,
+                                                   query.facets, use_hnsw=query.use_hnsw,
+                                                   max_distance=query.max_distance)
 
             fields = set(query.fields)
             return [Result(self._id_mappings[doc.doc_id], doc.score, fields=self._get_document(str(doc.doc_id), fields))
                     for
                     doc in
-                    docs], facets, total
+                    docs], facets, total, executor.total_is_lower_bound
         except Exception as e:
             raise SearchException(f"Unexpected exception during querying - {e}")
 
     def get_term(self, term, with_positions=True, with_skips=True):
-        # get all the matching docs in all the segments - currently we assume the term is in every segment
-        # this should be improved e.g. using a bloom filter or some bit set, inside the segment though -i.e.
-        # it should return [] quickly
+        # get all the matching docs in all the segments - segments without the term reject it quickly via their
+        # bloom filter
         combined_posting = TermPosting()
         self._segment_update_lock.acquire_read()
         if term:
@@ -362,6 +725,55 @@ class Index:
         self._segment_update_lock.release_read()
         return combined_posting
 
+    # queries iterate segments lazily so hold the segment update lock for their duration, preventing a merge from
+    # deleting a segment mid query. Must be paired with release_segments
+    def acquire_segments(self):
+        self._segment_update_lock.acquire_read()
+        return self._segments
+
+    # applies the function to each segment, in parallel on the search pool, returning the results in segment order
+    def map_segments(self, function, segments):
+        if self._search_pool is None or len(segments) < 2:
+            return [function(segment) for segment in segments]
+        return list(self._search_pool.map(function, segments))
+
+    def release_segments(self):
+        self._segment_update_lock.release_read()
+
+    # the blocks of a term in a segment for query evaluation. Hot terms appear in most queries so the blocks of flushed
+    # segments are decoded once and cached - the buffer of an open segment changes as docs are added so is read each
+    # time. Callers must hold the segments (acquire_segments)
+    def get_term_blocks(self, segment, term, with_positions=True):
+        if not segment.is_flushed():
+            return segment.get_term_blocks(term, with_positions=with_positions)
+        key = (segment.segment_id, term, with_positions)
+        stats = self._posting_cache_stats.setdefault(segment.segment_id, [0, 0])
+        blocks = self._posting_cache.get(key)
+        if blocks is not None:
+            stats[0] += 1
+            return blocks
+        stats[1] += 1
+        blocks = segment.get_term_blocks(term, with_positions=with_positions)
+        if isinstance(blocks, EncodedBlocks):
+            blocks = DecodedBlocks(blocks)
+            self._posting_cache.put(key, blocks, blocks.nbytes)
+        return blocks
+
+    # the docs of a segment with a filter term e.g. subject:Machine_Learning, as a sorted array. Popular filters are
+    # re-used across requests so their doc sets are cached per flushed segment as compressed bitmaps - the doc set of an
+    # open segment changes as docs are added so is read each time. Callers must hold the segments (acquire_segments)
+    def get_filter(self, segment, term):
+        if not segment.is_flushed():
+            blocks = segment.get_term_blocks(term, with_positions=False)
+            return blocks.postings()[0] if blocks is not None else EMPTY_DOC_IDS
+        key = (segment.segment_id, term)
+        bitmap = self._filter_cache.get(key)
+        if bitmap is None:
+            blocks = segment.get_term_blocks(term, with_positions=False)
+            bitmap = RoaringBitmap.from_doc_ids(blocks.postings()[0] if blocks is not None else [])
+            self._filter_cache.put(key, bitmap, bitmap.nbytes)
+        return bitmap.doc_ids()
+
     def has_doc_id(self, field):
         return field in self._doc_value_fields
 
@@ -394,60 +806,137 @@ class Index:
         return dict(itertools.islice(sorted_terms.items(), count))
 
     # merges two segments (together and flushed) to produce a larger segment - with the aim of speeding up searches
-    def optimize(self):
+    # merges the two smallest adjacent flushed segments or, given a target number of segments, merges the flushed
+    # segments into as many adjacent groups of similar size as needed to reach it - each group is merged in one pass
+    def optimize(self, target_segments=None):
+        if self._read_only:
+            raise MergeException(f'Index {self._index_id} is read only')
         self._merge_lock.acquire_write()
-        num_segments = len(self._segments)
-        if num_segments < 2:
-            # we need at least 2
-            print(f"Insufficient segments to merge - only {num_segments}")
+        try:
+            num_segments = len(self._segments)
+            if num_segments < 2:
+                # we need at least 2
+                print(f"Insufficient segments to merge - only {num_segments}")
+                return num_segments, num_segments
+            if target_segments is not None:
+                self._optimize_to(target_segments)
+                return num_segments, len(self._segments)
+            # find candidate segments
+            # must be flushed
+            smallest_combined_size = sys.maxsize
+            smallest_pos = -1
+            s = 0
+            while s < num_segments - 1:
+                if self._segments[s].is_flushed() and self._segments[s + 1].is_flushed():
+                    # number of documents is a crude metric of size but avg should be same across index
+                    combined_size = self._segments[s].number_of_documents + self._segments[s + 1].number_of_documents
+                    if combined_size < smallest_combined_size:
+                        smallest_combined_size = combined_size
+                        smallest_pos = s
+                s += 1
+            if smallest_pos == -1:
+                print(f"No candidate segments to merge - need at least two flushed segments", flush=True)
+                return num_segments, num_segments
+            # select the two smallest ADJACENT segments - this ensures doc ids are kept in order on disk
+            self._merge_segments(smallest_pos, 2)
+            return num_segments, len(self._segments)
+        finally:
             self._merge_lock.release_write()
-            return num_segments, num_segments
-        # find candidate segments
-        # must be flushed
-        smallest_combined_size = sys.maxsize
-        smallest_pos = -1
-        s = 0
-        while s < num_segments - 1:
-            if self._segments[s].is_flushed() and self._segments[s + 1].is_flushed():
-                # number of documents is a crude metric of size but avg should be same across index
-                combined_size = self._segments[s].number_of_documents + self._segments[s + 1].number_of_documents
-                if combined_size < smallest_combined_size:
-                    smallest_combined_size = combined_size
-                    smallest_pos = s
-            s += 1
-        if smallest_pos == -1:
-            print(f"No candidate segments to merge - need at least two flushed segments", flush=True)
+
+    # the merge lock must be held
+    def _optimize_to(self, target_segments):
+        if target_segments < 1:
+            raise MergeException(f"Target segments must be at least 1 - {target_segments} given")
+        self._segment_update_lock.acquire_read()
+        # only the last segment can be open - the flushed ones before it are merged
+        num_flushed = 0
+        while num_flushed < len(self._segments) and self._segments[num_flushed].is_flushed():
+            num_flushed += 1
+        sizes = [segment.number_of_documents for segment in self._segments[:num_flushed]]
+        num_groups = max(target_segments - (len(self._segments) - num_flushed), 1)
+        self._segment_update_lock.release_read()
+        if num_flushed <= num_groups:
+            print(f"No segments to merge - {num_flushed} flushed segments for a target of {target_segments}", flush=True)
+            return
+        # split the segments into groups of adjacent segments with a similar number of docs, each group closing once
+        # it reaches its share of the docs whilst leaving a segment for each remaining group
+        total = sum(sizes)
+        groups = []
+        start = 0
+        cumulative = 0
+        for i, size in enumerate(sizes):
+            cumulative += size
+            remaining_groups = num_groups - len(groups) - 1
+            if remaining_groups == 0:
+                break
+            if cumulative * num_groups >= total * (len(groups) + 1) or num_flushed - i - 1 == remaining_groups:
+                groups.append((start, i + 1 - start))
+                start = i + 1
+        groups.append((start, num_flushed - start))
+        print(f"Optimizing {num_flushed} segments to {num_groups}", flush=True)
+        # right to left so the positions of the groups still to merge don't change
+        for start, count in reversed(groups):
+            if count > 1:
+                self._merge_segments(start, count)
+
+    # runs the next merge selected by the policy, returning whether there was one - used by the merge scheduler
+    def _merge_next(self, policy, rate_limiter=None, on_start=None):
+        self._merge_lock.acquire_write()
+        try:
+            self._segment_update_lock.acquire_read()
+            merge = policy.find_merge(self._segments)
+            self._segment_update_lock.release_read()
+            if merge is None:
+                return False
+            start, count = merge
+            if on_start is not None:
+                segments = self._segments[start:start + count]
+                on_start([segment.segment_id for segment in segments],
+                         sum(segment.number_of_documents for segment in segments))
+            self._merge_segments(start, count, rate_limiter)
+            return True
+        finally:
             self._merge_lock.release_write()
-            return num_segments, num_segments
-        # we need segments at s and s + 1
-        print(
-            f"Initiating merge with segments {self._segments[smallest_pos].segment_id} and {self._segments[smallest_pos + 1].segment_id}...",
-            flush=True)
+
+    # merges count adjacent flushed segments from start into one, replacing them in the list of segments. The merge
+    # lock must be held
+    def _merge_segments(self, start, count, rate_limiter=None):
+        segments = self._segments[start:start + count]
+        print(f"Initiating merge with segments {', '.join(segment.segment_id for segment in segments)}...", flush=True)
         start_time = time.time()
-        # select the two smallest ADJACENT segments - this ensures doc ids are kept in order on disk
-        # this could be improved - we could for example ensure our segments were sorted on flush to speed this up with
-        # a linear merge to produce a combined term list
-        # produce a combined term dump
-        l_segment = self._segments[smallest_pos]
-        r_segment = self._segments[smallest_pos + 1]
         try:
-            new_segment = Segment(_create_segment_id(), self._storage_path, self._doc_value_fields)
-            new_segment.merge(l_segment, r_segment)
+            merged = Segment(_create_segment_id(), self._storage_path, self._doc_value_fields)
+            merged.merge(segments, rate_limiter=rate_limiter)
             # flush the new segment
-            new_segment.flush()
-            self._segment_update_lock.acquire_write()
-            # a stop the word event to modify the segments list, removing are two old ones and inserting our new one
-            new_segments = self._segments[:smallest_pos] + [new_segment] + self._segments[smallest_pos + 2:]
-            self._segments = new_segments
-            l_segment.delete()
-            r_segment.delete()
-            # we also need to write our new index file
-            self._store_index_meta()
-            print(f"Merge completed in {time.time() - start_time}s")
-            self._segment_update_lock.release_write()
-            self._merge_lock.release_write()
+            merged.flush()
         except Exception as e:
-            self._merge_lock.release_write()
-            self._segment_update_lock.release_write()
             raise MergeException(f"Unexpected exception during merge - {e}")
-        return num_segments, len(self._segments)
+        self._segment_update_lock.acquire_write()
+        # a stop the word event to modify the segments list, removing the old ones and inserting our new one
+        self._segments = self._segments[:start] + [merged] + self._segments[start + count:]
+        merged_ids = set(segment.segment_id for segment in segments)
+        self._filter_cache.invalidate(lambda key: key[0] in merged_ids)
+        self._posting_cache.invalidate(lambda key: key[0] in merged_ids)
+        for segment_id in merged_ids:
+            self._posting_cache_stats.pop(segment_id, None)
+        self._generation += 1
+        self._segment_update_lock.release_write()
+        # we also need to write our new index file - not whilst indexing is pickling it. This is written before the old
+        # segments are deleted so a reader never loads a state file referencing deleted segments
+        self._write_lock.acquire_write()
+        try:
+            self._store_index_meta()
+        finally:
+            self._write_lock.release_write()
+        self._segments_changed()
+        # queries still iterating the old segments hold the read lock
+        self._segment_update_lock.acquire_write()
+        for segment in segments:
+            segment.delete()
+        self._segment_update_lock.release_write()
+        print(f"Merge completed in {time.time() - start_time}s")
+
+    def merge_state(self):
+        if self._merge_scheduler is None:
+            return {"running": False}
+        return self._merge_scheduler.state()
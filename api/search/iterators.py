@@ -0,0 +1,524 @@
+import heapq
+import itertools
+import math
+import sys
+from bisect import bisect_left
+
+import numpy as np
+
+from search import codec
+from search.kernels import DOC_ID_TYPE, EMPTY_DOC_IDS
+
+# doc id of an exhausted iterator - greater than any real doc id so conjunctions terminate naturally
+NO_MORE_DOCS = sys.maxsize
+# score bounds are inflated slightly so rounding when summing scores can never cause a competitive doc to be skipped
+BOUND_SLACK = 1 + 1e-9
+
+
+# Document at a time iterators used to evaluate queries. Rather than materialising the full posting list of every
+# term (and every intermediate result), each node of a query is an iterator over the docs it matches in doc id order,
+# supporting next() and advance(target) i.e. move to the first doc >= target. Term iterators are backed by the block
+# skip table of the binary format (see codec.py) so they decode a block only when a doc in it is needed - an AND of a
+# rare and a common term decodes a handful of blocks of the common term. Memory per query is bounded by the decoded
+# block of each term, regardless of the number of matching docs.
+class PostingIterator:
+    is_stop_word = False
+
+    def __init__(self):
+        # -1 before the first call to next/advance, NO_MORE_DOCS once exhausted
+        self.doc_id = -1
+
+    def next(self):
+        return self.advance(self.doc_id + 1)
+
+    # moves to the first doc >= target and returns it - the iterator never moves backwards
+    def advance(self, target):
+        raise NotImplementedError
+
+    # score of the current doc
+    def score(self):
+        return 0
+
+    # positions of the current doc - only available if the terms were read with positions
+    def positions(self):
+        return None
+
+    # upper bound on the number of docs matched - used to order conjunctions
+    def cost(self):
+        return 0
+
+
+class EmptyIterator(PostingIterator):
+
+    def __init__(self, stop_word=False):
+        super().__init__()
+        self.is_stop_word = stop_word
+
+    def advance(self, target):
+        self.doc_id = NO_MORE_DOCS
+        return self.doc_id
+
+
+# Blocks of a term encoded in the binary format - the header is parsed on creation, blocks are decoded on demand
+class EncodedBlocks:
+
+    def __init__(self, buffer, with_positions=True):
+        self._buffer = buffer
+        self._header = codec.TermHeader(buffer)
+        self._with_positions = with_positions and self._header.has_positions
+        self.last_docs = self._header.skips['last_doc'].tolist()
+        self.doc_frequency = self._header.doc_frequency
+        # None if written before the max frequencies were stored
+        self.max_frequency = self._header.max_frequency
+        self.block_max_frequencies = None
+        if self.max_frequency is not None:
+            self.block_max_frequencies = self._header.skips['max_freq'].tolist()
+
+    # returns doc ids, frequencies, positions and the offset of each doc's positions (None without positions)
+    def decode(self, block):
+        doc_ids, frequencies, positions = codec.decode_block(self._buffer, self._header, block,
+                                                             with_positions=self._with_positions)
+        if positions is None:
+            return doc_ids.tolist(), frequencies.tolist(), None, None
+        offsets = [0]
+        offsets.extend(frequencies.cumsum().tolist())
+        return doc_ids.tolist(), frequencies.tolist(), positions.tolist(), offsets
+
+    def all_doc_ids(self):
+        return codec.decode(self._buffer, with_positions=False)[1]
+
+    # every block decoded - doc ids, frequencies, positions (None without) and the end of each block
+    def decode_all(self):
+        _, doc_ids, frequencies, positions = codec.decode(self._buffer, with_positions=self._with_positions)
+        return doc_ids.astype(DOC_ID_TYPE), frequencies, positions, np.cumsum(self._header.skips['count'])
+
+    # doc ids and frequencies as arrays. If candidates (sorted doc ids) are given, only the blocks which could contain
+    # them are decoded - the result is a superset of the candidates' postings, not restricted to them
+    def postings(self, candidates=None):
+        if candidates is None:
+            _, doc_ids, frequencies, _ = codec.decode(self._buffer, with_positions=False)
+            return doc_ids.astype(DOC_ID_TYPE), frequencies
+        blocks = np.unique(np.searchsorted(self._header.skips['last_doc'], candidates))
+        blocks = blocks[blocks < len(self.last_docs)]
+        if len(blocks) == 0:
+            return EMPTY_DOC_IDS, np.zeros(0, dtype=np.int64)
+        decoded = [codec.decode_block(self._buffer, self._header, block, with_positions=False) for block in
+                   blocks.tolist()]
+        return np.concatenate([block[0] for block in decoded]).astype(DOC_ID_TYPE), \
+            np.concatenate([block[1] for block in decoded])
+
+
+# The blocks of a term decoded up front and held as arrays, so they can be cached and shared by queries (see
+# Index.get_term_blocks). The block structure and bounds of the encoded term are kept for the iterators
+class DecodedBlocks:
+
+    def __init__(self, encoded):
+        self._doc_ids, self._frequencies, self._positions, self._ends = encoded.decode_all()
+        self._offsets = None
+        if self._positions is not None:
+            self._offsets = np.zeros(len(self._frequencies) + 1, dtype=np.int64)
+            np.cumsum(self._frequencies, out=self._offsets[1:])
+        self.last_docs = encoded.last_docs
+        self.doc_frequency = encoded.doc_frequency
+        self.max_frequency = encoded.max_frequency
+        self.block_max_frequencies = encoded.block_max_frequencies
+
+    @property
+    def nbytes(self):
+        size = self._doc_ids.nbytes + self._frequencies.nbytes + self._ends.nbytes + 16 * len(self.last_docs)
+        if self._positions is not None:
+            size += self._positions.nbytes + self._offsets.nbytes
+        return size
+
+    def decode(self, block):
+        start = int(self._ends[block - 1]) if block > 0 else 0
+        end = int(self._ends[block])
+        doc_ids = self._doc_ids[start:end].tolist()
+        frequencies = self._frequencies[start:end].tolist()
+        if self._positions is None:
+            return doc_ids, frequencies, None, None
+        offsets = self._offsets[start:end + 1]
+        return doc_ids, frequencies, self._positions[offsets[0]:offsets[-1]].tolist(), (offsets - offsets[0]).tolist()
+
+    def all_doc_ids(self):
+        return self._doc_ids
+
+    # already decoded so the candidates don't restrict anything
+    def postings(self, candidates=None):
+        return self._doc_ids, self._frequencies
+
+
+# A single block over already decoded postings - used for in memory (unflushed) segments and the text format
+class ArrayBlocks:
+
+    def __init__(self, doc_ids, frequencies, positions=None, offsets=None):
+        self._block = (doc_ids, frequencies, positions, offsets)
+        self.last_docs = doc_ids[-1:]
+        self.doc_frequency = len(doc_ids)
+        self.max_frequency = max(frequencies, default=0)
+        self.block_max_frequencies = [self.max_frequency]
+
+    @staticmethod
+    def from_postings(postings, with_positions=True):
+        # the buffer of an open segment can be appended to whilst we read it so take a copy, using the positions
+        # we actually copied for the frequency
+        postings = postings[:]
+        doc_ids = [posting.doc_id for posting in postings]
+        if not with_positions:
+            return ArrayBlocks(doc_ids, [posting.frequency for posting in postings])
+        frequencies = []
+        positions = []
+        offsets = [0]
+        for posting in postings:
+            doc_positions = posting.positions[:]
+            frequencies.append(len(doc_positions))
+            positions.extend(doc_positions)
+            offsets.append(len(positions))
+        return ArrayBlocks(doc_ids, frequencies, positions, offsets)
+
+    def decode(self, block):
+        return self._block
+
+    def all_doc_ids(self):
+        return np.array(self._block[0], dtype=np.int64)
+
+    def postings(self, candidates=None):
+        return np.array(self._block[0], dtype=DOC_ID_TYPE), np.array(self._block[1], dtype=np.int64)
+
+
+class TermIterator(PostingIterator):
+
+    def __init__(self, blocks, weight=0):
+        super().__init__()
+        self._blocks = blocks
+        # idf of the term - the score of a doc is (1 + log10(tf)) * weight, 0 for un-scored queries
+        self._weight = weight
+        self._block = -1
+        self._doc_ids = []
+        self._frequencies = []
+        self._positions = None
+        self._offsets = None
+        self._i = 0
+        # upper bounds of the scores of the term and each block - computed on first use
+        self._max_score = None
+        self._block_max_scores = None
+
+    def _load(self, block):
+        self._block = block
+        self._doc_ids, self._frequencies, self._positions, self._offsets = self._blocks.decode(block)
+
+    def advance(self, target):
+        if target <= self.doc_id:
+            return self.doc_id
+        if len(self._doc_ids) == 0 or target > self._doc_ids[-1]:
+            # not in the current block - use the skip table to find the first block which could contain the target
+            block = bisect_left(self._blocks.last_docs, target, self._block + 1)
+            if block >= len(self._blocks.last_docs):
+                self._doc_ids = []
+                self.doc_id = NO_MORE_DOCS
+                return self.doc_id
+            self._load(block)
+            self._i = 0
+        self._i = bisect_left(self._doc_ids, target, self._i)
+        self.doc_id = self._doc_ids[self._i]
+        return self.doc_id
+
+    def next(self):
+        # fast path for the common case of stepping within a block
+        if self._i + 1 < len(self._doc_ids):
+            self._i += 1
+            self.doc_id = self._doc_ids[self._i]
+            return self.doc_id
+        return self.advance(self.doc_id + 1)
+
+    def score(self):
+        if self._weight == 0:
+            return 0
+        return (1 + math.log10(self._frequencies[self._i])) * self._weight
+
+    def positions(self):
+        if self._positions is None:
+            return None
+        return self._positions[self._offsets[self._i]:self._offsets[self._i + 1]]
+
+    def cost(self):
+        return self._blocks.doc_frequency
+
+    # upper bound of the score of any doc in the term - infinite if the max frequencies weren't stored
+    def max_score(self):
+        if self._max_score is None:
+            frequency = self._blocks.max_frequency
+            self._max_score = math.inf if frequency is None else float(self._bound(np.array([frequency]))[0])
+        return self._max_score
+
+    # upper bound of the scores in the block which would contain the target, and the last doc of that block. This only
+    # reads the skip table - the block isn't decoded
+    def block_max_score(self, target):
+        block = bisect_left(self._blocks.last_docs, target, max(self._block, 0))
+        if block >= len(self._blocks.last_docs):
+            return 0, NO_MORE_DOCS
+        if self._block_max_scores is None:
+            frequencies = self._blocks.block_max_frequencies
+            if frequencies is None:
+                self._block_max_scores = [math.inf] * len(self._blocks.last_docs)
+            else:
+                self._block_max_scores = self._bound(np.array(frequencies)).tolist()
+        return self._block_max_scores[block], self._blocks.last_docs[block]
+
+    def _bound(self, frequencies):
+        return (1 + np.log10(np.maximum(frequencies, 1))) * self._weight * BOUND_SLACK
+
+    # all the doc ids of the term as an array - independent of the iterator's position
+    def doc_ids(self):
+        return self._blocks.all_doc_ids()
+
+    # doc ids and scores of the term as arrays, restricted to the blocks which could contain the candidates if given
+    def arrays(self, candidates=None):
+        doc_ids, frequencies = self._blocks.postings(candidates)
+        if self._weight == 0:
+            return doc_ids, np.zeros(len(doc_ids))
+        return doc_ids, (1 + np.log10(frequencies)) * self._weight
+
+
+# iterates a fixed list of (doc id, score) sorted by doc id e.g. the results of a vector search
+class ListIterator(PostingIterator):
+
+    def __init__(self, doc_ids, scores):
+        super().__init__()
+        self._doc_ids = doc_ids
+        self._scores = scores
+        self._i = 0
+
+    def advance(self, target):
+        if target <= self.doc_id:
+            return self.doc_id
+        self._i = bisect_left(self._doc_ids, target, self._i)
+        self.doc_id = self._doc_ids[self._i] if self._i < len(self._doc_ids) else NO_MORE_DOCS
+        return self.doc_id
+
+    def score(self):
+        return self._scores[self._i]
+
+    def cost(self):
+        return len(self._doc_ids)
+
+
+# a ListIterator over arrays e.g. the result of evaluating a boolean query with the array kernels (see kernels.py). The
+# arrays are kept so the results can be collected without iterating - the lists are only built if it is iterated
+class ArrayIterator(ListIterator):
+
+    def __init__(self, doc_ids, scores):
+        super().__init__(None, None)
+        self.doc_id_array = doc_ids
+        self.score_array = scores
+
+    def advance(self, target):
+        if self._doc_ids is None:
+            self._doc_ids = self.doc_id_array.tolist()
+            self._scores = self.score_array.tolist()
+        return super().advance(target)
+
+    def cost(self):
+        return len(self.doc_id_array)
+
+
+# intersection of two iterators. If a pcondition is given it is called with the positions of both sides for each
+# common doc - the doc matches only if it returns a non empty list of positions, which become the positions of the doc
+class AndIterator(PostingIterator):
+
+    def __init__(self, left, right, pcondition=None, score=False):
+        super().__init__()
+        self._left = left
+        self._right = right
+        self._pcondition = pcondition
+        self._score = score
+        self._positions = None
+
+    def advance(self, target):
+        if target <= self.doc_id:
+            return self.doc_id
+        left = self._left.advance(target)
+        while left != NO_MORE_DOCS:
+            right = self._right.advance(left)
+            if right != left:
+                left = self._left.advance(right)
+                continue
+            if self._pcondition is not None:
+                self._positions = self._pcondition(self._left.positions(), self._right.positions())
+                if len(self._positions) == 0:
+                    left = self._left.next()
+                    continue
+            break
+        self.doc_id = left
+        return self.doc_id
+
+    def score(self):
+        if self._score:
+            return self._left.score() + self._right.score()
+        return self._left.score()
+
+    def positions(self):
+        if self._pcondition is not None:
+            return self._positions
+        return self._left.positions()
+
+    def cost(self):
+        return min(self._left.cost(), self._right.cost())
+
+
+# union of two iterators - the score of a doc is the sum of the scores of the sides it appears in
+class OrIterator(PostingIterator):
+
+    def __init__(self, left, right):
+        super().__init__()
+        self._left = left
+        self._right = right
+
+    def advance(self, target):
+        if target <= self.doc_id:
+            return self.doc_id
+        left = self._left.doc_id
+        if left < target:
+            left = self._left.advance(target)
+        right = self._right.doc_id
+        if right < target:
+            right = self._right.advance(target)
+        self.doc_id = min(left, right)
+        return self.doc_id
+
+    def score(self):
+        if self._left.doc_id == self.doc_id:
+            if self._right.doc_id == self.doc_id:
+                return self._right.score() + self._left.score()
+            return self._left.score()
+        return self._right.score()
+
+    def positions(self):
+        if self._left.doc_id == self.doc_id:
+            return self._left.positions()
+        return self._right.positions()
+
+    def cost(self):
+        return self._left.cost() + self._right.cost()
+
+
+# all docs in [min_doc_id, max_doc_id] not matched by the child - each with a score of 1
+class NotIterator(PostingIterator):
+
+    def __init__(self, child, min_doc_id, max_doc_id):
+        super().__init__()
+        self._child = child
+        self._min_doc_id = min_doc_id
+        self._max_doc_id = max_doc_id
+
+    def advance(self, target):
+        if target <= self.doc_id:
+            return self.doc_id
+        doc_id = max(target, self._min_doc_id)
+        while doc_id <= self._max_doc_id:
+            excluded = self._child.doc_id
+            if excluded < doc_id:
+                excluded = self._child.advance(doc_id)
+            if excluded != doc_id:
+                self.doc_id = doc_id
+                return self.doc_id
+            doc_id += 1
+        self.doc_id = NO_MORE_DOCS
+        return self.doc_id
+
+    def score(self):
+        return 1
+
+    def cost(self):
+        return max(self._max_doc_id - self._min_doc_id + 1, 0)
+
+
+# a NOT evaluated with the array kernels (see kernels.Complement) - iterated as a NotIterator over the excluded docs
+class ComplementIterator(NotIterator):
+
+    def __init__(self, complement):
+        super().__init__(ArrayIterator(complement.excluded, np.zeros(len(complement.excluded))),
+                         complement.min_doc_id, complement.max_doc_id)
+        self.complement = complement
+
+    def score(self):
+        return self.complement.score
+
+    def cost(self):
+        return self.complement.count()
+
+
+# Block-Max MaxScore over a disjunction of term iterators, where the score of a doc is the sum of the scores of the terms
+# containing it. Rather than scoring every doc, the (score, -doc id) of competitive docs are pushed to top_docs - a min
+# heap of at most num_docs entries, which can be shared across segments so its threshold carries over. Once the heap is
+# full, its lowest score is a threshold which allows docs to be skipped:
+#
+# 1. Terms are ordered by their max score. Those whose summed max scores can't beat the threshold are non-essential -
+#    a doc containing only these can't be competitive, so only the docs of the essential terms are candidates.
+# 2. If the max scores of the blocks of the essential terms containing a candidate plus the non-essential bound can't
+#    beat the threshold, all docs up to the end of the shortest block are skipped without decoding them.
+# 3. The non-essential terms are only advanced to a candidate whilst its score could still beat the threshold.
+#
+# Docs are visited in doc id order, so a doc equal to the threshold never enters the heap - as with an exhaustive
+# evaluation where ties go to the lowest doc id.
+def block_max_maxscore(terms, top_docs, num_docs):
+    if num_docs <= 0:
+        return
+    ordered = sorted(terms, key=lambda term: term.max_score())
+    bounds = list(itertools.accumulate(term.max_score() for term in ordered))
+    for term in ordered:
+        term.next()
+    full = len(top_docs) >= num_docs
+    threshold = top_docs[0][0] if full else -math.inf
+    # ordered[:essential] are the non-essential terms
+    essential = 0
+    while essential < len(ordered) and bounds[essential] <= threshold:
+        essential += 1
+    while essential < len(ordered):
+        doc_id = min(term.doc_id for term in ordered[essential:])
+        if doc_id == NO_MORE_DOCS:
+            return
+        if full:
+            bound = bounds[essential - 1] if essential > 0 else 0
+            next_doc = NO_MORE_DOCS
+            for term in ordered[essential:]:
+                if term.doc_id == doc_id:
+                    block_score, last_doc = term.block_max_score(doc_id)
+                    bound += block_score
+                    next_doc = min(next_doc, last_doc + 1)
+                else:
+                    next_doc = min(next_doc, term.doc_id)
+            if bound <= threshold:
+                for term in ordered[essential:]:
+                    term.advance(next_doc)
+                continue
+        score = 0
+        for term in ordered[essential:]:
+            if term.doc_id == doc_id:
+                score += term.score()
+        competitive = True
+        for i in range(essential - 1, -1, -1):
+            if score + bounds[i] <= threshold:
+                competitive = False
+                break
+            if ordered[i].advance(doc_id) == doc_id:
+                score += ordered[i].score()
+        if competitive:
+            # re-sum in the order of the terms in the query so the score of a doc doesn't depend on the partition
+            score = 0
+            for term in terms:
+                if term.doc_id == doc_id:
+                    score += term.score()
+            scored_doc = (score, -doc_id)
+            if not full:
+                heapq.heappush(top_docs, scored_doc)
+            elif scored_doc > top_docs[0]:
+                heapq.heapreplace(top_docs, scored_doc)
+            full = len(top_docs) >= num_docs
+            if full and top_docs[0][0] > threshold:
+                threshold = top_docs[0][0]
+                while essential < len(ordered) and bounds[essential] <= threshold:
+                    essential += 1
+        for term in ordered[essential:]:
+            if term.doc_id == doc_id:
+                term.next()
@@ -0,0 +1,110 @@
+import numpy as np
+
+# Set operations over sorted, unique doc id arrays (int32) with numpy - used to evaluate boolean queries over whole
+# posting lists at once rather than a doc at a time (see Query._evaluate_arrays). Doc ids fit in int32 as the index is
+# limited well below 2^31 docs.
+DOC_ID_TYPE = np.int32
+
+EMPTY_DOC_IDS = np.zeros(0, dtype=DOC_ID_TYPE)
+EMPTY_SCORES = np.zeros(0, dtype=np.float64)
+
+
+# Galloping (exponential) search would probe the larger list from the last match. With numpy we get the same bound,
+# O(m log n) for m << n, by binary searching every doc of the smaller list into the larger at once. Returns the indices
+# of the common docs in both arrays, so scores can be gathered alongside.
+def intersect(left, right):
+    if len(left) > len(right):
+        right_indices, left_indices = intersect(right, left)
+        return left_indices, right_indices
+    if len(left) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # only the range of the larger list which overlaps the smaller can match
+    start = np.searchsorted(right, left[0])
+    end = np.searchsorted(right, left[-1], side='right')
+    positions = np.searchsorted(right[start:end], left)
+    found = positions < end - start
+    found[found] = right[start:end][positions[found]] == left[found]
+    return np.flatnonzero(found), positions[found] + start
+
+
+# k-way union - the score of a doc is the sum of its scores in each input, accumulated in the order of the inputs
+def union(doc_ids, scores):
+    if len(doc_ids) == 0:
+        return EMPTY_DOC_IDS, EMPTY_SCORES
+    if len(doc_ids) == 1:
+        return doc_ids[0], scores[0]
+    all_doc_ids = np.concatenate(doc_ids)
+    unique_doc_ids, inverse = np.unique(all_doc_ids, return_inverse=True)
+    # bincount adds the weights in order so a doc's score is the same as summing its inputs one by one
+    summed = np.bincount(inverse, weights=np.concatenate(scores), minlength=len(unique_doc_ids))
+    return unique_doc_ids.astype(DOC_ID_TYPE, copy=False), summed
+
+
+# the docs of left not in right, as a mask over left
+def difference(left, right):
+    if len(left) == 0 or len(right) == 0:
+        return np.ones(len(left), dtype=bool)
+    positions = np.searchsorted(right, left)
+    found = positions < len(right)
+    found[found] = right[positions[found]] == left[found]
+    return ~found
+
+
+# the docs in [min_doc_id, max_doc_id] not in excluded
+def complement(excluded, min_doc_id, max_doc_id):
+    if max_doc_id < min_doc_id:
+        return EMPTY_DOC_IDS
+    keep = np.ones(max_doc_id - min_doc_id + 1, dtype=bool)
+    excluded = excluded[(excluded >= min_doc_id) & (excluded <= max_doc_id)]
+    keep[excluded - min_doc_id] = False
+    return (np.flatnonzero(keep) + min_doc_id).astype(DOC_ID_TYPE)
+
+
+# The docs in [min_doc_id, max_doc_id] not in excluded, each with the same score - the result of a NOT. Rather than
+# listing every doc of the segment, it is held as the excluded docs plus a bitset over the range (1 bit per doc, built on
+# first use) so it can be intersected with other results, counted and paged without materialising the complement.
+class Complement:
+
+    def __init__(self, excluded, min_doc_id, max_doc_id, score=1):
+        self.excluded = excluded[(excluded >= min_doc_id) & (excluded <= max_doc_id)]
+        self.min_doc_id = min_doc_id
+        self.max_doc_id = max_doc_id
+        self.score = score
+        self._bits = None
+
+    def _bitset(self):
+        if self._bits is None:
+            mask = np.zeros(max(self.max_doc_id - self.min_doc_id + 1, 0), dtype=bool)
+            mask[self.excluded - self.min_doc_id] = True
+            self._bits = np.packbits(mask, bitorder='little')
+        return self._bits
+
+    def count(self):
+        return max(self.max_doc_id - self.min_doc_id + 1, 0) - len(self.excluded)
+
+    # mask of the doc ids in the complement
+    def contains(self, doc_ids):
+        inside = (doc_ids >= self.min_doc_id) & (doc_ids <= self.max_doc_id)
+        offsets = doc_ids[inside] - self.min_doc_id
+        inside[inside] = (self._bitset()[offsets >> 3] >> (offsets & 7)) & 1 == 0
+        return inside
+
+    # the first num_docs docs, reading only as much of the range as needed
+    def first(self, num_docs):
+        if num_docs <= 0 or self.count() == 0:
+            return EMPTY_DOC_IDS
+        # the range holding num_docs docs is num_docs plus the number of excluded docs within it
+        end = min(self.min_doc_id + num_docs - 1, self.max_doc_id)
+        while True:
+            extended = min(self.min_doc_id + num_docs - 1 + np.searchsorted(self.excluded, end, side='right'),
+                           self.max_doc_id)
+            if extended == end:
+                break
+            end = extended
+        return complement(self.excluded, self.min_doc_id, end)[:num_docs]
+
+    def doc_ids(self):
+        if self.max_doc_id < self.min_doc_id:
+            return EMPTY_DOC_IDS
+        bits = np.unpackbits(self._bitset(), count=self.max_doc_id - self.min_doc_id + 1, bitorder='little')
+        return (np.flatnonzero(bits == 0) + self.min_doc_id).astype(DOC_ID_TYPE)
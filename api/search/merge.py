@@ -0,0 +1,168 @@
+import threading
+import time
+import traceback
+from math import log
+
+from search.segment import DEFAULT_MAX_DOCS_PER_SEGMENT
+
+# adjacent segments of the same tier merged at once
+DEFAULT_SEGMENTS_PER_TIER = 10
+# segments are never merged beyond this many docs - larger segments make merges slow and gain little for queries
+DEFAULT_MAX_MERGED_DOCS = 500000
+# merge i/o rate - 0 is unlimited
+DEFAULT_MAX_MERGE_MB_PER_SEC = 20
+# bytes accumulated between pauses, so small writes don't each sleep
+MIN_PAUSE_CHECK_BYTES = 64 * 1024
+
+
+# Caps the rate at which a merge writes - the merge pauses for as long as needed for its writes to not exceed the rate.
+# A merge reads the same volume it writes so this bounds both, keeping disk bandwidth for queries whilst indexing.
+class RateLimiter:
+
+    def __init__(self, mb_per_sec):
+        self._lock = threading.Lock()
+        self._last_time = time.monotonic()
+        self._pending_bytes = 0
+        self.mb_per_sec = mb_per_sec
+        self.bytes = 0
+        self.paused = 0
+
+    def set_rate(self, mb_per_sec):
+        self.mb_per_sec = mb_per_sec
+
+    def pause(self, num_bytes):
+        with self._lock:
+            self.bytes += num_bytes
+            self._pending_bytes += num_bytes
+            if self._pending_bytes < MIN_PAUSE_CHECK_BYTES:
+                return
+            num_bytes, self._pending_bytes = self._pending_bytes, 0
+            now = time.monotonic()
+            if self.mb_per_sec <= 0:
+                self._last_time = now
+                return
+            # the time by which these bytes can be written at the rate - sleep if ahead of it
+            target = self._last_time + num_bytes / (self.mb_per_sec * 1024 * 1024)
+            if target <= now:
+                self._last_time = now
+                return
+            self._last_time = target
+        time.sleep(target - now)
+        self.paused += target - now
+
+
+# Selects adjacent segments to merge, grouping segments into tiers by number of docs: tier 0 are up to
+# min_docs * segments_per_tier docs, tier 1 up to min_docs * segments_per_tier^2 and so on. Once segments_per_tier
+# adjacent flushed segments share a tier they are merged into one segment of the next tier, lowest tier first. Only
+# adjacent segments are merged to keep doc ids in order across segments. Each doc is therefore rewritten once per tier
+# rather than once per merge.
+class TieredMergePolicy:
+
+    def __init__(self, segments_per_tier=DEFAULT_SEGMENTS_PER_TIER, max_merged_docs=DEFAULT_MAX_MERGED_DOCS,
+                 min_docs=DEFAULT_MAX_DOCS_PER_SEGMENT):
+        if segments_per_tier < 2:
+            raise ValueError("segments_per_tier must be at least 2")
+        self.segments_per_tier = segments_per_tier
+        self.max_merged_docs = max_merged_docs
+        self.min_docs = min_docs
+
+    def tier(self, num_docs):
+        if num_docs < self.min_docs * self.segments_per_tier:
+            return 0
+        return int(log(num_docs / self.min_docs, self.segments_per_tier) + 1e-9)
+
+    # the (start, count) of the next segments to merge, None if no merge is needed
+    def find_merge(self, segments):
+        best = None
+        best_key = None
+        for start in range(len(segments) - self.segments_per_tier + 1):
+            window = segments[start:start + self.segments_per_tier]
+            if not all(segment.is_flushed() for segment in window):
+                continue
+            tiers = set(self.tier(segment.number_of_documents) for segment in window)
+            num_docs = sum(segment.number_of_documents for segment in window)
+            if len(tiers) > 1 or num_docs > self.max_merged_docs:
+                continue
+            key = (tiers.pop(), num_docs)
+            if best_key is None or key < best_key:
+                best = (start, self.segments_per_tier)
+                best_key = key
+        return best
+
+    def state(self):
+        return {"segments_per_tier": self.segments_per_tier, "max_merged_docs": self.max_merged_docs,
+                "min_docs": self.min_docs}
+
+
+# Runs merges in a background thread. Woken after each flush, it merges whilst the policy finds segments to merge -
+# only one merge runs at once (see Index._merge_next) and its i/o is throttled by a rate limiter.
+class MergeScheduler:
+
+    def __init__(self, index, policy=TieredMergePolicy(), max_mb_per_sec=DEFAULT_MAX_MERGE_MB_PER_SEC):
+        self._index = index
+        self._policy = policy
+        self._rate_limiter = RateLimiter(max_mb_per_sec)
+        self._pending = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._current = None
+        self._merges = 0
+        self._merge_time = 0
+        self._last_error = None
+
+    def start(self):
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run, name="merge-scheduler", daemon=True)
+            self._thread.start()
+            # segments may have been flushed before we started
+            self._pending.set()
+
+    # called after a flush - checks for merges in the background
+    def notify(self):
+        self._pending.set()
+
+    # waits for any running merge to complete
+    def stop(self):
+        self._stopped = True
+        self._pending.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def set_rate(self, mb_per_sec):
+        self._rate_limiter.set_rate(mb_per_sec)
+
+    def _merge_started(self, segment_ids, num_docs):
+        self._current = {"segments": segment_ids, "docs": num_docs, "started": time.time()}
+
+    def _run(self):
+        while not self._stopped:
+            self._pending.wait()
+            self._pending.clear()
+            while not self._stopped:
+                try:
+                    merged = self._index._merge_next(self._policy, self._rate_limiter, self._merge_started)
+                except Exception as e:
+                    traceback.print_exc()
+                    self._last_error = str(e)
+                    merged = False
+                if self._current is not None:
+                    self._merge_time += time.time() - self._current["started"]
+                    self._current = None
+                if not merged:
+                    break
+                self._merges += 1
+
+    def state(self):
+        current = self._current
+        return {
+            "running": self._thread is not None and not self._stopped,
+            "current": dict(current, elapsed=time.time() - current["started"]) if current is not None else None,
+            "merges": self._merges,
+            "merge_time": self._merge_time,
+            "bytes_written": self._rate_limiter.bytes,
+            "throttled_time": self._rate_limiter.paused,
+            "max_mb_per_sec": self._rate_limiter.mb_per_sec,
+            "last_error": self._last_error,
+            "policy": self._policy.state()
+        }
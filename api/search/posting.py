@@ -2,6 +2,10 @@ import math
 from dataclasses import dataclass
 from functools import total_ordering
 
+import numpy as np
+
+from search import codec
+
 
 def _generate_skips(positions):
     skips = []
@@ -126,6 +130,62 @@ class Posting:
         return self.doc_id < other.doc_id
 
 
+# columnar form of a posting list as decoded from the binary format - positions for all docs are held in a single
+# array, with position_offsets[i]:position_offsets[i + 1] giving the positions of the ith doc
+class PostingArrays:
+    __slots__ = ('doc_ids', 'frequencies', 'positions', 'position_offsets')
+
+    def __init__(self, doc_ids, frequencies, positions=None):
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+        self.positions = positions
+        self.position_offsets = None
+        if positions is not None:
+            self.position_offsets = np.concatenate(([0], np.cumsum(frequencies)))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    @staticmethod
+    def from_postings(postings, with_positions=True):
+        doc_ids = np.fromiter((posting.doc_id for posting in postings), dtype=np.int64, count=len(postings))
+        frequencies = np.fromiter((posting.frequency for posting in postings), dtype=np.int64, count=len(postings))
+        positions = None
+        if with_positions:
+            positions = np.fromiter((position for posting in postings for position in posting.positions),
+                                    dtype=np.int64)
+        return PostingArrays(doc_ids, frequencies, positions=positions)
+
+    def concatenate(self, other):
+        positions = None
+        if self.positions is not None and other.positions is not None:
+            positions = np.concatenate((self.positions, other.positions))
+        return PostingArrays(np.concatenate((self.doc_ids, other.doc_ids)),
+                             np.concatenate((self.frequencies, other.frequencies)), positions=positions)
+
+    @staticmethod
+    def concatenate_all(arrays):
+        positions = None
+        if all(array.positions is not None for array in arrays):
+            positions = np.concatenate([array.positions for array in arrays])
+        return PostingArrays(np.concatenate([array.doc_ids for array in arrays]),
+                             np.concatenate([array.frequencies for array in arrays]), positions=positions)
+
+    def to_postings(self):
+        doc_ids = self.doc_ids.tolist()
+        frequencies = self.frequencies.tolist()
+        if self.positions is None:
+            return [Posting(doc_id, frequency) for doc_id, frequency in zip(doc_ids, frequencies)]
+        positions = self.positions.tolist()
+        offsets = self.position_offsets.tolist()
+        postings = []
+        for i in range(len(doc_ids)):
+            posting = Posting(doc_ids[i], frequencies[i])
+            posting.positions = positions[offsets[i]:offsets[i + 1]]
+            postings.append(posting)
+        return postings
+
+
 # encapsulates all the information about a term
 class TermPosting:
 
@@ -133,10 +193,35 @@ class TermPosting:
     def __init__(self, collecting_frequency=0, stop_word=False, first_occurrence=None):
         self._collection_frequency = collecting_frequency
         self._first_occurrence = first_occurrence
-        self.postings = []
+        # postings are held either as Posting objects or, when read from the binary format, as arrays. The latter
+        # are only converted to objects on access
+        self._postings = []
+        self._arrays = None
         self.skips = []
         self._stop_word = stop_word
 
+    @property
+    def postings(self):
+        if self._postings is None:
+            self._postings = self._arrays.to_postings()
+        return self._postings
+
+    @postings.setter
+    def postings(self, postings):
+        self._postings = postings
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            return PostingArrays.from_postings(self._postings)
+        return self._arrays
+
+    @arrays.setter
+    def arrays(self, arrays):
+        self._arrays = arrays
+        self._postings = None
+
     def add_position(self, doc_id, position):
         # we assume single threaded index construction and that one doc is added at a time - we thus create
         # a new posting when the doc id changes
@@ -155,7 +240,9 @@ class TermPosting:
 
     @property
     def doc_frequency(self):
-        return len(self.postings)
+        if self._postings is None:
+            return len(self._arrays)
+        return len(self._postings)
 
     @property
     def collection_frequency(self):
@@ -172,13 +259,34 @@ class TermPosting:
             self._collection_frequency += term_posting.collection_frequency
             # this should be in order for future merges self.postings.append(term_posting.postings)
             if update_skips:
-                current_offset = len(self.postings)
+                current_offset = self.doc_frequency
                 if current_offset == 0:
                     # optimization for first segement and when there is only one
                     self.skips = term_posting.skips
                 else:
                     self.skips = self.skips + [[skip[0], skip[1] + current_offset] for skip in term_posting.skips]
-            self.postings = self.postings + term_posting.postings
+            if self._postings is None and term_posting._postings is None:
+                # both array backed e.g. from a merge - avoid creating posting objects
+                self.arrays = self._arrays.concatenate(term_posting._arrays)
+            elif self.doc_frequency == 0 and term_posting._postings is None:
+                self.arrays = term_posting._arrays
+            else:
+                self.postings = self.postings + term_posting.postings
+
+    # collates the term information of the postings of a term in several segments, in doc id order, into one - as
+    # add_term_info but copying the postings once
+    @staticmethod
+    def merge(term_postings):
+        if len(term_postings) == 1:
+            return term_postings[0]
+        collection_frequency = sum(term_posting.collection_frequency for term_posting in term_postings)
+        merged = TermPosting(collecting_frequency=collection_frequency, first_occurrence=term_postings[0].first_occurrence)
+        if all(term_posting._postings is None for term_posting in term_postings):
+            # all array backed e.g. from a merge - avoid creating posting objects
+            merged.arrays = PostingArrays.concatenate_all([term_posting._arrays for term_posting in term_postings])
+        else:
+            merged.postings = [posting for term_posting in term_postings for posting in term_posting.postings]
+        return merged
 
     def __iter__(self):
         return iter(self.postings)
@@ -188,8 +296,32 @@ class TermPosting:
         skip_rep = ":".join(_generate_skips([posting.doc_id for posting in self.postings]))
         return f"{self._first_occurrence if self._first_occurrence else ''}|{self.collection_frequency}|{skip_rep}|{store_rep}"
 
+    def to_binary_format(self, with_positions=True):
+        if self._postings is None:
+            arrays = self._arrays
+        else:
+            arrays = PostingArrays.from_postings(self._postings, with_positions=with_positions)
+        return codec.encode(arrays.doc_ids, arrays.frequencies, positions=arrays.positions if with_positions else None,
+                            collection_frequency=self._collection_frequency,
+                            first_occurrence=self._first_occurrence)
+
+    @staticmethod
+    def from_binary_format(value, with_positions=True, with_skips=True):
+        header, doc_ids, frequencies, positions = codec.decode(value, with_positions=with_positions)
+        term_posting = TermPosting(collecting_frequency=header.collection_frequency,
+                                   first_occurrence=header.first_occurrence)
+        term_posting.arrays = PostingArrays(doc_ids, frequencies, positions=positions)
+        if with_skips:
+            # a skip to the last doc of every block bar the final one - same form as the text format skips
+            ends = np.cumsum(header.skips['count']) - 1
+            term_posting.skips = list(zip(header.skips['last_doc'][:-1].tolist(), ends[:-1].tolist()))
+        return term_posting
+
+    # values from the text store are str, binary stores return bytes
     @staticmethod
     def from_store_format(value, with_positions=True, with_skips=True):
+        if not isinstance(value, str):
+            return TermPosting.from_binary_format(value, with_positions=with_positions, with_skips=with_skips)
         components = value.split("|")
         first_occurrence = None if components[0] == '' else components[0]
         termPosting = TermPosting(collecting_frequency=int(components[1]), first_occurrence=first_occurrence)
@@ -202,6 +334,10 @@ class TermPosting:
 
     @staticmethod
     def from_min_store_format(value):
+        if not isinstance(value, str):
+            header = codec.TermHeader(value)
+            return TermPosting(collecting_frequency=header.collection_frequency,
+                               first_occurrence=header.first_occurrence)
         components = value.split("|")
         first_occurrence = None if components[0] == '' else components[0]
         return TermPosting(collecting_frequency=int(components[1]), first_occurrence=first_occurrence)
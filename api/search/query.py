@@ -1,8 +1,9 @@
 import heapq
 import math
 import re
-from operator import itemgetter
+import threading
 
+import numpy as np
 from pyparsing import (
     Word,
     alphanums,
@@ -15,20 +16,35 @@ from pyparsing import (
     oneOf,
 )
 
-from search.posting import ScoredPosting, Posting, TermPosting, VectorPosting
+from search import kernels
+from search.iterators import AndIterator, ArrayIterator, ComplementIterator, EmptyIterator, NotIterator, OrIterator, \
+    TermIterator, NO_MORE_DOCS, block_max_maxscore
+from search.posting import ScoredPosting, Posting
 
 PHRASE_TESTER = re.compile("\"(.*)\"")
 PROXIMITY_TESTER = re.compile("#[1-9][0-9]*\(.*\)")
+# boolean operators which can be evaluated over arrays (see Query._evaluate_arrays)
+ARRAY_OPERATORS = ('and', 'or', 'not', 'natural')
+# neighbours first retrieved per result requested by a vector search without facets, and at least
+VECTOR_K_FACTOR = 4
+MIN_VECTOR_K = 100
+# filters matching at most this many docs with vectors are scored exactly rather than by searching the hnsw graph
+MAX_EXACT_VECTOR_DOCS = 5000
 
 
 class Query:
 
     def __init__(self, index):
         self._index = index
-        # false indicates positions will not be loaded answering queries - set to true if a phrase or proximity query is used
-        self._with_positions = False
-        self._with_posting_skips = False
         self._is_natural = False
+        # whether the total of the last search only counts the docs retrieved, of more which match - see _nearest_docs
+        self.total_is_lower_bound = False
+        self._segments = []
+        # the blocks of each (segment, term) and the doc frequency of each term - read once per query
+        self._blocks = {}
+        self._doc_frequencies = {}
+        # segments are evaluated in parallel so the doc frequencies, which read every segment, are computed once
+        self._doc_frequency_lock = threading.Lock()
         # this builds the grammar to parse expressions using pyparser - we support booleans, quotes, proximity
         # + parenthesis (TBC)
         or_operator = Forward()
@@ -94,170 +110,218 @@ class Query:
             'natural': self._evaluate_natural
         }
 
-    def _evaluate_and(self, components, pcondition, score=False):
-        self._with_posting_skips = True
-        left_term_posting = self.evaluate(components[0], pcondition=pcondition, score=score)
-        right_term_posting = self.evaluate(components[1], pcondition=pcondition, score=score)
-        if left_term_posting.is_stop_word or right_term_posting.is_stop_word:
-            return self._execute_or(left_term_posting, right_term_posting)
-        intersection = self._execute_and(left_term_posting, right_term_posting, pcondition, score=score)
-        self._with_posting_skips = False
-        return intersection
-
-    def _execute_and(self, left_term_posting, right_term_posting, pcondition, score=False):
-        intersection = []
-        li = 0
-        ri = 0
-        ls = 0
-        rs = 0
-        left_skips = left_term_posting.skips
-        right_skips = right_term_posting.skips
-        left_postings = left_term_posting.postings
-        right_postings = right_term_posting.postings
-        while li < len(left_postings) and ri < len(right_postings):
-            left_posting = left_postings[li]
-            right_posting = right_postings[ri]
-            if left_posting.doc_id > right_posting.doc_id:
-                if rs < len(right_skips):
-                    right_skip = right_skips[rs]
-                    if left_posting.doc_id >= right_skip[0]:
-                        # can use the skip and advance the ri pointer
-                        rs += 1
-                        ri = right_skip[1]
-                        continue
-                ri += 1
-            elif left_posting.doc_id < right_posting.doc_id:
-                if ls < len(left_skips):
-                    # we still have a skip to maybe use
-                    left_skip = left_skips[ls]
-                    if left_skip[0] <= right_posting.doc_id:
-                        ls += 1
-                        li = left_skip[1]
-                        continue
-                li += 1
-            else:
-                positions = pcondition(left_posting, right_posting)
-                if positions is None or len(positions) > 0:
-                    if score:
-                        intersection.append(ScoredPosting(left_posting, left_posting.score + right_posting.score, positions=positions))
-                    else:
-                        intersection.append(left_posting)
-                li += 1
-                ri += 1
-        term_posting = TermPosting()
-        term_posting.postings = intersection
-        return term_posting
-
-    def _evaluate_natural(self, components, pcondition, score=True):
+    def _get_blocks(self, segment, term, with_positions):
+        key = (segment.segment_id, term, with_positions)
+        if key not in self._blocks:
+            self._blocks[key] = self._index.get_term_blocks(segment, term, with_positions=with_positions)
+        return self._blocks[key]
+
+    # the idf is global so the doc frequency is summed across all segments - only the block headers are read
+    def _doc_frequency(self, term, with_positions):
+        if term not in self._doc_frequencies:
+            with self._doc_frequency_lock:
+                if term not in self._doc_frequencies:
+                    doc_frequency = 0
+                    for segment in self._segments:
+                        blocks = self._get_blocks(segment, term, with_positions)
+                        if blocks is not None:
+                            doc_frequency += blocks.doc_frequency
+                    self._doc_frequencies[term] = doc_frequency
+        return self._doc_frequencies[term]
+
+    def _evaluate_and(self, components, segment, pcondition, score=False):
+        left = self.evaluate(components[0], segment, pcondition=pcondition, score=score)
+        right = self.evaluate(components[1], segment, pcondition=pcondition, score=score)
+        if left.is_stop_word or right.is_stop_word:
+            return self._execute_or(left, right)
+        return AndIterator(left, right, pcondition=pcondition, score=score)
+
+    def _evaluate_natural(self, components, segment, pcondition, score=True):
         # TODO: Replace this with HNSW vector scoring
-        return self._evaluate_or(components, pcondition, score=True)
-
-    def evaluate(self, components, pcondition=lambda left, right, args={}: None, score=False):
-        return self._methods[components.getName()](components, pcondition, score)
-
-    def _extend(self, list, iter):
-        item = next(iter, None)
-        while item:
-            list.append(item)
-            item = next(iter, None)
-
-    @staticmethod
-    def _posting_merge(left, right):
-        last = None
-        for posting in heapq.merge(left, right):
-            if last is None:
-                last = posting
-            elif posting != last:
-                yield last
-                last = posting
+        return self._evaluate_or(components, segment, pcondition, score=True)
+
+    # builds the iterator for the parsed query over a single segment - nothing is read until it is iterated. Boolean
+    # operators without phrases or proximity beneath them are instead evaluated up front with the array kernels
+    def evaluate(self, components, segment, pcondition=None, score=False):
+        if pcondition is None and components.getName() in ARRAY_OPERATORS and self._is_array_evaluable(components):
+            result = self._evaluate_arrays(components, segment, score)
+            if result is None:
+                return EmptyIterator(stop_word=True)
+            if isinstance(result, kernels.Complement):
+                return ComplementIterator(result)
+            return ArrayIterator(*result)
+        return self._methods[components.getName()](components, segment, pcondition, score)
+
+    def _is_array_evaluable(self, components):
+        name = components.getName()
+        if name == 'term':
+            return True
+        if name == 'parenthesis' or name == 'not':
+            return self._is_array_evaluable(components[0])
+        if name in ARRAY_OPERATORS:
+            return self._is_array_evaluable(components[0]) and self._is_array_evaluable(components[1])
+        # phrases and proximity need positions
+        return False
+
+    # Evaluates the query over whole posting lists with the numpy kernels, returning sorted doc ids and their scores as
+    # arrays - or None for a stop word, or a kernels.Complement for a NOT. Scores are the same as those of the iterators.
+    # If candidates (sorted doc ids) are
+    # given, the result only needs to be correct for those docs - terms then decode only the blocks which could contain
+    # them, so an AND of a rare and a common term decodes a handful of blocks of the common term.
+    def _evaluate_arrays(self, components, segment, score, candidates=None):
+        name = components.getName()
+        if name == 'term':
+            term = self._evaluate_term(components, segment, None, score)
+            if term.is_stop_word:
+                return None
+            if isinstance(term, TermIterator):
+                return term.arrays(candidates)
+            return kernels.EMPTY_DOC_IDS, kernels.EMPTY_SCORES
+        if name == 'parenthesis':
+            return self._evaluate_arrays(components[0], segment, score, candidates)
+        if name == 'not':
+            excluded = self._evaluate_arrays(components[0], segment, False, candidates)
+            if isinstance(excluded, kernels.Complement):
+                # NOT NOT a - the docs of a
+                doc_ids = excluded.excluded
             else:
-                yield ScoredPosting(posting, posting.score + last.score)
-                last = None
-        if last is not None:
-            yield last
-
-    def _execute_or(self, left_term_posting, right_term_posting):
-        if left_term_posting.is_stop_word:
-            left_term_posting = TermPosting()
-        if right_term_posting.is_stop_word:
-            right_term_posting = TermPosting()
-        merged_term_posting = TermPosting()
-        merged_term_posting.postings = list(
-            self._posting_merge(left_term_posting.postings, right_term_posting.postings))
-        return merged_term_posting
-
-    def _evaluate_or(self, components, pcondition, score=False):
-        left_term_posting = self.evaluate(components[0], score=score)
-        right_term_posting = self.evaluate(components[1], score=score)
-        return self._execute_or(left_term_posting, right_term_posting)
-
-    def _evaluate_not(self, components, pcondition, score):
-        not_docs = []
-        right_term_posting = self.evaluate(components[0], score=score)
-        if right_term_posting.is_stop_word:
-            right = None
+                excluded = kernels.EMPTY_DOC_IDS if excluded is None else excluded[0]
+                if candidates is None:
+                    # held lazily - the docs are only listed if they have to be e.g. for an OR
+                    min_doc_id, max_doc_id = segment.get_doc_id_range()
+                    return kernels.Complement(excluded, min_doc_id, max_doc_id)
+                doc_ids = candidates[kernels.difference(candidates, excluded)]
+            return doc_ids, np.ones(len(doc_ids))
+        if name == 'and':
+            return self._evaluate_arrays_and(components, segment, score, candidates)
+        return self._evaluate_arrays_or(components, segment, score, candidates)
+
+    def _evaluate_arrays_and(self, components, segment, score, candidates):
+        left_cost = self._array_cost(components[0], segment)
+        right_cost = self._array_cost(components[1], segment)
+        if left_cost is None or right_cost is None:
+            # as _evaluate_and - a stop word is ignored
+            return self._union_arrays([(components[1], score), (components[0], score)], segment, candidates)
+        # the cheaper side is evaluated first, its docs restricting what is read of the other - a NOT is only listed
+        # within the docs of the other side, so a AND NOT b is the docs of a less those of b
+        if left_cost <= right_cost:
+            left = self._evaluate_arrays(components[0], segment, score, candidates)
+            right = self._evaluate_arrays(components[1], segment, score, self._candidates(left, candidates))
         else:
-            right_side = iter(right_term_posting)
-            right = next(right_side, None)
-        doc_id = 1
-        while doc_id < self._index.current_id:
-            if not right or doc_id < right.doc_id:
-                not_docs.append(ScoredPosting(Posting(doc_id), score=1))
-            else:
-                right = next(right_side, None)
-            doc_id += 1
-        term_posting = TermPosting()
-        term_posting.postings = not_docs
-        return term_posting
-
-    def _phrase_match(self, left, right):
+            right = self._evaluate_arrays(components[1], segment, score, candidates)
+            left = self._evaluate_arrays(components[0], segment, score, self._candidates(right, candidates))
+        if isinstance(left, kernels.Complement):
+            if isinstance(right, kernels.Complement):
+                # NOT a AND NOT b is NOT (a OR b)
+                return kernels.Complement(np.union1d(left.excluded, right.excluded), left.min_doc_id, left.max_doc_id,
+                                          score=left.score + right.score if score else left.score)
+            matches = left.contains(right[0])
+            scores = np.full(np.count_nonzero(matches), float(left.score))
+            if score:
+                scores = scores + right[1][matches]
+            return right[0][matches], scores
+        if isinstance(right, kernels.Complement):
+            matches = right.contains(left[0])
+            scores = left[1][matches]
+            if score:
+                scores = scores + right.score
+            return left[0][matches], scores
+        left_indices, right_indices = kernels.intersect(left[0], right[0])
+        scores = left[1][left_indices]
+        if score:
+            scores = scores + right[1][right_indices]
+        return left[0][left_indices], scores
+
+    def _candidates(self, result, candidates):
+        if isinstance(result, kernels.Complement):
+            return candidates
+        return result[0]
+
+    def _evaluate_arrays_or(self, components, segment, score, candidates):
+        return self._union_arrays(self._or_operands(components, score), segment, candidates)
+
+    def _union_arrays(self, operands, segment, candidates):
+        doc_ids = []
+        scores = []
+        for operand, operand_score in operands:
+            result = self._evaluate_arrays(operand, segment, operand_score, candidates)
+            if isinstance(result, kernels.Complement):
+                result = result.doc_ids(), np.full(result.count(), float(result.score))
+            if result is not None:
+                doc_ids.append(result[0])
+                scores.append(result[1])
+        return kernels.union(doc_ids, scores)
+
+    # the operands of a chain of ORs e.g. a OR (b OR c) in the order the iterators sum their scores - (c + b) + a
+    def _or_operands(self, components, score):
+        name = components.getName()
+        if name == 'parenthesis':
+            return self._or_operands(components[0], score)
+        if name == 'natural':
+            score = True
+        if name == 'or' or name == 'natural':
+            return self._or_operands(components[1], score) + [(components[0], score)]
+        return [(components, score)]
+
+    # upper bound on the number of docs matched, None for a stop word
+    def _array_cost(self, components, segment):
+        name = components.getName()
+        if name == 'term':
+            term = self._evaluate_term(components, segment, None, False)
+            return None if term.is_stop_word else term.cost()
+        if name == 'parenthesis':
+            return self._array_cost(components[0], segment)
+        if name == 'not':
+            min_doc_id, max_doc_id = segment.get_doc_id_range()
+            return max(max_doc_id - min_doc_id + 1, 0)
+        left = self._array_cost(components[0], segment)
+        right = self._array_cost(components[1], segment)
+        if name == 'and':
+            if left is None or right is None:
+                return right if left is None else left
+            return min(left, right)
+        return (left or 0) + (right or 0)
+
+    def _execute_or(self, left, right):
+        if left.is_stop_word:
+            left = EmptyIterator()
+        if right.is_stop_word:
+            right = EmptyIterator()
+        return OrIterator(left, right)
+
+    def _evaluate_or(self, components, segment, pcondition, score=False):
+        left = self.evaluate(components[0], segment, score=score)
+        right = self.evaluate(components[1], segment, score=score)
+        return self._execute_or(left, right)
+
+    def _evaluate_not(self, components, segment, pcondition, score):
+        excluded = self.evaluate(components[0], segment, score=score)
+        if excluded.is_stop_word:
+            excluded = EmptyIterator()
+        # segments hold adjacent doc id ranges so the complement within each segment covers every doc in the index
+        min_doc_id, max_doc_id = segment.get_doc_id_range()
+        return NotIterator(excluded, min_doc_id, max_doc_id)
+
+    def _phrase_match(self, left_positions, right_positions):
         positions = []
-        left_positions = left.positions
-        right_positions = right.positions
-        li = 0
         ri = 0
-        ls = 0
-        rs = 0
-        # skip pointers
-        left_skips = left.skips
-        right_skips = right.skips
-        while li < len(left_positions) and ri < len(right_positions):
-            left = left_positions[li]
-            right = right_positions[ri]
-            if left >= right:
-                if rs < len(right_skips):
-                    # we still have a skip to maybe use
-                    right_skip = right_skips[rs]
-                    if left >= right_skip[0]:
-                        # can use the skip and advance the ri pointer
-                        rs += 1
-                        ri = right_skip[1]
-                        continue
+        for left in left_positions:
+            while ri < len(right_positions) and right_positions[ri] <= left:
                 ri += 1
-            else:
-                if left + 1 == right:
-                    positions.append(left)
-                if ls < len(left_skips):
-                    # we still have a skip to maybe use
-                    left_skip = left_skips[ls]
-                    if left_skip[0] < right:
-                        ls += 1
-                        li = left_skip[1]
-                        continue
-                li += 1
+            if ri == len(right_positions):
+                break
+            if right_positions[ri] == left + 1:
+                positions.append(left)
         return positions
 
-    def _evaluate_parenthesis(self, components, pcondition, score=False):
-        return self.evaluate(components[0], pcondition, score=score)
+    def _evaluate_parenthesis(self, components, segment, pcondition, score=False):
+        return self.evaluate(components[0], segment, pcondition, score=score)
 
-    def _evaluate_phrases(self, components, pcondition, score):
+    def _evaluate_phrases(self, components, segment, pcondition, score):
         # first we perform an AND by re-writing the query
-        self._with_positions = True
         and_query = self._parser(' AND '.join([component[0] for component in components]))
         # additional pcondition through lambda _phrase_match on verification step of and performs the phrase check
-        phrase_response = self.evaluate(and_query[0], pcondition=self._phrase_match, score=score)
-        self._with_positions = False
-        return phrase_response
+        return self.evaluate(and_query[0], segment, pcondition=self._phrase_match, score=score)
 
     def _proximity_match(self, left, right, distance):
         left_side = iter(left)
@@ -281,56 +345,229 @@ class Query:
                     continue
             return []
 
-    def _evaluate_proximity(self, components, pcondition, score):
-        self._with_positions = True
+    def _evaluate_proximity(self, components, segment, pcondition, score):
         distance = components[0]
         # first we perform an AND by re-writing the query
         and_query = self._parser(' AND '.join([component[0] for component in components[1:]]))
         # additional pcondition through lambda _phrase_match on verification step of and performs the phrase check
         check_proximity = lambda left, right: self._proximity_match(left, right, int(distance))
-        proximity_response = self.evaluate(and_query[0], pcondition=check_proximity, score=score)
-        self._with_positions = False
-        return proximity_response
+        return self.evaluate(and_query[0], segment, pcondition=check_proximity, score=score)
 
-    def _evaluate_term(self, components, pcondition, score):
-        # score the docs
+    def _evaluate_term(self, components, segment, pcondition, score):
         term = components[0]
         if ":" not in term:
             # : indicates a special lookup on a protected term
             term = self._index.analyzer.process_token(term)
         if term is None:
             # we have a stop word - a special case
-            return TermPosting(stop_word=True)
-        term_posting = self._index.get_term(term, with_positions=self._with_positions,
-                                            with_skips=self._with_posting_skips)
-        if not score:
-            return term_posting
-
-        scored_postings = []
-        for doc_posting in term_posting:
-            score = (1 + math.log10(doc_posting.frequency)) * \
-                    math.log10(self._index.number_of_docs / term_posting.doc_frequency)
-            scored_postings.append(ScoredPosting(doc_posting, score=score))
-        scored_posting = TermPosting(collecting_frequency=term_posting.collection_frequency)
-        scored_posting.postings = scored_postings
-        scored_posting.skips = term_posting.skips
-        return scored_posting
-
-    def _get_facets(self, facets, docs):
-        facet_values = {}
+            return EmptyIterator(stop_word=True)
+        # positions are only needed if we're checking a phrase or proximity - otherwise use the smaller postings
+        with_positions = pcondition is not None
+        blocks = self._get_blocks(segment, term, with_positions)
+        if blocks is None:
+            return EmptyIterator()
+        weight = 0
+        if score:
+            weight = math.log10(self._index.number_of_docs / self._doc_frequency(term, with_positions))
+        return TermIterator(blocks, weight=weight)
+
+    # evaluates the plan (a function giving the iterator of a segment) over every segment in parallel, on the index's
+    # search pool, then merges the top docs, totals and facet counts of the segments
+    def _collect(self, plan, score, max_results, offset, facets):
+        fields = [facet.field for facet in facets if self._index.has_doc_id(facet.field)]
+        # if we have an offset we need offset + max_results
+        num_docs = max_results + offset
+        results = self._index.map_segments(
+            lambda segment: self._collect_segment(segment, plan(segment), score, num_docs, fields), self._segments)
+        return self._merge_segment_results(results, score, max_results, offset, facets, fields)
+
+    # streams the docs matched in a segment - only the top docs and the facet counts are held, so memory doesn't grow
+    # with the number of matches. Returns the top docs, the number of matches and the facet counts of the segment
+    def _collect_segment(self, segment, iterator, score, num_docs, fields):
+        facet_values = {field: [] for field in fields}
+        top_docs = []
+        if isinstance(iterator, ArrayIterator):
+            if facet_values:
+                self._count_facets(segment, iterator.doc_id_array, facet_values)
+            self._push_arrays(iterator.doc_id_array, iterator.score_array, score, num_docs, top_docs)
+            return top_docs, len(iterator.doc_id_array), facet_values
+        if isinstance(iterator, ComplementIterator):
+            complement = iterator.complement
+            if facet_values:
+                self._count_facets(segment, complement.doc_ids(), facet_values)
+            # every doc has the same score so the first docs are the best
+            doc_ids = complement.first(num_docs)
+            self._push_arrays(doc_ids, np.full(len(doc_ids), complement.score), score, num_docs, top_docs)
+            return top_docs, complement.count(), facet_values
+        total = 0
+        # the matched docs are only held if facets are needed - they are counted per segment
+        matched = [] if facet_values else None
+        doc_id = iterator.next()
+        while doc_id != NO_MORE_DOCS:
+            total += 1
+            if matched is not None:
+                matched.append(doc_id)
+            if score:
+                # min heap of the best docs - on equal scores the lowest doc id wins
+                scored_doc = (iterator.score(), -doc_id)
+                if len(top_docs) < num_docs:
+                    heapq.heappush(top_docs, scored_doc)
+                elif scored_doc > top_docs[0]:
+                    heapq.heapreplace(top_docs, scored_doc)
+            elif len(top_docs) < num_docs:
+                # docs arrive in doc id order so the first are the ones we want
+                top_docs.append((iterator.score(), -doc_id))
+            doc_id = iterator.next()
+        if matched:
+            self._count_facets(segment, np.array(matched, dtype=np.int64), facet_values)
+        return top_docs, total, facet_values
+
+    # combines the results of each segment, in segment order, as if the segments had been collected one after another
+    def _merge_segment_results(self, results, score, max_results, offset, facets, fields):
+        num_docs = max_results + offset
+        facet_values = {field: [] for field in fields}
+        top_docs = []
+        total = 0
+        for segment_top_docs, segment_total, segment_facet_values in results:
+            total += segment_total
+            # facet counts are merged in segment order so values with equal counts keep their order
+            for field, parts in segment_facet_values.items():
+                facet_values[field].extend(parts)
+            if score:
+                top_docs.extend(segment_top_docs)
+            else:
+                # unscored docs are in doc id order so the first segments' docs are the ones we want
+                top_docs.extend(segment_top_docs[:max(num_docs - len(top_docs), 0)])
+        if score:
+            # (score, -doc id) is unique so the best docs are the same as from a single heap
+            top_docs = heapq.nlargest(num_docs, top_docs)
+        return self._results(top_docs, score, max_results, offset, facets, facet_values, total)
+
+    # as _collect for docs already evaluated to arrays - only the top docs are pushed to the heap
+    def _push_arrays(self, doc_ids, scores, score, num_docs, top_docs):
+        if score:
+            if len(doc_ids) > num_docs > 0:
+                # only docs scoring at least the num_docs'th best can make the heap, including any ties with it
+                threshold = np.partition(scores, len(scores) - num_docs)[len(scores) - num_docs]
+                selected = np.flatnonzero(scores >= threshold)
+                doc_ids = doc_ids[selected]
+                scores = scores[selected]
+            # best first - highest score then lowest doc id, as the heap orders them
+            order = np.lexsort((doc_ids, -scores))[:num_docs]
+            for doc_score, doc_id in zip(scores[order].tolist(), doc_ids[order].tolist()):
+                scored_doc = (doc_score, -doc_id)
+                if len(top_docs) < num_docs:
+                    heapq.heappush(top_docs, scored_doc)
+                elif scored_doc > top_docs[0]:
+                    heapq.heapreplace(top_docs, scored_doc)
+                else:
+                    break
+        else:
+            remaining = max(num_docs - len(top_docs), 0)
+            top_docs.extend(zip(scores[:remaining].tolist(), (-doc_ids[:remaining]).tolist()))
+
+    # a disjunction of terms only e.g. a OR b, or a natural language query not routed to HNSW
+    def _is_disjunction(self, components):
+        name = components.getName()
+        if name == 'parenthesis':
+            return self._is_disjunction(components[0])
+        if name == 'or' or name == 'natural':
+            return self._is_disjunction_clause(components[0]) and self._is_disjunction_clause(components[1])
+        return False
+
+    def _is_disjunction_clause(self, components):
+        return components.getName() == 'term' or self._is_disjunction(components)
+
+    def _disjunction_terms(self, components, segment):
+        name = components.getName()
+        if name == 'term':
+            term = self.evaluate(components, segment, score=True)
+            # stop words and terms not in the segment match nothing
+            return [term] if isinstance(term, TermIterator) else []
+        if name == 'parenthesis':
+            return self._disjunction_terms(components[0], segment)
+        return self._disjunction_terms(components[0], segment) + self._disjunction_terms(components[1], segment)
+
+    # scored disjunctions use dynamic pruning (see block_max_maxscore) so only docs which could make the top results are
+    # scored. The total and facets still need every matching doc, but not their scores, so are computed from a bitmap
+    # of the terms' doc ids - far cheaper than scoring each doc. Segments are collected in parallel as in _collect
+    def _collect_disjunction(self, components, max_results, offset, facets):
+        fields = [facet.field for facet in facets if self._index.has_doc_id(facet.field)]
+        num_docs = max_results + offset
+        results = self._index.map_segments(
+            lambda segment: self._collect_disjunction_segment(components, segment, num_docs, fields), self._segments)
+        return self._merge_segment_results(results, True, max_results, offset, facets, fields)
+
+    def _collect_disjunction_segment(self, components, segment, num_docs, fields):
+        facet_values = {field: [] for field in fields}
+        top_docs = []
+        terms = self._disjunction_terms(components, segment)
+        if len(terms) == 0:
+            return top_docs, 0, facet_values
+        block_max_maxscore(terms, top_docs, num_docs)
+        if len(terms) == 1 and not facet_values:
+            return top_docs, terms[0].cost(), facet_values
+        term_doc_ids = [term.doc_ids() for term in terms]
+        min_doc_id = min(int(doc_ids[0]) for doc_ids in term_doc_ids)
+        matches = np.zeros(max(int(doc_ids[-1]) for doc_ids in term_doc_ids) - min_doc_id + 1, dtype=bool)
+        for doc_ids in term_doc_ids:
+            matches[doc_ids - min_doc_id] = True
+        if facet_values:
+            self._count_facets(segment, np.flatnonzero(matches) + min_doc_id, facet_values)
+        return top_docs, int(np.count_nonzero(matches)), facet_values
+
+    # counts the values of the matched docs of a segment (an array in doc id order) for each facet field. Flushed
+    # segments count the ordinals of their columnar doc values with bincount, so only the values present are looked up.
+    # Each segment adds (values, counts, first occurrence, number of values) to facet_values - see _facet_counts
+    def _count_facets(self, segment, doc_ids, facet_values):
+        for field, parts in facet_values.items():
+            column = segment.get_doc_value_column(field)
+            if column is not None:
+                ordinals = column.ordinals(doc_ids)
+                if len(ordinals) == 0:
+                    continue
+                counts = np.bincount(ordinals)
+                present, first = np.unique(ordinals, return_index=True)
+                parts.append((column.labels[present], counts[present], first, len(ordinals)))
+                continue
+            # the open segment has no columns - its values are read doc by doc
+            values = []
+            for doc_id in doc_ids.tolist():
+                doc_values = segment.get_doc_values(field, doc_id)
+                if doc_values is not None:
+                    values.extend(doc_values)
+            if len(values) > 0:
+                labels, first, inverse = np.unique(np.array(values, dtype=str), return_index=True, return_inverse=True)
+                parts.append((labels, np.bincount(inverse), first, len(values)))
+
+    # the top values of a facet from the counts of each segment. Values with equal counts are ordered by their first
+    # occurrence in the matched docs, as if counted doc by doc
+    def _facet_counts(self, parts, num_values):
+        if len(parts) == 0:
+            return {}
+        labels = np.concatenate([part[0] for part in parts])
+        counts = np.concatenate([part[1] for part in parts])
+        offsets = np.cumsum([0] + [part[3] for part in parts[:-1]])
+        first = np.concatenate([part[2] + offset for part, offset in zip(parts, offsets)])
+        if len(parts) > 1:
+            labels, inverse = np.unique(labels, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts).astype(np.int64)
+            first_occurrence = np.full(len(labels), np.iinfo(np.int64).max)
+            np.minimum.at(first_occurrence, inverse, first)
+            first = first_occurrence
+        order = np.lexsort((first, -counts))[:num_values]
+        return dict(zip(labels[order].tolist(), counts[order].tolist()))
+
+    def _results(self, top_docs, score, max_results, offset, facets, facet_values, total):
+        if score:
+            top_docs.sort(reverse=True)
+        docs = [ScoredPosting(Posting(-doc_id), score=doc_score) for doc_score, doc_id in
+                top_docs[offset:offset + max_results]]
+        facet_counts = {}
         for facet in facets:
-            if self._index.has_doc_id(facet.field):
-                facet_values[facet.field] = {}
-                for doc in docs:
-                    values = self._index.get_doc_values(facet.field, doc.doc_id)
-                    for value in values:
-                        if not value in facet_values[facet.field]:
-                            facet_values[facet.field][value] = 1
-                        else:
-                            facet_values[facet.field][value] += 1
-                facet_values[facet.field] = dict(
-                    sorted(facet_values[facet.field].items(), key=itemgetter(1), reverse=True)[:facet.num_values])
-        return facet_values
+            if facet.field in facet_values:
+                facet_counts[facet.field] = self._facet_counts(facet_values[facet.field], facet.num_values)
+        return docs, facet_counts, total
 
     def _is_natural_language(self, query_text):
         # single term queries are not NL - insufficient information
@@ -348,40 +585,97 @@ class Query:
 
     def execute(self, query, filters, score, max_results, offset, facets, use_hnsw=True, max_distance=0.8):
         filters = [f"{filter.field}:{'_'.join(self._index.analyzer.tokenize(filter.value))}" for filter in filters]
-        filter_query = " AND ".join(filters)
-        if use_hnsw and self._is_natural_language(query):
-            print("Executing natural language search")
-            ids, distances = self._index.find_closest_vectors(query)
-            docs = []
-            # could do a binary search here but we ultimately need to iterate all values anyway to produce
-            # vector postings - we could remove the need for the vector postings object but needs a refactor - change
-            # only if performance an issue
-            for i in range(len(ids[0])):
-                if distances[0][i] > max_distance:
-                    break
-                # invert the distance to score
-                docs.append(VectorPosting(ids[0][i], 1 - distances[0][i]))
-            if len(filters) > 0:
-                parsed = self._parser(filter_query)
-                filtered_docs = self.evaluate(parsed[0], score=score)
-                vector_posting = TermPosting()
-                # unfortunately need in doc id order for fast intersection - might be worth building a custom
-                # intersect to avoid
-                docs.sort(key=lambda p: p.doc_id)
-                vector_posting.postings = docs
-                # intersect filtered with hnsw
-                docs = self._execute_and(vector_posting, filtered_docs, pcondition=lambda left, right, args={}: None, score=False).postings
-        else:
-            query = f"{query} AND {filter_query}"
-            parsed = self._parser(query)
-            docs = self.evaluate(parsed[0], score=score).postings
-        facet_values = {}
-        if len(facets) > 0:
-            facet_values = self._get_facets(facets, docs)
-        # we would add pagination here
-        if score and len(docs) > 0:
-            # if we have an offset we need offset + max_results
-            sorted_docs = heapq.nlargest(max_results + offset, docs, key=lambda doc: doc.score)
-            return sorted_docs[offset:offset + max_results], facet_values, len(docs)
-        return heapq.nsmallest(max_results, docs, key=lambda doc: doc.doc_id)[
-               offset:offset + max_results], facet_values, len(docs)
+        # segments can't be removed by a merge whilst we're iterating them
+        self._segments = self._index.acquire_segments()
+        try:
+            if use_hnsw and self._is_natural_language(query):
+                print("Executing natural language search")
+                doc_ids, scores, self.total_is_lower_bound = self._nearest_docs(query, filters, max_results + offset,
+                                                                                len(facets) > 0, max_distance)
+                plan = lambda segment: self._vector_plan(segment, doc_ids, scores)
+            else:
+                parsed = self._parser(query)
+                if len(filters) == 0:
+                    if score and self._is_disjunction(parsed[0]):
+                        return self._collect_disjunction(parsed[0], max_results, offset, facets)
+                    plan = lambda segment: self.evaluate(parsed[0], segment, score=score)
+                else:
+                    plan = lambda segment: self._evaluate_filtered(parsed[0], segment, score,
+                                                                   self._filter_doc_ids(segment, filters))
+            return self._collect(plan, score, max_results, offset, facets)
+        finally:
+            self._index.release_segments()
+
+    # the nearest docs within max_distance of the query, matching the filters, as arrays in doc id order scored by
+    # 1 - distance, and whether more docs may be within the distance. The filtered docs are an allow-list for the hnsw
+    # search - if there are only a few they are scored exactly instead. Facets count every doc within the distance so
+    # need all the neighbours the index can retrieve. Otherwise k starts from the number of docs requested and doubles
+    # only whilst too few were retrieved and neighbours beyond the k retrieved could still be within the distance. If
+    # every neighbour retrieved is within the distance, those beyond may be too - the total is then a lower bound
+    def _nearest_docs(self, query, filters, num_docs, all_docs, max_distance):
+        query_vector = self._index.embed_query(query)
+        allowed = None
+        num_vectors = self._index.number_of_vectors
+        if len(filters) > 0:
+            allowed = self._index.vector_doc_ids(self._all_filter_doc_ids(filters))
+            if len(allowed) <= MAX_EXACT_VECTOR_DOCS:
+                doc_ids, scores = self._within_distance(
+                    *self._index.exact_closest_vectors(query_vector, allowed, filters), max_distance)
+                return doc_ids, scores, False
+            num_vectors = len(allowed)
+        limit = min(self._index.max_vector_results(), num_vectors)
+        k = limit if all_docs else min(max(num_docs * VECTOR_K_FACTOR, MIN_VECTOR_K), limit)
+        while True:
+            doc_ids, scores = self._within_distance(*self._index.find_closest_vectors(query_vector, k, allowed),
+                                                    max_distance)
+            if k >= limit or len(doc_ids) < k or len(doc_ids) >= num_docs:
+                return doc_ids, scores, len(doc_ids) == k and k < num_vectors
+            k = min(k * 2, limit)
+
+    # the neighbours (nearest first) within the distance, in doc id order and scored by 1 - distance
+    def _within_distance(self, ids, distances, max_distance):
+        # nearest first so the docs within the distance are a prefix
+        end = int(np.searchsorted(distances, max_distance, side='right'))
+        doc_ids = ids[:end].astype(kernels.DOC_ID_TYPE)
+        scores = 1 - distances[:end]
+        order = np.argsort(doc_ids, kind='stable')
+        return doc_ids[order], scores[order]
+
+    # the docs of every segment matching the filters, in doc id order
+    def _all_filter_doc_ids(self, filters):
+        doc_ids = [self._filter_doc_ids(segment, filters) for segment in self._segments]
+        return np.concatenate(doc_ids) if len(doc_ids) > 0 else kernels.EMPTY_DOC_IDS
+
+    # the range of the docs (an array in doc id order) within the segment
+    def _segment_slice(self, segment, doc_ids):
+        min_doc_id, max_doc_id = segment.get_doc_id_range()
+        return int(np.searchsorted(doc_ids, min_doc_id, side='left')), int(np.searchsorted(doc_ids, max_doc_id,
+                                                                                           side='right'))
+
+    # the nearest docs, in doc id order, within the segment - already restricted to the filtered docs
+    def _vector_plan(self, segment, doc_ids, scores):
+        start, end = self._segment_slice(segment, doc_ids)
+        return ArrayIterator(doc_ids[start:end], scores[start:end])
+
+    # the docs of the segment matching every filter - the doc set of each filter is cached by the index
+    def _filter_doc_ids(self, segment, filters):
+        doc_ids = self._index.get_filter(segment, filters[0])
+        for term in filters[1:]:
+            doc_ids = doc_ids[kernels.intersect(doc_ids, self._index.get_filter(segment, term))[0]]
+        return doc_ids
+
+    # evaluates the query restricted to the filtered docs - filters only restrict the docs matched, they aren't scored
+    def _evaluate_filtered(self, components, segment, score, candidates):
+        if not self._is_array_evaluable(components):
+            return AndIterator(self.evaluate(components, segment, score=score),
+                               ArrayIterator(candidates, np.zeros(len(candidates))))
+        # the filtered docs are the candidates so only the blocks of terms which could contain them are read
+        result = self._evaluate_arrays(components, segment, score, candidates)
+        if result is None:
+            # a stop word is ignored as in an AND, leaving the filtered docs
+            return ArrayIterator(candidates, np.zeros(len(candidates)))
+        if isinstance(result, kernels.Complement):
+            doc_ids = candidates[result.contains(candidates)]
+            return ArrayIterator(doc_ids, np.full(len(doc_ids), float(result.score)))
+        indices = kernels.intersect(result[0], candidates)[0]
+        return ArrayIterator(result[0][indices], result[1][indices])
@@ -1,31 +1,60 @@
+import heapq
 import os.path
 import sys
 import time
 import uuid
 import ujson as json
+from search import codec
+from search.bloom import BloomFilter
+from search.cache import LRUCache
+from search.dictionary import TermDictionary
+from search.docvalues import DocValueColumn
+from search.iterators import ArrayBlocks, EncodedBlocks
 from search.lock import ReadWriteLock
 from search.posting import TermPosting
-from search.store import Store
+from search.store import Store, MappedStore, OffsetIndex
 
 # new segment rolled over on hitting this
 DEFAULT_MAX_DOCS_PER_SEGMENT = 2000
+# default memory for doc values read from the doc value stores, shared by all segments
+DOC_VALUE_CACHE_BYTES = 32 * 1024 * 1024
 
+# doc values of each (segment id, field, doc id) read from the stores - flushed segments use their columns so this only
+# holds the docs of open segments. Bounded and shared across segments, see Index for configuring its size
+DOC_VALUE_CACHE = LRUCache(DOC_VALUE_CACHE_BYTES)
 
+
+def _doc_values_size(values):
+    return 64 + sum(48 + len(value) for value in values)
+
+
+# segments are created concurrently by indexing and background merges so the suffix must be random - the leading hex
+# of a uuid1 is its clock and repeats within a few ms
 def _create_segment_id():
-    return f"{round(time.time() * 1000)}_{uuid.uuid1().hex[:4]}"
+    return f"{round(time.time() * 1000)}_{uuid.uuid4().hex[:8]}"
+
+
+def _with_position(items, position):
+    for term, posting in items:
+        yield term, position, posting
 
 
 class Segment:
 
     def __init__(self, segment_id, storage_path, doc_value_fields, max_docs=DEFAULT_MAX_DOCS_PER_SEGMENT):
-        # for now we use a hash for the term dictionary - in future we may want to use a tree here
-        # this index persists the postings on disk to save disk - note that segments are immutable
-        # the keys to this dict are the terms, the values offsets
+        # whilst indexing, terms are held in a buffer (hash). On flush the postings are persisted to disk and the terms
+        # written to a sorted term dictionary (see dictionary.py) which maps them to their offsets - note that flushed
+        # segments are immutable
         self._segment_id = segment_id
         self._postings_file = os.path.join(storage_path, f"{self._segment_id}.pot")
-        self._postings_index = Store(self._postings_file)
+        # new segments always use the binary posting format - see codec.py
+        self._postings_index = Store(self._postings_file, binary=True)
         self._positions_file = os.path.join(storage_path, f"{self._segment_id}.pos")
-        self._positions_index = Store(self._positions_file)
+        self._positions_index = Store(self._positions_file, binary=True)
+        # once flushed, the terms are held in a dictionary shared by the postings and positions, with a bloom filter
+        # to cheaply reject terms not in the segment
+        self._term_dictionary = None
+        self._bloom_filter = None
         self._buffer = {}
         self._is_flushed = False
         self._max_docs = max_docs
@@ -34,12 +63,12 @@ class Segment:
         self._min_doc_id = sys.maxsize
         self._doc_value_fields = {}
         self._doc_values = {}
-        self._doc_value_cache = {}
+        # once flushed, the doc values of each field are also held in a columnar layout for faceting
+        self._doc_value_columns = {}
         for field in doc_value_fields:
             doc_value_store_path = os.path.join(storage_path, f"{self._segment_id}-{field}.dv")
             self._doc_values[field] = Store(doc_value_store_path)
             self._doc_value_fields[field] = doc_value_store_path
-            self._doc_value_cache[field] = {}
         self._flush_lock = ReadWriteLock()
         self._indexing_lock = ReadWriteLock()
 
@@ -86,7 +115,7 @@ class Segment:
             for field, values in doc_values.items():
                 if field in self._doc_values:
                     self._doc_values[field][doc_id] = json.dumps(values)
-                    self._doc_value_cache[field][doc_id] = values
+                    DOC_VALUE_CACHE.put((self._segment_id, field, doc_id), values, _doc_values_size(values))
             if doc_id > self._max_doc_id:
                 self._max_doc_id = doc_id
             if doc_id < self._min_doc_id:
@@ -107,15 +136,18 @@ class Segment:
             self._doc_values[field]
         except KeyError:
             return None
+        column = self._doc_value_columns.get(field)
+        if column is not None:
+            return column.values(doc_id)
         # check the cache first
-        try:
-            return self._doc_value_cache[field][doc_id]
-        except KeyError:
-            pass
+        key = (self._segment_id, field, doc_id)
+        values = DOC_VALUE_CACHE.get(key)
+        if values is not None:
+            return values
         try:
             values = json.loads(self._doc_values[field][doc_id])
             # insert into cache
-            self._doc_value_cache[field][doc_id] = values
+            DOC_VALUE_CACHE.put(key, values, _doc_values_size(values))
             return values
         except KeyError:
             pass
@@ -134,6 +166,8 @@ class Segment:
             return pos
         # don't need the read lock on an immutable segment
         self._flush_lock.release_read()
+        if term not in self._bloom_filter:
+            return None
         # use the disk postings if this has been flushed
         if with_positions:
             if term in self._positions_index:
@@ -145,6 +179,29 @@ class Segment:
                 return TermPosting.from_store_format(self._postings_index[term], with_positions=False,
                                                      with_skips=with_skips)
 
+    # the term's postings as blocks which are only decoded when iterated (see iterators.py) or None if the term is not in
+    # the segment. Unlike get_term this doesn't decode the postings
+    def get_term_blocks(self, term, with_positions=True):
+        self._flush_lock.acquire_read()
+        if not self._is_flushed:
+            blocks = None
+            if term in self._buffer:
+                blocks = ArrayBlocks.from_postings(self._buffer[term].postings, with_positions=with_positions)
+            self._flush_lock.release_read()
+            return blocks
+        self._flush_lock.release_read()
+        if term not in self._bloom_filter:
+            return None
+        try:
+            data = self._positions_index[term] if with_positions else self._postings_index[term]
+        except KeyError:
+            return None
+        if isinstance(data, str):
+            # text format - no block structure to exploit so decode up front
+            term_posting = TermPosting.from_store_format(data, with_positions=with_positions, with_skips=False)
+            return ArrayBlocks.from_postings(term_posting.postings, with_positions=with_positions)
+        return EncodedBlocks(data, with_positions=with_positions)
+
     # flushed the buffer to disk - this can be called manually and "closes" the segment to additions making it immutable
     def flush(self):
         # whilst we're flushing, reads can continue on the buffer. Indexing can't.
@@ -155,8 +212,8 @@ class Segment:
                 print(f"Flushing segment {self._segment_id}")
                 # flush the term buffer in sorted term order
                 for term in sorted(self._buffer):
-                    self._positions_index[term] = self._buffer[term].to_store_format()
-                    self._postings_index[term] = self._buffer[term].to_store_format(with_positions=False)
+                    self._positions_index[term] = self._buffer[term].to_binary_format()
+                    self._postings_index[term] = self._buffer[term].to_binary_format(with_positions=False)
                 # this flush is just to prevent queries from reading an empty buffer - might not be needed. Note we do this
                 # only for the period of clearing the buffer - not during flushing - very short period
                 self._flush_lock.acquire_write()
@@ -170,11 +227,17 @@ class Segment:
                 self._postings_index.clear()
                 for field in self._doc_values.keys():
                     self._doc_values[field].clear()
-                    self._doc_value_cache[field].clear()
+                self._evict_doc_values()
                 raise e
             self._is_flushed = True
-            # release the memory of the segment
+            # the segment is now immutable - switch to memory mapped reads
+            self._open_terms(self._postings_index.seal(), self._positions_index.seal())
+            for field in self._doc_values.keys():
+                self._doc_values[field] = self._doc_values[field].to_reader()
+            self._open_doc_value_columns()
+            # release the memory of the segment - the doc values are now read from the columns
             self._buffer.clear()
+            self._evict_doc_values()
             self._flush_lock.release_write()
             print(f"Segment {self._segment_id} flushed in {time.time() - start_time}s")
             self._indexing_lock.release_write()
@@ -194,26 +257,86 @@ class Segment:
         self._flush_lock = ReadWriteLock()
         self._indexing_lock = ReadWriteLock()
         # this will load the index off disk
-        print(f"Loading index postings for segment {self._segment_id} from {self._postings_file}...", end="",
-              flush=True)
-        self._postings_index = Store(self._postings_file)
-        print("OK")
-        print(f"Loading index positions for segment {self._segment_id} from {self._positions_file}...", end="",
-              flush=True)
-        self._positions_index = Store(self._positions_file)
+        print(f"Loading index postings and positions for segment {self._segment_id} from {self._postings_file} and "
+              f"{self._positions_file}...", end="", flush=True)
+        self._open_terms()
         print("OK")
         print(f"Index loaded for {self._segment_id}")
         # load the doc values
         self._doc_values = {}
-        # for now we don't populate the cache
-        self._doc_value_cache = {}
+        self._doc_value_columns = {}
         for field, path in self._doc_value_fields.items():
-            self._doc_value_cache[field] = {}
             print(f"Loading field {field} in segment {self._segment_id}...")
-            self._doc_values[field] = Store(path)
+            self._doc_values[field] = MappedStore(path)
             print(f"Field {field} loaded for segment {self._segment_id} with {len(self._doc_values[field])} docs")
+        self._open_doc_value_columns()
         print(f"Segment {self._segment_id} loaded")
 
+    # opens the postings and positions of a flushed segment through a term dictionary shared by both files. Offsets can
+    # be passed from the stores which wrote the files, otherwise if the dictionary needs building (e.g. segments written
+    # before it existed) the files are scanned
+    def _open_terms(self, postings_offsets=None, positions_offsets=None):
+        dictionary_path = TermDictionary.path_for(os.path.splitext(self._postings_file)[0])
+        files = [self._postings_file, self._positions_file]
+        data_sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in files]
+        if not TermDictionary.is_valid(dictionary_path, data_sizes):
+            offsets = [postings_offsets, positions_offsets]
+            for i, path in enumerate(files):
+                if offsets[i] is None:
+                    store = MappedStore(path, index={})
+                    offsets[i] = store.scan_offsets()
+                    store.close()
+            TermDictionary.write(dictionary_path, offsets, data_sizes)
+        self._term_dictionary = TermDictionary(dictionary_path)
+        self._open_bloom_filter()
+        self._postings_index = MappedStore(self._postings_file, index=self._term_dictionary.column(0))
+        self._positions_index = MappedStore(self._positions_file, index=self._term_dictionary.column(1))
+
+    # loads the segment's bloom filter, building it from the term dictionary if missing e.g. segments written before it
+    # existed
+    def _open_bloom_filter(self):
+        bloom_path = BloomFilter.path_for(os.path.splitext(self._postings_file)[0])
+        if os.path.exists(bloom_path):
+            try:
+                bloom_filter = BloomFilter.read(bloom_path)
+                if bloom_filter.count == len(self._term_dictionary):
+                    self._bloom_filter = bloom_filter
+                    return
+            except ValueError as e:
+                print(f"Rebuilding bloom filter for segment {self._segment_id} - {e}")
+        self._bloom_filter = BloomFilter.from_terms(self._term_dictionary)
+        self._bloom_filter.write(bloom_path)
+
+    # loads the columnar doc values of each field, building them from the doc value stores if missing e.g. segments
+    # written before they existed
+    def _open_doc_value_columns(self):
+        for field, path in self._doc_value_fields.items():
+            column_path = DocValueColumn.path_for(path)
+            if os.path.exists(column_path):
+                try:
+                    column = DocValueColumn.read(column_path)
+                    if column.count == len(self._doc_values[field]):
+                        self._doc_value_columns[field] = column
+                        continue
+                except ValueError as e:
+                    print(f"Rebuilding doc values of {field} for segment {self._segment_id} - {e}")
+            items = ((doc_id, json.loads(values)) for doc_id, values in self._doc_values[field].items())
+            column = DocValueColumn.from_items(self._min_doc_id, self._max_doc_id, items)
+            column.write(column_path)
+            self._doc_value_columns[field] = column
+
+    def _evict_doc_values(self):
+        segment_id = self._segment_id
+        DOC_VALUE_CACHE.invalidate(lambda key: key[0] == segment_id)
+
+    # the columnar doc values of a field - None until the segment is flushed
+    def get_doc_value_column(self, field):
+        return self._doc_value_columns.get(field)
+
+    @property
+    def term_dictionary(self):
+        return self._term_dictionary
+
     def positions_items(self):
         if not self.is_flushed():
             # this would require unacceptable locking and likely not easily thread safe
@@ -222,6 +345,12 @@ class Segment:
         for term, posting in self._positions_index.items():
             yield term, TermPosting.from_store_format(posting)
 
+    # the positions of each term as stored i.e. encoded
+    def raw_positions_items(self):
+        if not self.is_flushed():
+            raise NotImplementedError("Can't iterate positions on non flushed segment")
+        return self._positions_index.items()
+
     def terms(self):
         if not self.is_flushed():
             # this would require unacceptable locking and likely not easily thread safe
@@ -243,111 +372,97 @@ class Segment:
             for doc_id, doc_value in doc_values.items():
                 yield field, doc_id, json.loads(doc_value)
 
+    # the doc values as stored i.e. encoded
+    def raw_doc_value_items(self):
+        for field, doc_values in self._doc_values.items():
+            for doc_id, doc_value in doc_values.items():
+                yield field, doc_id, doc_value
+
     # this closes the segment on shutdown
     def close(self):
         self._buffer.clear()
-        self._doc_value_cache.clear()
+        self._evict_doc_values()
+        self._doc_value_columns = {}
         self._postings_index.close()
         self._positions_index.close()
+        if self._term_dictionary is not None:
+            self._term_dictionary.close()
         for doc_values in self._doc_values.values():
             doc_values.close()
 
     # These methods support merging segments - no locking required - we assume this is called in a single thread with
     # no active reads of writing on it
 
-    # this merges two segments into this segment. We assume the segments are adjacent to each other i.e. doc ids are sequential
-    def merge(self, l_segment, r_segment):
+    # this merges segments into this segment in a single pass. We assume the segments are adjacent to each other and in
+    # doc id order i.e. doc ids are sequential
+    def merge(self, segments, rate_limiter=None):
         # set some meta on the segments - the doc id range in the new segment - segments are adjacent so we know they
         # cover the range entirely
-        min_id_l, max_id_l = l_segment.get_doc_id_range()
-        min_id_r, max_id_r = r_segment.get_doc_id_range()
-        self._min_doc_id = min(min_id_l, min_id_r)
-        self._max_doc_id = max(max_id_l, max_id_r)
-        self._merge_doc_ids(l_segment, r_segment)
-        self._merge_postings(l_segment, r_segment)
-        self._merge_positions(l_segment, r_segment)
-
-    def _merge_doc_ids(self, l_segment, r_segment):
+        doc_id_ranges = [segment.get_doc_id_range() for segment in segments]
+        self._min_doc_id = min(min_doc_id for min_doc_id, _ in doc_id_ranges)
+        self._max_doc_id = max(max_doc_id for _, max_doc_id in doc_id_ranges)
+        self._merge_doc_ids(segments, rate_limiter)
+        self._merge_terms(segments, rate_limiter)
+
+    # writes to a store of the merged segment, throttled by the rate limiter if any (see merge.py)
+    def _write_merged(self, store, key, value, rate_limiter):
+        store[key] = value
+        if rate_limiter is not None:
+            rate_limiter.pause(len(value))
+
+    def _merge_doc_ids(self, segments, rate_limiter):
         print(f"Merging doc ids into {self._segment_id}...")
-        l_iter = iter(l_segment.doc_value_items())
-        r_iter = iter(r_segment.doc_value_items())
-        # we rely on the left segment having lower doc ids than the right
-        for field, doc_id, doc_value in l_iter:
-            self._doc_values[field][doc_id] = json.dumps(doc_value)
-        for field, doc_id, doc_value in r_iter:
-            self._doc_values[field][doc_id] = json.dumps(doc_value)
+        # we rely on the segments being in doc id order - values are copied as is, without decoding
+        for segment in segments:
+            for field, doc_id, doc_value in segment.raw_doc_value_items():
+                self._write_merged(self._doc_values[field], doc_id, doc_value, rate_limiter)
         print(f"Doc ids merged")
 
-    # merge the postings together - note we skip the buffer as it is faster (given no seeking required)
-    def _merge_positions(self, l_segment, r_segment):
-        print(f"Merging positions into {self._segment_id}...")
-        # we know the terms will be in sorted order so we can linear merge these to avoid lots of seeking
-        l_iter = iter(l_segment.positions_items())
-        r_iter = iter(r_segment.positions_items())
-        left_term, left_posting = next(l_iter, (None, None))
-        right_term, right_posting = next(r_iter, (None, None))
-        while left_term and right_term:
-            if left_term < right_term:
-                self._positions_index[left_term] = left_posting.to_store_format()
-                left_term, left_posting = next(l_iter, (None, None))
-            elif left_term > right_term:
-                self._positions_index[right_term] = right_posting.to_store_format()
-                right_term, right_posting = next(r_iter, (None, None))
-            else:
-                # no need to update skips as they are generated on store
-                left_posting.add_term_info(right_posting)
-                self._positions_index[left_term] = left_posting.to_store_format()
-                left_term, left_posting = next(l_iter, (None, None))
-                right_term, right_posting = next(r_iter, (None, None))
-        if left_term:
-            self._positions_index[left_term] = left_posting.to_store_format()
-            for left_term, left_posting in l_iter:
-                self._positions_index[left_term] = left_posting.to_store_format()
-        if right_term:
-            self._positions_index[right_term] = right_posting.to_store_format()
-            for right_term, right_posting in r_iter:
-                self._positions_index[right_term] = right_posting.to_store_format()
-        print(f"Positions merged")
-
-    def _merge_postings(self, l_segment, r_segment):
-        print(f"Merging postings into {self._segment_id}...")
-        # we know the terms will be in sorted order so we can linear merge these to avoid lots of seeking
-        l_iter = iter(l_segment.postings_items())
-        r_iter = iter(r_segment.postings_items())
-        left_term, left_posting = next(l_iter, (None, None))
-        right_term, right_posting = next(r_iter, (None, None))
-        while left_term and right_term:
-            if left_term < right_term:
-                self._postings_index[left_term] = left_posting.to_store_format(with_positions=False)
-                left_term, left_posting = next(l_iter, (None, None))
-            elif left_term > right_term:
-                self._postings_index[right_term] = right_posting.to_store_format(with_positions=False)
-                right_term, right_posting = next(r_iter, (None, None))
-            else:
-                # no need to update skips as they are generated on store
-                left_posting.add_term_info(right_posting)
-                self._postings_index[left_term] = left_posting.to_store_format(with_positions=False)
-                left_term, left_posting = next(l_iter, (None, None))
-                right_term, right_posting = next(r_iter, (None, None))
-        if left_term:
-            self._postings_index[left_term] = left_posting.to_store_format(with_positions=False)
-            for left_term, left_posting in l_iter:
-                self._postings_index[left_term] = left_posting.to_store_format(with_positions=False)
-        if right_term:
-            self._postings_index[right_term] = right_posting.to_store_format(with_positions=False)
-            for right_term, right_posting in r_iter:
-                self._postings_index[right_term] = right_posting.to_store_format(with_positions=False)
-        print(f"Postings merged")
+    # k-way merge of the terms of the segments with a heap - terms are in sorted order in each segment so each is read
+    # once, in order. The positions are read and the postings derived from them, so the postings files aren't read.
+    # Postings of a term in several segments are concatenated in segment (and so doc id) order
+    def _merge_terms(self, segments, rate_limiter):
+        print(f"Merging postings and positions of {len(segments)} segments into {self._segment_id}...")
+        # (term, segment position) is unique so the postings are never compared
+        streams = [_with_position(segment.raw_positions_items(), i) for i, segment in enumerate(segments)]
+        current_term = None
+        term_postings = []
+        for term, _, posting in heapq.merge(*streams):
+            if term != current_term and term_postings:
+                self._write_merged_term(current_term, term_postings, rate_limiter)
+                term_postings = []
+            current_term = term
+            term_postings.append(posting)
+        if term_postings:
+            self._write_merged_term(current_term, term_postings, rate_limiter)
+        print(f"Postings and positions merged")
+
+    # term_postings are the encoded positions of the term in each segment it occurs in
+    def _write_merged_term(self, term, term_postings, rate_limiter):
+        if all(codec.is_raw_mergeable(term_posting) for term_posting in term_postings):
+            # copy the encoded blocks as is - only the skip table of the term is rewritten
+            positions = bytes(term_postings[0]) if len(term_postings) == 1 else codec.concatenate(term_postings)
+            postings = codec.strip_positions(positions)
+        else:
+            # older formats are decoded and re-encoded - no need to update skips as they are generated on store
+            term_posting = TermPosting.merge([TermPosting.from_store_format(term_posting) for term_posting in
+                                              term_postings])
+            positions = term_posting.to_binary_format()
+            postings = term_posting.to_binary_format(with_positions=False)
+        self._write_merged(self._positions_index, term, positions, rate_limiter)
+        self._write_merged(self._postings_index, term, postings, rate_limiter)
 
     def get_doc_id_range(self):
         return self._min_doc_id, self._max_doc_id
 
     def delete(self):
         self.close()
-        if os.path.exists(self._positions_file):
-            os.remove(self._positions_file)
-        if os.path.exists(self._postings_file):
-            os.remove(self._postings_file)
-        for path in self._doc_value_fields.values():
-            if os.path.exists(path):
-                os.remove(path)
+        for path in [self._positions_file, self._postings_file] + list(self._doc_value_fields.values()):
+            # remove the store, its offset index and doc value column
+            for file_path in [path, OffsetIndex.path_for(path), DocValueColumn.path_for(path)]:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        segment_path = os.path.splitext(self._postings_file)[0]
+        for file_path in [TermDictionary.path_for(segment_path), BloomFilter.path_for(segment_path)]:
+            if os.path.exists(file_path):
+                os.remove(file_path)
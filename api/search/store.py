@@ -2,7 +2,10 @@ import ujson as json
 import io
 import os.path
 import bisect
+import mmap
+import struct
 
+import lmdb
 from lmdbm import Lmdb
 
 from search.exception import StoreException
@@ -23,25 +26,47 @@ class DocumentStore(Lmdb):
     def _post_value(self, value):
         return json.loads(value.decode("utf-8"))
 
+    # a store opened read only by a reader process sees the map grow as the writer adds docs - adopt the new size
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except lmdb.MapResizedError:
+            self.env.set_mapsize(0)
+            return super().__getitem__(key)
+
 
 # Our dictionary store on disk. Only thread safe on gets NOT on writes or iteration!
+# Two formats are supported. v1 stores each key and value as a line of text. v2 (binary=True) stores length prefixed
+# records, allowing arbitrary bytes as values - see codec.py. The format of an existing file is detected on open.
 class Store(dict):
     START_FLAG = b'# FILE-DICT v1\n'
+    BINARY_START_FLAG = b'# FILE-DICT v2\n'
+    # key length, value length
+    RECORD_HEADER = struct.Struct('<II')
 
-    def __init__(self, path):
+    def __init__(self, path, binary=False):
         self.path = path
 
         if os.path.exists(path):
             file = io.open(path, 'r+b')
+            binary = file.read(len(self.BINARY_START_FLAG)) == self.BINARY_START_FLAG
+            file.seek(0)
         else:
             file = io.open(path, 'w+b')
-            file.write(self.START_FLAG)
+            file.write(self.BINARY_START_FLAG if binary else self.START_FLAG)
             file.flush()
 
         self._file = file
+        self.binary = binary
         self._offsets = {}  # the (size, offset) of the lines, where size is in bytes, including the trailing \n
         self._free_lines = []
 
+        if binary:
+            # for binary stores offsets are the (offset, length) of the value
+            for key, offset, length in self._scan_records():
+                self._offsets[key] = (offset, length)
+            return
+
         offset = 0
         while True:
             line = file.readline()
@@ -65,6 +90,22 @@ class Store(dict):
 
         self._free_lines.sort()
 
+    # iterates the binary records as (key, value offset, value length) - stops at a partially written record
+    def _scan_records(self):
+        end = self._file.seek(0, os.SEEK_END)
+        offset = len(self.BINARY_START_FLAG)
+        while offset + self.RECORD_HEADER.size <= end:
+            # if something was read/written while iterating, the stream might be positioned elsewhere
+            if self._file.tell() != offset:
+                self._file.seek(offset)
+            key_length, value_length = self.RECORD_HEADER.unpack(self._file.read(self.RECORD_HEADER.size))
+            value_offset = offset + self.RECORD_HEADER.size + key_length
+            if value_offset + value_length > end:
+                break
+            key = json.loads(self._file.read(key_length))
+            yield key, value_offset, value_length
+            offset = value_offset + value_length
+
     def parse_line(self, line):
         (left, sep, right) = line.partition(b'\t')
         term = json.loads(left)
@@ -105,6 +146,9 @@ class Store(dict):
     def __getitem__(self, key):
         offset = self._offsets[key]
         with open(self.path, 'r+b') as reader:
+            if self.binary:
+                reader.seek(offset[0])
+                return reader.read(offset[1])
             reader.seek(offset)
             line = reader.readline()
             return self.parse_value(line)
@@ -113,6 +157,17 @@ class Store(dict):
         if key in self._offsets:
             raise StoreException("Store is append only")
 
+        if self.binary:
+            key_bytes = json.dumps(key, ensure_ascii=False).encode('UTF-8')
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(self.RECORD_HEADER.pack(len(key_bytes), len(value)))
+            self._file.write(key_bytes)
+            self._file.write(value)
+            self._file.flush()
+            # a partially written record is ignored on load so no need for the comment trick used below
+            self._offsets[key] = (offset + self.RECORD_HEADER.size + len(key_bytes), len(value))
+            return
+
         # we have a value we need to store
         line = f"{json.dumps(key, ensure_ascii=False)}\t{value}\n"
         line = line.encode('UTF-8')
@@ -136,6 +191,8 @@ class Store(dict):
         self._offsets[key] = offset
 
     def __delitem__(self, key):
+        if self.binary:
+            raise StoreException("Binary store is append only")
         offset = self._offsets[key]
         self._freeLine(offset)
         del self._offsets[key]
@@ -151,12 +208,19 @@ class Store(dict):
 
     def clear(self):
         self._file.truncate(0)
+        self._file.seek(0)
+        self._file.write(self.BINARY_START_FLAG if self.binary else self.START_FLAG)
         self._file.flush()
         self._offsets = {}
         self._free_lines = []
 
     # THIS IS NOT THREAD SAFE
     def items(self):
+        if self.binary:
+            for key, offset, length in self._scan_records():
+                self._file.seek(offset)
+                yield key, self._file.read(length)
+            return
         offset = 0
         while True:
             # if something was read/written while iterating, the stream might be positioned elsewhere
@@ -186,11 +250,224 @@ class Store(dict):
     def size(self):
         self._file.size()
 
+    # closes the store to writes, returning the (offset, length) of the values for binary stores. Text offsets don't
+    # hold the line lengths so None is returned - readers have to scan
+    def seal(self):
+        self._file.close()
+        return self._offsets if self.binary else None
+
+    # closes the store to writes, returning a read only memory mapped view of it - used once a segment is flushed
+    def to_reader(self):
+        return MappedStore(self.path, offsets=self.seal())
+
     def close(self):
         self._file.close()
         print(f"Closed store '{self.path}' with {len(self)} items'")
 
 
+# A persistent sorted key -> (offset, length) index for a store file, written next to it as <path>.idx. This allows
+# a flushed store to be opened without scanning the whole file and holding every key in memory - the index is
+# memory mapped and keys located with a binary search. Keys are sorted by their encoded (json) bytes. Layout:
+#
+#   <flag><data file size:Q><count:I>
+#   key offsets (count + 1) * I, value offsets count * Q, value lengths count * I, keys blob
+class OffsetIndex:
+    START_FLAG = b'# FILE-IDX v1\n'
+    HEADER = struct.Struct('<QI')
+
+    def __init__(self, path):
+        self.path = path
+        with io.open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        offset = len(self.START_FLAG)
+        self.data_size, self._count = self.HEADER.unpack_from(self._map, offset)
+        offset += self.HEADER.size
+        # casts give fast access to the arrays as python ints without copying
+        self._key_offsets = view[offset:offset + (self._count + 1) * 4].cast('I')
+        offset += (self._count + 1) * 4
+        self._value_offsets = view[offset:offset + self._count * 8].cast('Q')
+        offset += self._count * 8
+        self._value_lengths = view[offset:offset + self._count * 4].cast('I')
+        self._keys_start = offset + self._count * 4
+
+    @staticmethod
+    def path_for(path):
+        return f"{path}.idx"
+
+    @staticmethod
+    def encode_key(key):
+        return json.dumps(key, ensure_ascii=False).encode('UTF-8')
+
+    @staticmethod
+    def write(path, data_size, offsets):
+        entries = sorted((OffsetIndex.encode_key(key), offset, length) for key, (offset, length) in offsets.items())
+        key_offsets = [0]
+        for key_bytes, _, _ in entries:
+            key_offsets.append(key_offsets[-1] + len(key_bytes))
+        # written to a temp file first so a partial index is never loaded
+        with io.open(f"{path}.tmp", 'wb') as file:
+            file.write(OffsetIndex.START_FLAG)
+            file.write(OffsetIndex.HEADER.pack(data_size, len(entries)))
+            file.write(struct.pack(f'<{len(key_offsets)}I', *key_offsets))
+            file.write(struct.pack(f'<{len(entries)}Q', *[entry[1] for entry in entries]))
+            file.write(struct.pack(f'<{len(entries)}I', *[entry[2] for entry in entries]))
+            file.write(b''.join(entry[0] for entry in entries))
+        os.replace(f"{path}.tmp", path)
+
+    def _key(self, i):
+        return self._map[self._keys_start + self._key_offsets[i]:self._keys_start + self._key_offsets[i + 1]]
+
+    def _find(self, key):
+        key_bytes = self.encode_key(key)
+        low = 0
+        high = self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < key_bytes:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._count and self._key(low) == key_bytes:
+            return low
+        return -1
+
+    def __getitem__(self, key):
+        i = self._find(key)
+        if i == -1:
+            raise KeyError(key)
+        return self._value_offsets[i], self._value_lengths[i]
+
+    def __contains__(self, key):
+        return self._find(key) != -1
+
+    def keys(self):
+        for i in range(self._count):
+            yield json.loads(self._key(i))
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._key_offsets.release()
+        self._value_offsets.release()
+        self._value_lengths.release()
+        self._map.close()
+
+
+# A read only view of a Store file for flushed (immutable) segments. The file is memory mapped once - lookups do not
+# open the file or seek, binary values are returned as memoryview slices over the map without copying. Unlike Store,
+# iteration does not use a shared file cursor so this is thread safe for all reads e.g. a merge and queries reading
+# the same store concurrently.
+class MappedStore:
+
+    def __init__(self, path, offsets=None, index=None):
+        self.path = path
+        self._map = None
+        self._view = None
+        self.binary = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with io.open(path, 'rb') as file:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+            self.binary = self._map[0:len(Store.BINARY_START_FLAG)] == Store.BINARY_START_FLAG
+        self.data_size = 0 if self._map is None else len(self._map)
+        # an index can be shared across stores e.g. the term dictionary for the postings and positions files. This
+        # is then owned (and closed) by the caller
+        self._owns_index = index is None
+        if index is not None:
+            self._offsets = index
+            return
+        # the (offset, length) of the values are read from the sidecar index if we have one. Otherwise, e.g. for
+        # segments written before the index existed or on flush, we build it. Offsets can be passed from the Store
+        # which wrote the file to avoid re-scanning it
+        index_path = OffsetIndex.path_for(path)
+        data_size = self.data_size
+        if os.path.exists(index_path):
+            self._offsets = OffsetIndex(index_path)
+            if self._offsets.data_size == data_size:
+                return
+            # stale index
+            self._offsets.close()
+        if offsets is None:
+            offsets = self.scan_offsets()
+        OffsetIndex.write(index_path, data_size, offsets)
+        self._offsets = OffsetIndex(index_path)
+
+    # iterates (key, offset, length) - for text stores the offset is the start of the line and length its size
+    def _scan(self):
+        if self._map is None:
+            return
+        end = len(self._map)
+        if self.binary:
+            offset = len(Store.BINARY_START_FLAG)
+            while offset + Store.RECORD_HEADER.size <= end:
+                key_length, value_length = Store.RECORD_HEADER.unpack_from(self._map, offset)
+                value_offset = offset + Store.RECORD_HEADER.size + key_length
+                if value_offset + value_length > end:
+                    # partially written record
+                    break
+                yield json.loads(self._map[value_offset - key_length:value_offset]), value_offset, value_length
+                offset = value_offset + value_length
+            return
+        offset = 0
+        while offset < end:
+            line_end = self._map.find(b'\n', offset)
+            line_end = end if line_end == -1 else line_end + 1
+            # ignore empty and commented lines
+            if self._map[offset] != 35 and line_end - offset > 1:
+                (left, sep, right) = self._map[offset:line_end].partition(b'\t')
+                yield json.loads(left), offset, line_end - offset
+            offset = line_end
+
+    # the (offset, length) of every value by scanning the file
+    def scan_offsets(self):
+        return {key: (offset, length) for key, offset, length in self._scan()}
+
+    def _read(self, offset, length):
+        if self.binary:
+            return self._view[offset:offset + length]
+        (left, sep, right) = self._map[offset:offset + length].partition(b'\t')
+        return right.decode('utf-8').strip()
+
+    def __getitem__(self, key):
+        offset, length = self._offsets[key]
+        return self._read(offset, length)
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def items(self):
+        for key, offset, length in self._scan():
+            yield key, self._read(offset, length)
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def values(self):
+        for item in self.items():
+            yield item[1]
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def close(self):
+        if self._owns_index:
+            self._offsets.close()
+        if self._map is not None:
+            try:
+                self._view.release()
+                self._map.close()
+            except BufferError:
+                # slices are still held by a reader e.g. a query running during a merge. The map is closed when they
+                # are garbage collected
+                pass
+        print(f"Closed store '{self.path}' with {len(self)} items'")
+
+
 class List(list):
     START_FLAG = b'# FILE-LIST v1\n'
 
@@ -0,0 +1,146 @@
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# Pre-forking server. A master process forks one writer process, which owns the index and is the only process that
+# indexes, flushes and merges, and API_WORKERS reader processes which serve queries over the same index directory.
+# Flushed segments are immutable and memory mapped so the readers share their pages through the page cache rather than
+# each holding a copy. After a flush or merge the writer signals the master (SIGUSR1), which signals the readers to
+# refresh their list of segments from the state file (see Index.refresh). The writer listens on API_PORT and reader i on
+# API_PORT + i - nginx.conf balances queries across the readers. Children which die are restarted. The app_server
+# upstream of nginx.conf lists the readers of the default 2 workers - with more or fewer, list a server per reader.
+#
+#   API_WORKERS=2 python serve.py
+
+WORKERS = int(os.getenv("API_WORKERS", 2))
+HOST = os.getenv("API_HOST", "127.0.0.1")
+PORT = int(os.getenv("API_PORT", 5000))
+# seconds children are given to close the index on shutdown
+STOP_TIMEOUT = 60
+
+_readers = {}
+_writer_ready = threading.Event()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+# SIGUSR1 from the writer - ready or segments changed
+def _on_segments_changed(signum, frame):
+    _writer_ready.set()
+    for pid in list(_readers):
+        try:
+            os.kill(pid, signal.SIGUSR1)
+        except ProcessLookupError:
+            pass
+
+
+def _refresh(index, pending):
+    while True:
+        pending.wait()
+        pending.clear()
+        try:
+            index.refresh()
+        except Exception:
+            # a merge may have replaced the segments whilst refreshing - the writer signals us again
+            traceback.print_exc()
+
+
+def _run_server(role, port):
+    # a refresh signalled before the index is loaded must not kill us - it is picked up once loaded
+    pending = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: pending.set())
+    signal.signal(signal.SIGTERM, _interrupt)
+    signal.signal(signal.SIGINT, _interrupt)
+    os.environ["INDEX_ROLE"] = role
+    os.environ["INDEX_NOTIFY_PID"] = str(os.getppid())
+    # the index is only loaded after the fork - nothing is shared with the master other than the files
+    import api
+    from cheroot.wsgi import Server as WSGIServer
+    from cheroot.wsgi import PathInfoDispatcher as WSGIPathInfoDispatcher
+    if role == "reader":
+        threading.Thread(target=_refresh, args=(api.index, pending), name="refresh", daemon=True).start()
+    else:
+        os.kill(os.getppid(), signal.SIGUSR1)
+    server = WSGIServer((HOST, port), WSGIPathInfoDispatcher({'/': api.app}))
+    print(f"Running {role} process {os.getpid()} on {HOST}:{port}")
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def _fork(role, port):
+    pid = os.fork()
+    if pid > 0:
+        return pid
+    code = 0
+    try:
+        _run_server(role, port)
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    # the exit handlers of the api close the index - the writer saves it, so don't interrupt them
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.exit(code)
+
+
+def _start_writer():
+    _writer_ready.clear()
+    pid = _fork("writer", PORT)
+    # readers load the index from the files of the writer so wait for it to load
+    while not _writer_ready.wait(1):
+        if os.waitpid(pid, os.WNOHANG)[0] != 0:
+            print("Writer failed to start")
+            sys.exit(1)
+    return pid
+
+
+def _stop_children(writer):
+    # readers first so the writer saves the index last
+    for pids in [list(_readers), [writer]]:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.time() + STOP_TIMEOUT
+        for pid in pids:
+            try:
+                while os.waitpid(pid, os.WNOHANG)[0] == 0 and time.time() < deadline:
+                    time.sleep(0.1)
+            except ChildProcessError:
+                pass
+
+
+def main():
+    signal.signal(signal.SIGUSR1, _on_segments_changed)
+    signal.signal(signal.SIGTERM, _interrupt)
+    writer = _start_writer()
+    for i in range(1, WORKERS + 1):
+        _readers[_fork("reader", PORT + i)] = PORT + i
+    print(f"Serving with writer {writer} and readers {', '.join(str(pid) for pid in _readers)}")
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid == writer:
+                print(f"Writer {pid} exited with status {status} - restarting")
+                writer = _start_writer()
+            elif pid in _readers:
+                port = _readers.pop(pid)
+                print(f"Reader {pid} exited with status {status} - restarting")
+                _readers[_fork("reader", port)] = port
+    except KeyboardInterrupt:
+        print("Stopping...")
+        _stop_children(writer)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import random
+
+import pytest
+
+import search.index as index_module
+from search.analyzer import Analyzer
+from search.cache import LRUCache
+from search.index import Index
+from search.models import Document, Filter, Search
+
+# Behaviour of the LRU cache (user-011) and the caches of the index built on it - filter doc sets (user-010), decoded
+# postings (user-012) and results (user-014) - which must never serve the segments or docs of before a merge or an add.
+# Invalidation on refresh is covered by test_refresh.py. Run from the api directory with python -m pytest
+
+WORDS = ['w1x', 'w2x', 'w3x', 'w4x', 'w5x', 'w6x']
+SUBJECTS = ['Robotics', 'Cryptography', 'Machine Learning']
+
+
+def test_least_recently_used_are_evicted():
+    cache = LRUCache(100)
+    for key in 'abcd':
+        cache.put(key, key.upper(), 25)
+    # a read makes an entry the most recently used
+    assert cache.get('a') == 'A'
+    cache.put('e', 'E', 30)
+    assert [key for key, _ in cache.items()] == ['d', 'a', 'e']
+    assert cache.get('b') is None
+    # replacing an entry replaces its size
+    cache.put('d', 'D', 5)
+    cache.put('f', 'F', 30)
+    assert [key for key, _ in cache.items()] == ['a', 'e', 'd', 'f']
+    # values larger than the cache are never cached
+    cache.put('g', 'G', 101)
+    assert cache.get('g') is None
+    assert len(cache) == 4
+    stats = cache.stats()
+    assert stats['bytes'] == 90
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 2, 2)
+    assert stats['hit_ratio'] == pytest.approx(1 / 3)
+
+
+def test_resize_and_invalidate():
+    cache = LRUCache(100)
+    for i in range(10):
+        cache.put(('segment-1' if i % 2 else 'segment-2', i), i, 10)
+    cache.resize(50)
+    assert [key[1] for key, _ in cache.items()] == [5, 6, 7, 8, 9]
+    cache.invalidate(lambda key: key[0] == 'segment-1')
+    assert [key[1] for key, _ in cache.items()] == [6, 8]
+    assert cache.stats()['bytes'] == 20
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['bytes'] == 0
+
+
+class _NoModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        pass
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _NoModel)
+    index = Index(str(tmp_path), Analyzer([], True), doc_value_fields=['subject'], search_threads=None)
+    index.load()
+    rnd = random.Random(9)
+    for batch in range(3):
+        index.add_documents([Document(f"doc-{batch}-{i}", {'title': ' '.join(rnd.choices(WORDS, k=rnd.randint(2, 8))),
+                                                           'subject': [SUBJECTS[i % len(SUBJECTS)]]})
+                             for i in range(60)])
+        index.save()
+    yield index
+    index.close()
+
+
+SEARCH = Search('w1x OR w2x', True, 10, 0, filters=[Filter('subject', 'Robotics')], use_hnsw=False)
+
+
+def _ids(results):
+    return [(hit.id, round(hit.score, 6)) for hit in results[0]], results[2]
+
+
+def _cached_segment_ids(cache):
+    return set(key[0] for key, _ in cache.items())
+
+
+def test_caches_are_invalidated_by_merge(index):
+    expected = _ids(index.search(SEARCH))
+    segment_ids = set(segment.segment_id for segment in index._segments)
+    assert _cached_segment_ids(index._filter_cache) == segment_ids
+    assert _cached_segment_ids(index._posting_cache) == segment_ids
+    # a repeated search is served from the result cache without reading the segments
+    posting_stats = index._posting_cache.stats()
+    assert _ids(index.search(SEARCH)) == expected
+    assert index._result_cache.stats()['hits'] == 1
+    assert index._posting_cache.stats() == posting_stats
+    index.optimize(target_segments=1)
+    assert not (_cached_segment_ids(index._filter_cache) | _cached_segment_ids(index._posting_cache)) & segment_ids
+    assert _ids(index.search(SEARCH)) == expected
+    assert index._result_cache.stats()['hits'] == 1
+    assert _cached_segment_ids(index._filter_cache) == {index._segments[0].segment_id}
+
+
+def test_result_cache_sees_added_docs(index):
+    _, total = _ids(index.search(SEARCH))
+    index.add_documents([Document(f"new-{i}", {'title': 'w1x w2x', 'subject': ['Robotics']}) for i in range(3)])
+    # searched from the open segment before it is flushed
+    assert _ids(index.search(SEARCH))[1] == total + 3
+    index.save()
+    assert _ids(index.search(SEARCH))[1] == total + 3
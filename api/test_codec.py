@@ -0,0 +1,191 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+import search.index as index_module
+from search import codec
+from search.analyzer import Analyzer
+from search.bloom import BloomFilter
+from search.dictionary import TermDictionary
+from search.index import Index
+from search.models import Document, Search
+from search.posting import TermPosting
+from search.store import MappedStore, OffsetIndex, Store
+
+# Behaviour of the binary posting format (user-001) - encoding round trips, combining encoded terms without decoding
+# them for merges (user-017) and reading segments written in the old text format. Run from the api directory with
+# python -m pytest
+
+WORDS = ['w1x', 'w2x', 'w3x', 'w4x', 'w5x', 'w6x']
+
+
+class _NoModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_model(monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _NoModel)
+
+
+# the postings of a term over num_docs docs from first_doc - doc gaps, frequencies and positions of varying widths
+def _postings(num_docs, first_doc=1, seed=0):
+    rnd = np.random.RandomState(seed)
+    doc_ids = first_doc + np.cumsum(rnd.randint(1, 300, num_docs)) - 1
+    frequencies = rnd.randint(1, 20, num_docs)
+    positions = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                               [np.sort(rnd.choice(5000, frequency, replace=False)) for frequency in frequencies])
+    return doc_ids, frequencies, positions
+
+
+@pytest.mark.parametrize('num_docs', [0, 1, codec.BLOCK_SIZE, 300])
+def test_round_trip(num_docs):
+    doc_ids, frequencies, positions = _postings(num_docs)
+    buffer = codec.encode(doc_ids, frequencies, positions=positions, collection_frequency=int(frequencies.sum()),
+                          first_occurrence='Größe')
+    header, decoded_doc_ids, decoded_frequencies, decoded_positions = codec.decode(buffer)
+    np.testing.assert_array_equal(decoded_doc_ids, doc_ids)
+    np.testing.assert_array_equal(decoded_frequencies, frequencies)
+    np.testing.assert_array_equal(decoded_positions, positions)
+    assert header.first_occurrence == 'Größe'
+    assert header.doc_frequency == num_docs
+    assert header.collection_frequency == frequencies.sum()
+    assert header.max_frequency == (frequencies.max() if num_docs > 0 else 0)
+    assert len(header.skips) == (num_docs + codec.BLOCK_SIZE - 1) // codec.BLOCK_SIZE
+    # the skip table points at the last doc of each block
+    np.testing.assert_array_equal(header.skips['last_doc'], doc_ids[codec.BLOCK_SIZE - 1::codec.BLOCK_SIZE].tolist() +
+                                  ([doc_ids[-1]] if num_docs % codec.BLOCK_SIZE else []))
+    assert codec.decode(buffer, with_positions=False)[3] is None
+
+
+def test_postings_without_positions_are_stripped_encoding():
+    doc_ids, frequencies, positions = _postings(300)
+    with_positions = codec.encode(doc_ids, frequencies, positions=positions, first_occurrence='term')
+    assert codec.strip_positions(with_positions) == codec.encode(doc_ids, frequencies, first_occurrence='term')
+
+
+def test_concatenate_matches_decoded_postings():
+    parts = [_postings(300, 1, 0), _postings(5, 100000, 1), _postings(200, 200000, 2)]
+    buffers = [codec.encode(doc_ids, frequencies, positions=positions, collection_frequency=int(frequencies.sum()))
+               for doc_ids, frequencies, positions in parts]
+    assert all(codec.is_raw_mergeable(buffer) for buffer in buffers)
+    combined = codec.concatenate(buffers)
+    header, doc_ids, frequencies, positions = codec.decode(combined)
+    for decoded, i in ((doc_ids, 0), (frequencies, 1), (positions, 2)):
+        np.testing.assert_array_equal(decoded, np.concatenate([part[i] for part in parts]))
+    assert header.doc_frequency == len(doc_ids)
+    assert header.collection_frequency == frequencies.sum()
+    assert header.max_frequency == frequencies.max()
+    # every block of every part is kept as is
+    assert len(header.skips) == sum(len(codec.TermHeader(buffer).skips) for buffer in buffers)
+    assert codec.strip_positions(combined) == codec.concatenate([codec.strip_positions(buffer) for buffer in buffers])
+
+
+def _term_posting(doc_positions, first_occurrence=None):
+    term_posting = TermPosting(first_occurrence=first_occurrence)
+    for doc_id, positions in doc_positions:
+        for position in positions:
+            term_posting.add_position(doc_id, position)
+    return term_posting
+
+
+def _as_lists(term_posting, with_positions=True):
+    return [(posting.doc_id, posting.frequency, list(posting.positions) if with_positions else None)
+            for posting in term_posting.postings]
+
+
+def test_text_format_reads_as_binary():
+    doc_positions = [(doc_id, sorted(random.Random(doc_id).sample(range(100), doc_id % 5 + 1)))
+                     for doc_id in range(3, 400, 7)]
+    term_posting = _term_posting(doc_positions, first_occurrence='Robots')
+    assert not codec.is_raw_mergeable(term_posting.to_store_format())
+    for with_positions in (True, False):
+        text = TermPosting.from_store_format(term_posting.to_store_format(with_positions=with_positions),
+                                             with_positions=with_positions)
+        binary = TermPosting.from_store_format(term_posting.to_binary_format(with_positions=with_positions),
+                                               with_positions=with_positions)
+        assert _as_lists(text, with_positions) == _as_lists(binary, with_positions)
+        assert text.collection_frequency == binary.collection_frequency == term_posting.collection_frequency
+        assert text.first_occurrence == binary.first_occurrence == 'Robots'
+
+
+def test_text_store_is_read_through_offset_index(tmp_path):
+    path = str(tmp_path / 'positions.dat')
+    store = Store(path)
+    expected = {}
+    for i, term in enumerate(WORDS):
+        expected[term] = _term_posting([(doc_id, [doc_id % 3, 10 + i]) for doc_id in range(1, 50, i + 1)])
+        store[term] = expected[term].to_store_format()
+    store.close()
+    # the sidecar offset index is built on first open
+    assert not os.path.exists(OffsetIndex.path_for(path))
+    reader = MappedStore(path)
+    assert os.path.exists(OffsetIndex.path_for(path))
+    assert not reader.binary
+    assert sorted(reader.keys()) == sorted(WORDS)
+    for term, term_posting in expected.items():
+        assert _as_lists(TermPosting.from_store_format(reader[term])) == _as_lists(term_posting)
+    assert 'w9x' not in reader
+    reader.close()
+
+
+def _open(path):
+    index = Index(str(path), Analyzer([], True), search_threads=None)
+    index.load()
+    return index
+
+
+def _results(index):
+    results = []
+    for query in ('w1x', 'w1x OR w5x', 'w2x AND w3x', '"w1x w2x"', 'NOT w4x'):
+        hits, _, total, _ = index._search(Search(query, True, 1000, 0, use_hnsw=False))
+        results.append(([(hit.id, round(hit.score, 6)) for hit in hits], total))
+    return results
+
+
+# rewrites the postings and positions of a flushed segment in the text format, as written before the binary format,
+# removing the files derived from them
+def _to_text_format(segment):
+    for path, with_positions in ((segment._positions_file, True), (segment._postings_file, False)):
+        reader = MappedStore(path, index={})
+        values = {term: TermPosting.from_store_format(value, with_positions=with_positions)
+                  for term, value in reader.items()}
+        reader.close()
+        os.remove(path)
+        if os.path.exists(OffsetIndex.path_for(path)):
+            os.remove(OffsetIndex.path_for(path))
+        store = Store(path)
+        for term, term_posting in values.items():
+            store[term] = term_posting.to_store_format(with_positions=with_positions)
+        store.close()
+    segment_path = os.path.splitext(segment._postings_file)[0]
+    os.remove(TermDictionary.path_for(segment_path))
+    os.remove(BloomFilter.path_for(segment_path))
+
+
+def test_old_text_segments_are_searched_and_merged(tmp_path):
+    rnd = random.Random(3)
+    index = _open(tmp_path)
+    for batch in range(3):
+        index.add_documents([Document(f"doc-{batch}-{i}", {'title': ' '.join(rnd.choices(WORDS, k=rnd.randint(2, 9)))})
+                             for i in range(50)])
+        index.save()
+    expected = _results(index)
+    old_segments = index._segments[:2]
+    index.close()
+    for segment in old_segments:
+        _to_text_format(segment)
+    index = _open(tmp_path)
+    try:
+        assert isinstance(index._segments[0]._positions_index['w1x'], str)
+        assert _results(index) == expected
+        # text and binary segments are merged by decoding the text ones
+        index.optimize(target_segments=1)
+        assert isinstance(index._segments[0]._positions_index['w1x'], memoryview)
+        assert _results(index) == expected
+    finally:
+        index.close()
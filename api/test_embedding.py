@@ -0,0 +1,153 @@
+import hashlib
+import threading
+
+import numpy as np
+import pytest
+
+import search.index as index_module
+from search.analyzer import Analyzer
+from search.embedding import EmbeddingBatcher, EmbeddingCache
+from search.index import Index, VECTOR_DIMENSIONS
+
+# Behaviour of query embedding - the batcher (user-021) and the cache of query vectors (user-022). Run from the api
+# directory with python -m pytest
+
+
+# a vector per text and backend from their hash, so queries embed without the BERT model. Forward passes are counted
+class _HashModel:
+    passes = []
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        self.backend = backend
+
+    def embed(self, text, sentwise=True):
+        seed = int(hashlib.md5(f"{self.backend}:{text}".encode()).hexdigest()[:8], 16)
+        return np.random.RandomState(seed).uniform(-1, 1, VECTOR_DIMENSIONS).astype(np.float32)
+
+    def embed_batch(self, texts):
+        _HashModel.passes.append((self.backend, list(texts)))
+        return [self.embed(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def hash_model(monkeypatch):
+    _HashModel.passes = []
+    monkeypatch.setattr(index_module, 'BERTModule', _HashModel)
+
+
+def _open(path, backend):
+    index = Index(str(path), Analyzer([], True), search_threads=None, persist_embeddings=True,
+                  vector_backend=backend)
+    index.load()
+    return index
+
+
+def test_saved_query_vectors_are_kept_per_backend(tmp_path):
+    index = _open(tmp_path, 'fp32')
+    fp32 = index.embed_query('robot arms')
+    index.close()
+    assert _HashModel.passes == [('fp32', ['robot arms'])]
+    # the vectors saved by fp32 aren't served by int8
+    index = _open(tmp_path, 'int8')
+    int8 = index.embed_query('robot arms')
+    index.close()
+    assert _HashModel.passes[1:] == [('int8', ['robot arms'])]
+    assert not np.array_equal(fp32, int8)
+    # each backend loads its own vectors
+    for backend, expected in (('fp32', fp32), ('int8', int8)):
+        index = _open(tmp_path, backend)
+        np.testing.assert_array_equal(index.embed_query('Robot  ARMS'), expected)
+        index.close()
+    assert len(_HashModel.passes) == 2
+
+
+def _embed_concurrently(batcher, texts):
+    vectors = {}
+    errors = {}
+    start = threading.Barrier(len(texts))
+
+    def embed(text):
+        start.wait()
+        try:
+            vectors[text] = batcher.embed(text)
+        except Exception as e:
+            errors[text] = e
+
+    threads = [threading.Thread(target=embed, args=(text,)) for text in texts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return vectors, errors
+
+
+def test_concurrent_queries_share_forward_passes():
+    model = _HashModel()
+    batcher = EmbeddingBatcher(model, max_batch_size=4, max_wait_ms=500)
+    texts = [f"query {i}" for i in range(8)]
+    vectors, errors = _embed_concurrently(batcher, texts)
+    batcher.stop()
+    assert errors == {}
+    # each query gets its own vector
+    for text in texts:
+        np.testing.assert_array_equal(vectors[text], model.embed(text))
+    assert sorted(text for _, batch in _HashModel.passes for text in batch) == texts
+    assert all(len(batch) <= 4 for _, batch in _HashModel.passes)
+    assert len(_HashModel.passes) < len(texts)
+    assert batcher.stats()['queries'] == len(texts)
+
+
+def test_batch_failures_reach_every_query():
+    class _FailingModel(_HashModel):
+
+        def embed_batch(self, texts):
+            raise ValueError("model failed")
+
+    batcher = EmbeddingBatcher(_FailingModel(), max_batch_size=8, max_wait_ms=200)
+    vectors, errors = _embed_concurrently(batcher, ['a', 'b', 'c'])
+    batcher.stop()
+    assert vectors == {}
+    assert sorted(errors) == ['a', 'b', 'c']
+    assert all(isinstance(error, ValueError) for error in errors.values())
+    with pytest.raises(RuntimeError):
+        batcher.embed('d')
+
+
+def test_unbatched_queries_call_the_model():
+    batcher = EmbeddingBatcher(_HashModel(), max_batch_size=1)
+    np.testing.assert_array_equal(batcher.embed('robot arms'), _HashModel().embed('robot arms'))
+    assert _HashModel.passes == []
+    batcher.stop()
+
+
+def test_cache_normalizes_queries_and_is_bounded():
+    vector = np.ones(VECTOR_DIMENSIONS, dtype=np.float32)
+    cache = EmbeddingCache(max_bytes=3 * (vector.nbytes + 200))
+    for i in range(4):
+        cache.put(f"Query {i}", vector * i)
+    assert cache.get('query 0') is None
+    np.testing.assert_array_equal(cache.get('  QUERY   3 '), vector * 3)
+    assert cache.stats()['entries'] == 3
+
+
+def test_cache_survives_restarts(tmp_path):
+    path = str(tmp_path / 'embeddings.npz')
+    cache = EmbeddingCache(path=path)
+    vectors = {f"query {i}": np.random.RandomState(i).uniform(-1, 1, VECTOR_DIMENSIONS) for i in range(5)}
+    for text, vector in vectors.items():
+        cache.put(text, vector)
+    cache.get('query 0')
+    cache.save()
+    loaded = EmbeddingCache(path=path)
+    loaded.load()
+    # least recently used first, as saved
+    assert [key for key, _ in loaded._cache.items()] == ['query 1', 'query 2', 'query 3', 'query 4', 'query 0']
+    for text, vector in vectors.items():
+        np.testing.assert_array_equal(loaded.get(text), vector.astype(np.float32))
+    assert loaded.stats()['misses'] == 0
+    # a damaged file only loses the cache
+    with open(path, 'wb') as file:
+        file.write(b'not a cache')
+    damaged = EmbeddingCache(path=path)
+    damaged.load()
+    assert damaged.stats()['entries'] == 0
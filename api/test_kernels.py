@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from search import kernels
+from search.bitmap import ARRAY_CONTAINER_MAX, RoaringBitmap
+from search.iterators import ComplementIterator, NO_MORE_DOCS
+from search.kernels import Complement, DOC_ID_TYPE
+
+# Behaviour of the numpy set operations over doc id arrays (user-008), the Complement of a NOT (user-009) and the
+# roaring bitmaps of cached filters (user-010), checked against python sets. Run from the api directory with
+# python -m pytest
+
+
+def _doc_ids(rnd, size, high):
+    return np.unique(rnd.randint(1, high, size)).astype(DOC_ID_TYPE)
+
+
+# pairs of sorted unique doc id arrays - empty, disjoint, skewed in size and overlapping
+def _pairs():
+    rnd = np.random.RandomState(11)
+    empty = kernels.EMPTY_DOC_IDS
+    return [(empty, empty), (empty, _doc_ids(rnd, 10, 100)), (_doc_ids(rnd, 10, 100), empty),
+            (np.arange(1, 50, dtype=DOC_ID_TYPE), np.arange(50, 100, dtype=DOC_ID_TYPE)),
+            (_doc_ids(rnd, 5, 10000), _doc_ids(rnd, 5000, 10000)), (_doc_ids(rnd, 3000, 5000), _doc_ids(rnd, 40, 5000)),
+            (_doc_ids(rnd, 500, 1000), _doc_ids(rnd, 500, 1000))]
+
+
+@pytest.mark.parametrize('left, right', _pairs())
+def test_intersect(left, right):
+    left_indices, right_indices = kernels.intersect(left, right)
+    expected = sorted(set(left.tolist()) & set(right.tolist()))
+    assert left[left_indices].tolist() == expected
+    assert right[right_indices].tolist() == expected
+
+
+@pytest.mark.parametrize('left, right', _pairs())
+def test_difference(left, right):
+    assert left[kernels.difference(left, right)].tolist() == sorted(set(left.tolist()) - set(right.tolist()))
+
+
+def test_union_sums_scores():
+    rnd = np.random.RandomState(3)
+    inputs = [_doc_ids(rnd, size, 2000) for size in (0, 10, 800, 1500)]
+    scores = [rnd.uniform(0, 5, len(doc_ids)) for doc_ids in inputs]
+    doc_ids, summed = kernels.union(inputs, scores)
+    expected = {}
+    for input_doc_ids, input_scores in zip(inputs, scores):
+        for doc_id, score in zip(input_doc_ids.tolist(), input_scores.tolist()):
+            expected[doc_id] = expected.get(doc_id, 0) + score
+    assert doc_ids.dtype == DOC_ID_TYPE
+    assert doc_ids.tolist() == sorted(expected)
+    assert summed.tolist() == pytest.approx([expected[doc_id] for doc_id in sorted(expected)])
+    assert kernels.union([], [])[0].tolist() == []
+
+
+@pytest.mark.parametrize('excluded, min_doc_id, max_doc_id', [
+    ([], 1, 100), ([1, 2, 3, 100], 1, 100), (list(range(10, 90)), 1, 100), (list(range(1, 101)), 1, 100),
+    ([5, 50, 500, 5000], 40, 600), ([3], 10, 9)])
+def test_complement(excluded, min_doc_id, max_doc_id):
+    excluded = np.array(excluded, dtype=DOC_ID_TYPE)
+    expected = [doc_id for doc_id in range(min_doc_id, max_doc_id + 1) if doc_id not in set(excluded.tolist())]
+    assert kernels.complement(excluded, min_doc_id, max_doc_id).tolist() == expected
+    complement = Complement(excluded, min_doc_id, max_doc_id)
+    assert complement.count() == len(expected)
+    assert complement.doc_ids().tolist() == expected
+    for num_docs in (0, 1, 7, len(expected), len(expected) + 5):
+        assert complement.first(num_docs).tolist() == expected[:num_docs]
+    candidates = np.arange(min_doc_id - 5, max_doc_id + 6, dtype=DOC_ID_TYPE)
+    assert candidates[complement.contains(candidates)].tolist() == expected
+    # iterated a doc at a time as a NOT
+    iterator = ComplementIterator(complement)
+    iterated = []
+    while iterator.next() != NO_MORE_DOCS:
+        iterated.append(iterator.doc_id)
+    assert iterated == expected
+
+
+@pytest.mark.parametrize('doc_ids', [
+    [], [0], [1, 65535, 65536, 65537, 1 << 20],
+    # a dense partition held as a bitset next to sparse ones
+    list(range(70000, 70000 + ARRAY_CONTAINER_MAX + 1)) + [200000, 200005],
+    list(range(0, 300000, 3))])
+def test_roaring_bitmap_round_trip(doc_ids):
+    bitmap = RoaringBitmap.from_doc_ids(np.array(doc_ids, dtype=DOC_ID_TYPE))
+    assert len(bitmap) == len(doc_ids)
+    assert bitmap.doc_ids().tolist() == doc_ids
+    assert bitmap.doc_ids().dtype == DOC_ID_TYPE
+
+
+def test_roaring_bitmap_is_smaller_than_doc_ids():
+    dense = np.arange(0, 1 << 18, dtype=DOC_ID_TYPE)
+    sparse = np.arange(0, 1 << 18, 97, dtype=DOC_ID_TYPE)
+    # a bit per doc when dense, 2 bytes per doc when sparse
+    assert RoaringBitmap.from_doc_ids(dense).nbytes < dense.nbytes / 16
+    assert RoaringBitmap.from_doc_ids(sparse).nbytes < sparse.nbytes / 1.5
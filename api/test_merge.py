@@ -0,0 +1,149 @@
+import random
+import time
+
+import numpy as np
+import pytest
+
+import search.index as index_module
+import search.merge as merge_module
+from search import codec
+from search.analyzer import Analyzer
+from search.index import Index
+from search.merge import RateLimiter, TieredMergePolicy
+from search.models import Document, Search
+from search.posting import TermPosting
+
+# Behaviour of background merging - the tiered merge policy and the scheduler running it (user-015) - and of merges
+# copying encoded blocks rather than decoding them (user-017). Run from the api directory with python -m pytest
+
+WORDS = ['w1x', 'w2x', 'w3x', 'w4x', 'w5x', 'w6x']
+
+
+class _Segment:
+
+    def __init__(self, number_of_documents, flushed=True):
+        self.number_of_documents = number_of_documents
+        self._flushed = flushed
+
+    def is_flushed(self):
+        return self._flushed
+
+
+def test_policy_tiers():
+    policy = TieredMergePolicy(segments_per_tier=10, min_docs=100)
+    assert [policy.tier(num_docs) for num_docs in (1, 100, 999, 1000, 9999, 10000, 100000)] == [0, 0, 0, 1, 1, 2, 3]
+    with pytest.raises(ValueError):
+        TieredMergePolicy(segments_per_tier=1)
+
+
+def test_policy_merges_adjacent_flushed_segments_of_a_tier():
+    policy = TieredMergePolicy(segments_per_tier=3, max_merged_docs=5000, min_docs=100)
+    assert policy.find_merge([_Segment(100), _Segment(100)]) is None
+    # the open segment is never merged
+    assert policy.find_merge([_Segment(100), _Segment(100), _Segment(100, flushed=False)]) is None
+    assert policy.find_merge([_Segment(100), _Segment(100), _Segment(100), _Segment(100, flushed=False)]) == (0, 3)
+    # segments of different tiers aren't merged - the lowest tier goes first
+    segments = [_Segment(1000), _Segment(1000), _Segment(1000), _Segment(50), _Segment(80), _Segment(90)]
+    assert policy.find_merge(segments) == (3, 3)
+    assert policy.find_merge(segments[:3]) == (0, 3)
+    assert policy.find_merge([_Segment(1000), _Segment(50), _Segment(80)]) is None
+    # nor beyond the largest merged segment
+    assert policy.find_merge([_Segment(2000), _Segment(2000), _Segment(2000)]) is None
+
+
+def test_rate_limiter_paces_writes(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(merge_module.time, 'sleep', sleeps.append)
+    limiter = RateLimiter(1)
+    # small writes accumulate before pausing
+    limiter.pause(merge_module.MIN_PAUSE_CHECK_BYTES // 2)
+    assert sleeps == []
+    limiter.pause(1024 * 1024 - merge_module.MIN_PAUSE_CHECK_BYTES // 2)
+    assert sleeps == [pytest.approx(1, abs=0.05)]
+    limiter.set_rate(0)
+    limiter.pause(1024 * 1024)
+    assert len(sleeps) == 1
+    assert limiter.bytes == 2 * 1024 * 1024
+
+
+class _NoModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_model(monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _NoModel)
+
+
+def _add_batch(index, rnd, batch, size):
+    index.add_documents([Document(f"doc-{batch}-{i}", {'title': ' '.join(rnd.choices(WORDS, k=rnd.randint(2, 8)))})
+                         for i in range(size)])
+    index.save()
+
+
+def _results(index):
+    results = []
+    for query in ('w1x', 'w1x OR w5x', 'w2x AND w3x', '"w1x w2x"', 'NOT w4x'):
+        hits, _, total, _ = index._search(Search(query, True, 1000, 0, use_hnsw=False))
+        results.append(([(hit.id, round(hit.score, 6)) for hit in hits], total))
+    return results
+
+
+def test_scheduler_merges_in_background(tmp_path):
+    index = Index(str(tmp_path), Analyzer([], True), search_threads=None, auto_merge=True,
+                  merge_policy=TieredMergePolicy(segments_per_tier=3, min_docs=10), max_merge_mb_per_sec=0)
+    index.load()
+    try:
+        rnd = random.Random(4)
+        for batch in range(9):
+            _add_batch(index, rnd, batch, 20)
+        # 9 segments of tier 0 make 3 of tier 1, then one of tier 2
+        deadline = time.time() + 60
+        while len(index._segments) > 1 and time.time() < deadline:
+            time.sleep(0.05)
+        assert len(index._segments) == 1
+        assert index._segments[0].get_doc_id_range() == (1, 180)
+        state = index.merge_state()
+        assert state['merges'] == 4
+        assert state['last_error'] is None
+        # every doc has at least two of the words
+        assert index._search(Search(' OR '.join(WORDS), False, 1000, 0, use_hnsw=False))[2] == 180
+    finally:
+        index.close()
+
+
+def _decoded_terms(segment):
+    # copied so the decoded arrays outlive the segment's files
+    return {term: codec.decode(bytes(value)) for term, value in segment.raw_positions_items()}
+
+
+def test_merge_copies_encoded_blocks(tmp_path, monkeypatch):
+    index = Index(str(tmp_path), Analyzer([], True), search_threads=None)
+    index.load()
+    try:
+        rnd = random.Random(8)
+        # enough docs per segment for several blocks per term
+        for batch in range(3):
+            _add_batch(index, rnd, batch, 3 * codec.BLOCK_SIZE)
+        expected = _results(index)
+        terms = [_decoded_terms(segment) for segment in index._segments]
+
+        def decode_and_merge(term_postings):
+            pytest.fail("postings were decoded")
+
+        monkeypatch.setattr(TermPosting, 'merge', staticmethod(decode_and_merge))
+        index.optimize(target_segments=1)
+        merged = index._segments[0]
+        for term, (header, doc_ids, frequencies, positions) in _decoded_terms(merged).items():
+            parts = [segment_terms[term] for segment_terms in terms if term in segment_terms]
+            for decoded, i in ((doc_ids, 1), (frequencies, 2), (positions, 3)):
+                np.testing.assert_array_equal(decoded, np.concatenate([part[i] for part in parts]))
+            assert header.collection_frequency == sum(part[0].collection_frequency for part in parts)
+            assert len(header.skips) == sum(len(part[0].skips) for part in parts)
+            # the postings file holds the same blocks without positions
+            assert bytes(merged._postings_index[term]) == codec.strip_positions(merged._positions_index[term])
+        assert _results(index) == expected
+    finally:
+        index.close()
@@ -0,0 +1,101 @@
+import multiprocessing
+import random
+
+import pytest
+
+import search.index as index_module
+from search.analyzer import Analyzer
+from search.index import Index
+from search.models import Document, Filter, Search
+
+# Behaviour of read only indices serving the files of an index written by another process (user-019) - refresh picks up
+# the writer's flushes and merges, keeping the segments it has open and dropping the cached doc sets and postings of
+# those merged away. Run from the api directory with python -m pytest
+
+WORDS = ['w1x', 'w2x', 'w3x', 'w4x', 'w5x', 'w6x']
+SUBJECTS = ['Robotics', 'Cryptography', 'Machine Learning']
+BATCH_SIZE = 50
+QUERIES = [Search(query, score, 1000, 0, filters=filters, use_hnsw=False) for query, score, filters in (
+    ('w1x', True, []), ('w1x OR w5x', True, [Filter('subject', 'Robotics')]), ('"w2x w3x"', True, []),
+    ('NOT w4x', False, []))]
+
+
+class _NoModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        pass
+
+
+def _open(path, read_only=False):
+    index = Index(path, Analyzer([], True), doc_value_fields=['subject'], search_threads=None, read_only=read_only)
+    index.load()
+    return index
+
+
+def _results(index, cached=False):
+    results = []
+    for query in QUERIES:
+        hits, _, total, _ = index.search(query) if cached else index._search(query)
+        results.append(([(hit.id, round(hit.score, 6)) for hit in hits], total))
+    return results
+
+
+# runs in its own process - the doc store can't be opened twice by one process. Sends the results it sees on close
+def _write(path, batches, optimize, results):
+    index_module.BERTModule = _NoModel
+    index = _open(path)
+    for batch in batches:
+        rnd = random.Random(batch)
+        index.add_documents([Document(f"doc-{batch}-{i}", {'title': ' '.join(rnd.choices(WORDS, k=rnd.randint(2, 8))),
+                                                           'subject': [SUBJECTS[i % len(SUBJECTS)]]})
+                             for i in range(BATCH_SIZE)])
+        index.save()
+    if optimize:
+        index.optimize(target_segments=1)
+    results.put(_results(index))
+    index.close()
+
+
+def _run_writer(path, batches, optimize=False):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    writer = context.Process(target=_write, args=(path, batches, optimize, results))
+    writer.start()
+    expected = results.get(timeout=120)
+    writer.join()
+    assert writer.exitcode == 0
+    return expected
+
+
+@pytest.fixture(autouse=True)
+def no_model(monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _NoModel)
+
+
+def test_reader_refreshes_flushes_and_merges(tmp_path):
+    path = str(tmp_path)
+    expected = _run_writer(path, [0, 1])
+    reader = _open(path, read_only=True)
+    try:
+        assert len(reader._segments) == 2
+        assert _results(reader, cached=True) == expected
+        # a flush adds a segment - those already open are kept
+        segments = list(reader._segments)
+        expected = _run_writer(path, [2])
+        reader.refresh()
+        assert reader._segments[:2] == segments and len(reader._segments) == 3
+        # results cached before the refresh aren't served
+        assert _results(reader, cached=True) == expected
+        assert reader._result_cache.stats()['hits'] == 0
+        segment_ids = set(segment.segment_id for segment in reader._segments)
+        assert set(key[0] for key, _ in reader._filter_cache.items()) == segment_ids
+        # a merge replaces them all
+        expected = _run_writer(path, [], optimize=True)
+        reader.refresh()
+        assert len(reader._segments) == 1 and reader._segments[0].segment_id not in segment_ids
+        assert not set(key[0] for key, _ in reader._filter_cache.items()) & segment_ids
+        assert not set(key[0] for key, _ in reader._posting_cache.items()) & segment_ids
+        assert _results(reader, cached=True) == expected
+        assert reader.number_of_docs == 3 * BATCH_SIZE
+    finally:
+        reader.close()
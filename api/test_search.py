@@ -0,0 +1,162 @@
+import random
+
+import pytest
+
+import search.index as index_module
+from search.analyzer import Analyzer
+from search.index import Index
+from search.models import Document, Filter, Search
+
+# Behaviour of keyword query evaluation pinned by the iterator (user-005) and filter (user-010) rewrites. Run from the
+# api directory with python -m pytest
+
+WORDS = ['w1x', 'w2x', 'w3x', 'w4x', 'w5x', 'w6x', 'w7x', 'w8x']
+SUBJECTS = ['Robotics', 'Cryptography', 'Machine Learning']
+# docs added between saves - each batch is flushed to its own segment
+BATCHES = 3
+BATCH_SIZE = 40
+# phrase docs - only the first contains "w1x w2x w1x"
+PHRASE_DOCS = {
+    'phrase-exact': 'w1x w2x w1x',
+    'phrase-gap': 'w1x w2x w3x w1x',
+    'phrase-shifted': 'w2x w1x w2x',
+    'phrase-reversed': 'w1x w1x w2x',
+}
+
+
+# keyword queries aren't embedded so the BERT model isn't loaded
+class _NoModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        pass
+
+
+def _documents():
+    rnd = random.Random(7)
+    docs = [Document(doc_id, {'title': text, 'subject': ['Robotics']}) for doc_id, text in PHRASE_DOCS.items()]
+    for i in range(BATCHES * BATCH_SIZE):
+        docs.append(Document(f"doc-{i}", {
+            'title': ' '.join(rnd.choices(WORDS, k=rnd.randint(3, 12))),
+            'subject': [SUBJECTS[i % len(SUBJECTS)]]
+        }))
+    return docs
+
+
+def _open(path):
+    index = Index(str(path), Analyzer([], True), doc_value_fields=['subject'], search_threads=None)
+    index.load()
+    return index
+
+
+# an index of several flushed segments and an open one, searched from its buffer
+def _build(path):
+    index = _open(path)
+    docs = _documents()
+    size = len(docs) // BATCHES
+    for start in range(0, len(docs), size):
+        index.add_documents(docs[start:start + size])
+        if start + size < len(docs):
+            index.save()
+    return index
+
+
+@pytest.fixture(autouse=True)
+def no_model(monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _NoModel)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = _build(tmp_path)
+    yield index
+    index.close()
+
+
+def _search(index, query, score=True, max_results=1000, offset=0, filters=[]):
+    hits, _, total, _ = index.search(Search(query, score, max_results, offset, filters=filters, use_hnsw=False))
+    return [(hit.id, hit.score) for hit in hits], total
+
+
+# the words of the title of each doc, by id - optionally of the docs with a subject
+def _titles(index, subject=None):
+    docs = {}
+    for doc_id in range(1, index.current_id):
+        fields = index._get_document(str(doc_id), ['title', 'subject'])
+        if subject is None or subject in fields['subject']:
+            docs[index._id_mappings[doc_id]] = fields['title'].split()
+    return docs
+
+
+def test_unscored_offset_pages_through_all_results(index):
+    all_hits, total = _search(index, 'w1x', score=False)
+    assert len(all_hits) == total > 20
+    for offset in (0, 3, 10):
+        page, page_total = _search(index, 'w1x', score=False, max_results=5, offset=offset)
+        assert page_total == total
+        # previously max_results - offset docs were returned
+        assert [doc_id for doc_id, _ in page] == [doc_id for doc_id, _ in all_hits[offset:offset + 5]]
+
+
+@pytest.mark.parametrize('score', [True, False])
+def test_phrase_with_repeated_term(index, score):
+    hits, total = _search(index, '"w1x w2x w1x"', score=score)
+    expected = [doc_id for doc_id, words in _titles(index).items()
+                if any(words[i:i + 3] == ['w1x', 'w2x', 'w1x'] for i in range(len(words) - 2))]
+    assert 'phrase-exact' in expected
+    assert not {'phrase-gap', 'phrase-shifted', 'phrase-reversed'} & set(expected)
+    assert sorted(doc_id for doc_id, _ in hits) == sorted(expected)
+    assert total == len(expected)
+
+
+def test_filter_restricts_whole_disjunction_without_scoring(index):
+    unfiltered = dict(_search(index, 'w1x OR w7x')[0])
+    hits, total = _search(index, 'w1x OR w7x', filters=[Filter('subject', 'Cryptography')])
+    titles = _titles(index, 'Cryptography')
+    # both sides of the OR are filtered - not only the last clause
+    expected = {doc_id for doc_id, words in titles.items() if 'w1x' in words or 'w7x' in words}
+    assert {doc_id for doc_id, _ in hits} == expected
+    assert total == len(expected)
+    # the filter term adds nothing to the score
+    for doc_id, score in hits:
+        assert score == pytest.approx(unfiltered[doc_id])
+
+
+def test_not_with_filter(index):
+    hits, total = _search(index, 'NOT w1x', score=False, filters=[Filter('subject', 'Robotics')])
+    expected = {doc_id for doc_id, words in _titles(index, 'Robotics').items() if 'w1x' not in words}
+    assert {doc_id for doc_id, _ in hits} == expected
+    assert total == len(expected)
+
+
+QUERIES = [('w1x', True, []), ('w1x OR w7x', True, []), ('w2x AND w3x', True, []), ('w2x AND NOT w3x', False, []),
+           ('"w1x w2x w1x"', True, []), ('"w1x w2x"', False, []), ('#3(w1x, w4x)', True, []),
+           ('w1x OR w7x', True, [Filter('subject', 'Cryptography')]),
+           ('NOT w1x', False, [Filter('subject', 'Robotics')])]
+
+
+def _results(index):
+    results = []
+    for query, score, filters in QUERIES:
+        for max_results, offset in ((10, 0), (5, 7), (1000, 0)):
+            hits, total = _search(index, query, score=score, max_results=max_results, offset=offset, filters=filters)
+            results.append(([(doc_id, round(doc_score, 6)) for doc_id, doc_score in hits], total))
+    return results
+
+
+def test_results_unchanged_by_optimize_and_reload(tmp_path):
+    index = _build(tmp_path)
+    try:
+        expected = _results(index)
+        # the open segment is flushed first
+        index.save()
+        assert len(index._segments) > 2
+        index.optimize(target_segments=1)
+        assert len(index._segments) == 1
+        assert _results(index) == expected
+    finally:
+        index.close()
+    index = _open(tmp_path)
+    try:
+        assert _results(index) == expected
+    finally:
+        index.close()
@@ -0,0 +1,163 @@
+import os
+import random
+
+import pytest
+
+import search.index as index_module
+from search.analyzer import Analyzer
+from search.bloom import BloomFilter
+from search.dictionary import BLOCK_SIZE, TermDictionary
+from search.index import Index
+from search.models import Document
+from search.store import MappedStore, OffsetIndex, Store
+
+# Behaviour of the files read by flushed segments - the offset index sidecar of a store (user-003), the front coded term
+# dictionary (user-004) and the bloom filters over its terms (user-007). Run from the api directory with
+# python -m pytest
+
+WORDS = ['w1x', 'w2x', 'w3x', 'w4x', 'w5x', 'w6x']
+
+
+class _NoModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_model(monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _NoModel)
+
+
+def _write_store(path, items):
+    store = Store(path, binary=True)
+    for key, value in items.items():
+        store[key] = value
+    return store
+
+
+def test_offset_index_is_written_on_seal_and_reused(tmp_path, monkeypatch):
+    path = str(tmp_path / 'values.dat')
+    items = {f"term-{i}": os.urandom(i % 17) for i in range(500)}
+    store = _write_store(path, items)
+    reader = MappedStore(path, offsets=store.seal())
+    assert {key: bytes(reader[key]) for key in items} == items
+    reader.close()
+    assert os.path.exists(OffsetIndex.path_for(path))
+    # reopened from the sidecar without scanning the file
+    monkeypatch.setattr(MappedStore, 'scan_offsets', lambda self: pytest.fail("store was scanned"))
+    reader = MappedStore(path)
+    assert len(reader) == len(items)
+    assert sorted(reader.keys()) == sorted(items)
+    assert {key: bytes(reader[key]) for key in items} == items
+    assert 'term-500' not in reader
+    with pytest.raises(KeyError):
+        reader['term-500']
+    reader.close()
+
+
+def test_stale_offset_index_is_rebuilt(tmp_path):
+    path = str(tmp_path / 'values.dat')
+    store = _write_store(path, {1: b'one', 2: b'two'})
+    MappedStore(path, offsets=store.seal()).close()
+    # the file grew after the index was written e.g. a crash before the sidecar was replaced
+    store = Store(path)
+    store[3] = b'three'
+    store.seal()
+    reader = MappedStore(path)
+    offset_index = OffsetIndex(OffsetIndex.path_for(path))
+    assert offset_index.data_size == os.path.getsize(path)
+    offset_index.close()
+    assert [bytes(reader[key]) for key in (1, 2, 3)] == [b'one', b'two', b'three']
+    reader.close()
+
+
+# terms with long shared prefixes, spanning several blocks
+TERMS = sorted(set([f"{prefix}{suffix}" for prefix in ('a', 'ab', 'abc', 'robot', 'robotic', 'größe', 'zz')
+                    for suffix in ('', 's', 'ed', 'ing', '1', '2', '10', 'é')]))
+
+
+@pytest.fixture
+def dictionary(tmp_path):
+    path = str(tmp_path / 'terms.tdi')
+    postings = {term: (i * 10, i + 1) for i, term in enumerate(TERMS)}
+    positions = {term: (i * 100, 2 * i + 1) for i, term in enumerate(TERMS)}
+    # only terms in every column are written
+    postings['only-postings'] = (0, 1)
+    TermDictionary.write(path, [postings, positions], [1000, 2000])
+    dictionary = TermDictionary(path)
+    yield dictionary
+    dictionary.close()
+
+
+def test_dictionary_lookups(dictionary):
+    assert len(TERMS) > 3 * BLOCK_SIZE
+    assert len(dictionary) == len(TERMS)
+    assert list(dictionary) == TERMS
+    for ordinal, term in enumerate(TERMS):
+        assert dictionary.ordinal(term) == ordinal
+        assert dictionary.term(ordinal) == term
+        assert dictionary.value(ordinal, 0) == (ordinal * 10, ordinal + 1)
+        assert dictionary.value(ordinal, 1) == (ordinal * 100, 2 * ordinal + 1)
+    for missing in ('', '0', 'aa', 'abcd', 'robotica', 'zzz', 'only-postings', '￿'):
+        assert dictionary.ordinal(missing) == -1
+    with pytest.raises(IndexError):
+        dictionary.term(len(TERMS))
+    column = dictionary.column(1)
+    assert column['robotics'] == dictionary.value(TERMS.index('robotics'), 1)
+    assert 'robotica' not in column
+    with pytest.raises(KeyError):
+        column['robotica']
+
+
+@pytest.mark.parametrize('prefix', ['', 'a', 'ab', 'abc', 'robot', 'robotic', 'größe', 'gr', 'z', 'q', 'zzz'])
+def test_dictionary_prefix_scan(dictionary, prefix):
+    assert list(dictionary.prefix(prefix)) == [(term, TERMS.index(term)) for term in TERMS if term.startswith(prefix)]
+
+
+def test_dictionary_is_invalid_for_other_data(tmp_path, dictionary):
+    assert TermDictionary.is_valid(dictionary.path, [1000, 2000])
+    assert not TermDictionary.is_valid(dictionary.path, [1000, 2001])
+    assert not TermDictionary.is_valid(dictionary.path, [1000])
+    assert not TermDictionary.is_valid(str(tmp_path / 'missing.tdi'), [1000, 2000])
+
+
+def test_bloom_filter_has_no_false_negatives(tmp_path):
+    terms = [f"term-{i}" for i in range(5000)]
+    bloom_filter = BloomFilter.from_terms(terms)
+    assert all(term in bloom_filter for term in terms)
+    false_positives = sum(f"other-{i}" in bloom_filter for i in range(20000))
+    assert false_positives < 20000 * 0.02
+    path = str(tmp_path / 'terms.blm')
+    bloom_filter.write(path)
+    read = BloomFilter.read(path)
+    assert read.count == len(terms)
+    assert all(term in read for term in terms)
+    assert sum(f"other-{i}" in read for i in range(20000)) == false_positives
+    # a partial file is rejected so the segment rebuilds it
+    with open(path, 'r+b') as file:
+        file.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError):
+        BloomFilter.read(path)
+
+
+def test_segment_rejects_missing_terms_without_dictionary_lookups(tmp_path, monkeypatch):
+    index = Index(str(tmp_path), Analyzer([], True), search_threads=None)
+    index.load()
+    try:
+        rnd = random.Random(5)
+        index.add_documents([Document(f"doc-{i}", {'title': ' '.join(rnd.choices(WORDS, k=5))}) for i in range(50)])
+        index.save()
+        segment = index._segments[0]
+        lookups = []
+        ordinal = TermDictionary.ordinal
+        monkeypatch.setattr(TermDictionary, 'ordinal', lambda self, term: lookups.append(term) or ordinal(self, term))
+        assert segment.get_term_blocks('w1x') is not None
+        assert lookups == ['w1x']
+        missing = [f"missing{i}" for i in range(200)]
+        for term in missing:
+            assert segment.get_term_blocks(term) is None
+        # only false positives of the filter reach the dictionary
+        assert len(lookups) - 1 < len(missing) * 0.05
+    finally:
+        index.close()
@@ -0,0 +1,120 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+import search.index as index_module
+import search.query as query_module
+from search.analyzer import Analyzer
+from search.index import Index, VECTOR_DIMENSIONS
+from search.models import Document, Facet, Filter, Search
+
+# Behaviour of natural language searches over the hnsw index - adaptive k (user-024) and filtered search (user-025).
+# Run from the api directory with python -m pytest
+
+NUM_DOCS = 400
+SUBJECTS = ['Robotics', 'Cryptography', 'Machine Learning', 'Computer Vision']
+QUERY = 'learning robot arms'
+
+
+# a vector per text from its hash, so queries embed without the BERT model
+class _HashModel:
+
+    def __init__(self, vmodel=0, backend='fp32'):
+        self.calls = 0
+
+    def embed(self, text, sentwise=True):
+        seed = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
+        return np.random.RandomState(seed).uniform(-1, 1, VECTOR_DIMENSIONS).astype(np.float32)
+
+    def embed_batch(self, texts):
+        self.calls += 1
+        return [self.embed(text) for text in texts]
+
+
+def _vector(i):
+    return np.random.RandomState(i).uniform(-1, 1, VECTOR_DIMENSIONS)
+
+
+def _documents():
+    return [Document(f"doc-{i}", {'title': f"title {i}", 'subject': [SUBJECTS[i % len(SUBJECTS)]]},
+                     vector=_vector(i).tolist()) for i in range(NUM_DOCS)]
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_module, 'BERTModule', _HashModel)
+    index = Index(str(tmp_path), Analyzer([], True), doc_value_fields=['subject'], search_threads=None)
+    index.load()
+    docs = _documents()
+    index.add_documents(docs[:NUM_DOCS // 2])
+    index.save()
+    index.add_documents(docs[NUM_DOCS // 2:])
+    yield index
+    index.close()
+
+
+# the exact cosine distance of every doc (optionally with a subject) to the query, nearest first
+def _exact(subject=None):
+    query = _HashModel().embed(QUERY)
+    query = query / np.linalg.norm(query)
+    distances = []
+    for i in range(NUM_DOCS):
+        if subject is None or SUBJECTS[i % len(SUBJECTS)] == subject:
+            vector = _vector(i)
+            distances.append((1 - float(vector @ query / np.linalg.norm(vector)), f"doc-{i}"))
+    return sorted(distances)
+
+
+def _search(index, max_results=10, offset=0, filters=[], facets=[], max_distance=0.8):
+    # bypasses the result cache so settings changed by a test apply
+    hits, facet_counts, total, _ = index._search(Search(QUERY, True, max_results, offset, facets=facets,
+                                                        filters=filters, max_distance=max_distance))
+    return [(hit.id, hit.score) for hit in hits], facet_counts, total
+
+
+@pytest.mark.parametrize('max_exact_docs', [query_module.MAX_EXACT_VECTOR_DOCS, 10])
+def test_filtered_search_returns_nearest_filtered_docs(index, monkeypatch, max_exact_docs):
+    # with a cutoff below the number of filtered docs the filter is an allow-list of the hnsw search
+    monkeypatch.setattr(query_module, 'MAX_EXACT_VECTOR_DOCS', max_exact_docs)
+    max_distance = 1.0
+    expected = [(doc_id, 1 - distance) for distance, doc_id in _exact('Robotics') if distance <= max_distance]
+    hits, facet_counts, total = _search(index, max_results=10, filters=[Filter('subject', 'Robotics')],
+                                        facets=[Facet('subject', 5)], max_distance=max_distance)
+    assert [doc_id for doc_id, _ in hits] == [doc_id for doc_id, _ in expected[:10]]
+    assert [score for _, score in hits] == pytest.approx([score for _, score in expected[:10]], abs=1e-5)
+    assert total == len(expected)
+    assert facet_counts == {'subject': {'Robotics': len(expected)}}
+
+
+def test_page_without_facets_retrieves_few_neighbours(index, monkeypatch):
+    ks = []
+    find_closest_vectors = Index.find_closest_vectors
+    # patched on the class - the index pickles its attributes when closed
+    monkeypatch.setattr(Index, 'find_closest_vectors', lambda self, vector, k, allowed=None: ks.append(k) or
+                        find_closest_vectors(self, vector, k, allowed))
+    expected = [doc_id for distance, doc_id in _exact() if distance <= 1.0]
+    for offset in (0, 20):
+        ks.clear()
+        hits, _, total, lower_bound = index._search(Search(QUERY, True, 10, offset, max_distance=1.0))
+        assert [hit.id for hit in hits] == expected[offset:offset + 10]
+        # a single search for a few neighbours - every one within the distance, so the total is a lower bound
+        assert ks == [max((offset + 10) * query_module.VECTOR_K_FACTOR, query_module.MIN_VECTOR_K)]
+        assert lower_bound
+        assert offset + 10 <= total < len(expected)
+    ks.clear()
+    hits, _, total, lower_bound = index._search(Search(QUERY, True, 10, 0, facets=[Facet('subject', 5)],
+                                                       max_distance=1.0))
+    # facets need every neighbour so the total is exact
+    assert ks == [index.max_vector_results()]
+    assert not lower_bound
+    assert total == len(expected)
+
+
+def test_total_is_exact_when_the_distance_cuts_the_neighbours(index):
+    expected = [doc_id for distance, doc_id in _exact() if distance <= 0.95]
+    assert 10 < len(expected) < query_module.MIN_VECTOR_K
+    hits, _, total, lower_bound = index._search(Search(QUERY, True, 10, 0, max_distance=0.95))
+    assert [hit.id for hit in hits] == expected[:10]
+    assert total == len(expected)
+    assert not lower_bound
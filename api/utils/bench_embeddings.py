@@ -0,0 +1,112 @@
+import argparse
+import itertools
+import statistics
+import time
+
+import numpy as np
+import ujson as json
+
+from search.bert import BERTModule, BACKENDS
+
+
+# Benchmark of the query embedding backends of BERTModule against the fp32 model. For each backend reports the latency
+# of embedding a single query and the recall of the top k docs found with its query vectors vs those found with the fp32
+# vectors - docs are ranked exactly by cosine similarity so only the embedding differs. Doc vectors are read from a
+# vector file as used by index.py (lines of id,[vector]) or embedded with the fp32 model from an ndjson file. Run from the
+# api directory e.g. python -m utils.bench_embeddings -v vectors.txt -q utils/queries.txt
+
+
+def read_queries(filename, max_queries):
+    queries = []
+    with open(filename, "r") as query_file:
+        for line in query_file:
+            # lines are query,expected hits - phrase quotes don't matter to the model
+            query = line.strip().rsplit(",", 1)[0].replace('"', '').strip()
+            if query and query not in queries:
+                queries.append(query)
+            if len(queries) == max_queries:
+                break
+    return queries
+
+
+def read_vectors(filename, max_docs):
+    vectors = []
+    with open(filename, "r") as vector_file:
+        for line in itertools.islice(vector_file, max_docs):
+            vectors.append(json.loads(line.strip().split(",", 1)[1]))
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def embed_docs(model, filename, max_docs):
+    texts = []
+    with open(filename, "r") as doc_file:
+        for line in itertools.islice(doc_file, max_docs):
+            doc = json.loads(line)
+            texts.append(f"{doc.get('title', '')} {doc.get('abstract', '')}")
+    return np.asarray(model.embed_batch(texts), dtype=np.float32)
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def embed_queries(model, queries):
+    vectors = []
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        vectors.append(model.embed(query, sentwise=False))
+        times.append(time.perf_counter() - start)
+    return np.asarray(vectors, dtype=np.float32), times
+
+
+def top_k(query_vectors, doc_vectors, k):
+    scores = normalize(query_vectors) @ doc_vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query embedding backend benchmark")
+    parser.add_argument("-q", "--queries", help="query file", default="utils/queries.txt")
+    parser.add_argument("-v", "--vector_file", help="doc vector file", required=False, default=None)
+    parser.add_argument("-f", "--file", help="ndjson doc file - embedded if no vector file", required=False,
+                        default=None)
+    parser.add_argument("-m", "--max_docs", help="max docs", default=100000, type=int)
+    parser.add_argument("-n", "--max_queries", help="max queries", default=500, type=int)
+    parser.add_argument("-k", "--k", help="top k for recall", default=10, type=int)
+    parser.add_argument("-b", "--backends", help="backends to compare with fp32", default="int8")
+    args = parser.parse_args()
+    if args.vector_file is None and args.file is None:
+        parser.error("a vector file or doc file is required")
+    queries = read_queries(args.queries, args.max_queries)
+    reference = BERTModule(vmodel=4, backend='fp32')
+    if args.vector_file:
+        docs = read_vectors(args.vector_file, args.max_docs)
+    else:
+        print(f"Embedding docs from {args.file}...", end="", flush=True)
+        docs = embed_docs(reference, args.file, args.max_docs)
+        print("OK")
+    docs = normalize(docs)
+    k = min(args.k, len(docs))
+    print(f"{len(queries)} queries, {len(docs)} docs, recall@{k}")
+    # warm up so the first query doesn't pay for lazy initialisation
+    reference.embed(queries[0], sentwise=False)
+    reference_vectors, reference_times = embed_queries(reference, queries)
+    reference_top = top_k(reference_vectors, docs, k)
+    print(f"{'backend':10s} {'median ms':>10s} {'p95 ms':>10s} {'speedup':>8s} {'cosine':>8s} {'recall':>8s}")
+    reference_median = statistics.median(reference_times)
+    print(f"{'fp32':10s} {reference_median * 1000:10.2f} "
+          f"{np.percentile(reference_times, 95) * 1000:10.2f} {1:8.2f} {1:8.4f} {1:8.4f}")
+    for backend in args.backends.split(","):
+        if backend not in BACKENDS:
+            parser.error(f"unknown backend {backend}")
+        model = BERTModule(vmodel=4, backend=backend)
+        model.embed(queries[0], sentwise=False)
+        vectors, times = embed_queries(model, queries)
+        cosine = np.mean(np.sum(normalize(vectors) * normalize(reference_vectors), axis=1))
+        recall = np.mean([len(found & expected) / k for found, expected in zip(top_k(vectors, docs, k),
+                                                                                reference_top)])
+        median = statistics.median(times)
+        print(f"{backend:10s} {median * 1000:10.2f} {np.percentile(times, 95) * 1000:10.2f} "
+              f"{reference_median / median:8.2f} {cosine:8.4f} {recall:8.4f}")
@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import numpy as np
+
+from search import kernels
+from search.iterators import AndIterator, ListIterator, NotIterator, OrIterator, NO_MORE_DOCS
+
+
+# Microbenchmark of the numpy set operation kernels against the document at a time iterators, over random sorted doc id
+# lists. Run from the api directory e.g. python -m utils.bench_kernels -n 1000000
+
+
+def random_postings(rng, num_docs, density):
+    doc_ids = np.flatnonzero(rng.random(num_docs) < density).astype(kernels.DOC_ID_TYPE)
+    return doc_ids, rng.random(len(doc_ids))
+
+
+def drain(iterator):
+    count = 0
+    total = 0
+    doc_id = iterator.next()
+    while doc_id != NO_MORE_DOCS:
+        count += 1
+        total += iterator.score()
+        doc_id = iterator.next()
+    return count, total
+
+
+def list_iterator(postings):
+    return ListIterator(postings[0].tolist(), postings[1].tolist())
+
+
+def time_it(function, repeats):
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start = time.time()
+        result = function()
+        best = min(best, time.time() - start)
+    return best, result
+
+
+def intersect_arrays(left, right):
+    left_indices, right_indices = kernels.intersect(left[0], right[0])
+    scores = left[1][left_indices] + right[1][right_indices]
+    return len(left_indices), scores.sum()
+
+
+def union_arrays(operands):
+    doc_ids, scores = kernels.union([operand[0] for operand in operands], [operand[1] for operand in operands])
+    return len(doc_ids), scores.sum()
+
+
+def difference_arrays(left, right):
+    keep = kernels.difference(left[0], right[0])
+    return int(keep.sum()), float(keep.sum())
+
+
+def union_iterators(operands):
+    iterator = list_iterator(operands[0])
+    for operand in operands[1:]:
+        iterator = OrIterator(list_iterator(operand), iterator)
+    return drain(iterator)
+
+
+def report(name, iterators, arrays):
+    (iterator_time, iterator_result), (array_time, array_result) = iterators, arrays
+    if iterator_result[0] != array_result[0] or abs(iterator_result[1] - array_result[1]) > 1e-6 * max(
+            abs(iterator_result[1]), 1):
+        print(f"{name}: results differ - {iterator_result} vs {array_result}")
+    print(f"{name:40s} {iterator_result[0]:>10d} docs  iterators {iterator_time * 1000:10.2f}ms  "
+          f"arrays {array_time * 1000:8.2f}ms  {iterator_time / max(array_time, 1e-9):8.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Set operation kernel benchmark")
+    parser.add_argument("-n", "--num_docs", help="number of docs", default=1000000, type=int)
+    parser.add_argument("-r", "--repeats", help="repeats per operation - the best time is reported", default=3,
+                        type=int)
+    parser.add_argument("-s", "--seed", help="random seed", default=42, type=int)
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+    common = random_postings(rng, args.num_docs, 0.2)
+    medium = random_postings(rng, args.num_docs, 0.05)
+    rare = random_postings(rng, args.num_docs, 0.001)
+    terms = [random_postings(rng, args.num_docs, density) for density in (0.1, 0.05, 0.02, 0.01)]
+
+    report("intersect common AND medium",
+           time_it(lambda: drain(AndIterator(list_iterator(common), list_iterator(medium), score=True)), args.repeats),
+           time_it(lambda: intersect_arrays(common, medium), args.repeats))
+    report("intersect rare AND common",
+           time_it(lambda: drain(AndIterator(list_iterator(rare), list_iterator(common), score=True)), args.repeats),
+           time_it(lambda: intersect_arrays(rare, common), args.repeats))
+    report("union common OR medium",
+           time_it(lambda: union_iterators([common, medium]), args.repeats),
+           time_it(lambda: union_arrays([common, medium]), args.repeats))
+    report(f"union of {len(terms)} terms",
+           time_it(lambda: union_iterators(terms), args.repeats),
+           time_it(lambda: union_arrays(terms), args.repeats))
+    report("difference common AND NOT medium",
+           time_it(lambda: drain(AndIterator(list_iterator((common[0], np.ones(len(common[0])))),
+                                             NotIterator(list_iterator(medium), 0, args.num_docs - 1))),
+                   args.repeats),
+           time_it(lambda: difference_arrays(common, medium), args.repeats))
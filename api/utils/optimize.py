@@ -6,16 +6,21 @@ import requests
 
 def optimize(host, port, target_segments):
     print(f"Optimizing to {target_segments}")
-    response = requests.get(f"http://{host}:{port}/optimize", timeout=36000)
+    response = requests.get(f"http://{host}:{port}/optimize", params={"target_segments": target_segments},
+                            timeout=36000)
     while response.status_code == 200:
         body = response.json()
         before = body["segments"]["before"]
         after = body["segments"]["after"]
         print(f"{before} segments optimized to {after}")
-        if after == target_segments:
+        if after <= target_segments:
             print("Target segments reached!")
             return
-        response = requests.get(f"http://{host}:{port}/optimize", timeout=36000)
+        if after == before:
+            print("No further segments can be merged - flush the index first")
+            return
+        response = requests.get(f"http://{host}:{port}/optimize", params={"target_segments": target_segments},
+                                timeout=36000)
     print(f"Exited with unexpected {response.status_code} - {response.text}")
 
 
@@ -29,7 +34,8 @@ def build_suggestions(host, port):
 
 
 if __name__ == '__main__':
-    # This script optimizes the index down to a target number of segments by repeatedly calling _optimize
+    # This script optimizes the index down to a target number of segments by calling _optimize - the segments are
+    # merged down to the target in one call, it is repeated in case any segments were left open
     parser = argparse.ArgumentParser(description="Indexing script")
     parser.add_argument("-a", "--host", help="host", default="localhost")
     parser.add_argument("-p", "--port", help="port", default=5000, type=int)